@@ -9,8 +9,24 @@ the average key size and data size across all traffic snapshots.
 
 __version__ = '2.0p0'
 
+import checkpoint
 import cli
+import collector
+import exporter
+import histogram
 import manager
 import memcache
+import mrc
+import namespace
 import network
+import output
+import pipeline
+import replay
+import ring
+import sampling
+import sketch
+import slabs
+import stream
 import ui
+import window
+import workers
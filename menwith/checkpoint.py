@@ -0,0 +1,269 @@
+"""
+Checkpoints of the aggregated decoder state
+
+The counters, key sketches, histograms and rolling windows of a decoder are
+written to a file every interval, so a long gather that dies or is
+restarted can resume from its last checkpoint instead of starting over.
+
+A checkpoint is a header naming the format and its version, the length
+and CRC32 of the body, followed by the body, the options the state was
+gathered with and the decoder state pickled with the highest binary
+protocol. A run only resumes from a checkpoint gathered with the same
+options, as counts scaled by another sampling rate, keys tracked another
+way or namespaces normalized by other rules can not be added up. Each
+write goes to a temporary file beside the checkpoint that is synced and
+renamed over it, so the file is always either the previous checkpoint or
+the new one, never a partial one. Reading hands the body to the unpickler
+in one call.
+
+Pickling a large state takes time, so a periodic checkpoint forks and
+leaves the pickling and writing to the child, which has a copy of the state
+as it was at the fork. Only one child writes at a time, a checkpoint that
+comes due while the last one is still being written is skipped.
+
+Decode workers each write their own part of a checkpoint the same way, a
+file beside it numbered for the worker, so no worker waits on pickling its
+state, nor on the parent. The parent merges the latest parts into the
+checkpoint itself from a forked child too.
+
+"""
+import cPickle
+import errno
+import logging
+import os
+import struct
+import time
+import zlib
+
+# The file header, the format magic and version, the body length and CRC32
+MAGIC = 'MNWC'
+VERSION = 4
+_HEADER = struct.Struct('!4sHQI')
+
+# The default seconds between checkpoints
+INTERVAL = 60.0
+
+# The options the decoder state depends on and their command line flags
+SETTINGS = [('sample', '--sample'), ('top_keys', '--top-keys'),
+            ('key_error', '--key-error'), ('responses', '--responses'),
+            ('distinct', '--distinct'), ('namespaces', '--namespaces'),
+            ('mrc', '--mrc'), ('mrc_rate', '--mrc-rate'),
+            ('mrc_keys', '--mrc-keys')]
+
+
+def _setting(options, name):
+    """Return the value of an option the decoder state depends on, the
+    rules of the namespace normalizer rather than the normalizer itself.
+
+    :param optparse.Values options: The command line options
+    :param str name: The option
+    :returns: mixed
+
+    """
+    value = getattr(options, name)
+    if name == 'namespaces' and value is not None:
+        return (value.delimiters, value.collapse, value.patterns)
+    return value
+
+
+def mismatched(settings, options):
+    """Return the flags of the options that differ from those a checkpoint
+    was gathered with.
+
+    :param dict settings: The options of the checkpoint
+    :param optparse.Values options: The command line options
+    :returns: list
+
+    """
+    return [flag for name, flag in SETTINGS
+            if settings.get(name) != _setting(options, name)]
+
+
+def part(path, index):
+    """Return the file the worker at index writes its part of the
+    checkpoint at path to.
+
+    :param str path: The checkpoint file
+    :param int index: The worker index
+    :returns: str
+
+    """
+    return '%s.%i' % (path, index)
+
+
+def settings(options):
+    """Return the options the decoder state depends on, to be kept with it.
+
+    :param optparse.Values options: The command line options
+    :returns: dict
+
+    """
+    return dict([(name, _setting(options, name)) for name, flag in SETTINGS])
+
+
+def read(path):
+    """Return the options and the decoder state in the checkpoint file at
+    path.
+
+    :param str path: The checkpoint file
+    :returns: tuple
+    :raises: ValueError
+
+    """
+    with open(path, 'rb') as handle:
+        header = handle.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError('%s is not a menwith checkpoint' % path)
+        magic, version, length, checksum = _HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a version %i menwith checkpoint' %
+                             (path, VERSION))
+        body = handle.read(length + 1)
+    if len(body) != length or zlib.crc32(body) & 0xffffffff != checksum:
+        raise ValueError('%s is damaged' % path)
+    return cPickle.loads(body)
+
+
+def write(path, settings, state):
+    """Write the options and decoder state to the checkpoint file at path,
+    replacing it only once the new checkpoint is complete.
+
+    :param str path: The checkpoint file
+    :param dict settings: The options the state was gathered with
+    :param dict state: The decoder state
+
+    """
+    body = cPickle.dumps((settings, state), cPickle.HIGHEST_PROTOCOL)
+    temporary = '%s.%i.tmp' % (path, os.getpid())
+    try:
+        with open(temporary, 'wb') as handle:
+            handle.write(_HEADER.pack(MAGIC, VERSION, len(body),
+                                      zlib.crc32(body) & 0xffffffff))
+            handle.write(body)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.rename(temporary, path)
+    except Exception:
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+        raise
+
+    # Make the rename itself durable
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+class Checkpointer(object):
+    """Writes a checkpoint of the decoder state every interval from a
+    forked child, so the decoding process does not wait on the pickling or
+    the disk.
+
+    """
+    def __init__(self, path, settings, interval=INTERVAL, parts=0):
+        """Create a new Checkpointer writing to the file at path, removing
+        any parts of it left by an earlier run.
+
+        :param str path: The checkpoint file
+        :param dict settings: The options the state is gathered with
+        :param float interval: The seconds between checkpoints
+        :param int parts: The number of workers writing parts of it
+
+        """
+        self._logger = logging.getLogger('menwith.checkpoint.Checkpointer')
+        self.path = path
+        self.settings = settings
+        self.interval = interval
+        self.deadline = time.time() + interval
+        self.written = 0
+        self.skipped = 0
+        self._child = None
+        self.parts = [part(path, index) for index in xrange(parts)]
+        self._remove_parts()
+
+    def _reap(self, block=False):
+        """Collect the exit status of the child writing the last checkpoint
+        if it has exited, or wait for it to.
+
+        :param bool block: Wait for the child to exit
+        :returns: bool
+
+        """
+        if self._child is None:
+            return True
+        try:
+            pid, status = os.waitpid(self._child, 0 if block else os.WNOHANG)
+        except OSError as error:
+            if error.errno != errno.ECHILD:
+                raise
+            pid, status = self._child, 0
+        if not pid:
+            return False
+        self._child = None
+        if status:
+            self._logger.error('Could not write the checkpoint %s, the '
+                               'writer exited with status %i', self.path,
+                               status)
+        else:
+            self.written += 1
+        return True
+
+    def _remove_parts(self):
+        """Remove the parts of the checkpoint written by workers."""
+        for path in self.parts:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def due(self):
+        """Return if the next checkpoint is due.
+
+        :returns: bool
+
+        """
+        return time.time() >= self.deadline
+
+    def checkpoint(self, state):
+        """Write the decoder state from a forked child, unless the last
+        checkpoint is still being written. The state may be a callable
+        returning it, called in the child.
+
+        :param dict|callable state: The decoder state, not copied
+
+        """
+        self.deadline = time.time() + self.interval
+        if not self._reap():
+            self.skipped += 1
+            self._logger.warning('Skipped a checkpoint, the last one is '
+                                 'still being written')
+            return
+        pid = os.fork()
+        if not pid:
+            # Nothing but the write happens in the child, which exits
+            # without running any of the parent's cleanup
+            status = 0
+            try:
+                write(self.path, self.settings,
+                      state() if callable(state) else state)
+            except Exception:
+                status = 1
+            os._exit(status)
+        self._child = pid
+
+    def finish(self, state):
+        """Wait for any checkpoint being written and write a final one in
+        this process.
+
+        :param dict state: The decoder state
+
+        """
+        self._reap(True)
+        write(self.path, self.settings, state)
+        self._remove_parts()
+        self.written += 1
+        self._logger.info('Wrote the checkpoint %s', self.path)
+
+    def wait(self):
+        """Wait for any checkpoint being written."""
+        self._reap(True)
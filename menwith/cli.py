@@ -2,15 +2,47 @@ __author__ = 'gmr'
 
 import logging
 import optparse
+import os
 import signal
+import socket
 
+from . import checkpoint
+from . import collector
+from . import exporter
 from . import manager
+from . import memcache
+from . import mrc
+from . import namespace
+from . import output
+from . import pipeline
+from . import sampling
+from . import slabs
 from . import __version__
 
-OUTPUT_FORMATS = ['formatted', 'csv', 'xsl']
-REQUIRES_FILE_OUTPUT = ['csv', 'xls']
+OUTPUT_FORMATS = ['formatted', 'csv', 'jsonl', 'binary']
+REQUIRES_FILE_OUTPUT = ['binary']
 parser = None
 
+def _parse_ports(value):
+    """Return the ports in a comma separated list of ports and port ranges
+    such as 11211,11213-11215.
+
+    :param str value: The port list
+    :returns: list
+    :raises: ValueError
+
+    """
+    ports = list()
+    for part in value.split(','):
+        if '-' in part:
+            first, last = [int(port) for port in part.split('-', 1)]
+        else:
+            first = last = int(part)
+        if not 0 < first <= last < 65536:
+            raise ValueError('Invalid port range: %s' % part)
+        ports.extend(range(first, last + 1))
+    return ports
+
 def _check_values(values, args):
 
     error = False
@@ -35,19 +67,28 @@ def _check_values(values, args):
 
         # If the specified an output format and no file
         if not values.file and values.output in REQUIRES_FILE_OUTPUT:
-            error = 'You must specify a file when using csv or xsl output.'
+            error = 'You must specify a file when using binary output.'
+
+        if values.timeout < 0:
+            error = 'The timeout can not be negative.'
+
+        if values.interval <= 0:
+            error = 'The record interval must be greater than 0.'
+
+        # Streamed records only report totals, so keep the key tables from
+        # growing with the run by tracking just the most used keys
+        if values.output in output.WRITERS and values.top_keys is None:
+            values.top_keys = output.TOP_KEYS
 
         if values.window:
             error = 'You can only use WX view in interactive mode'
 
     elif values.interactive:
 
+        # The window interface is a placeholder that shows nothing yet
         if values.window:
-            try:
-                import wx
-            except ImportError:
-                error = 'Windowed interactive mode specified but wxWidgets \
-is not installed, please install wxWidgets.'
+            error = 'Windowed interactive mode is not available yet, use \
+the curses interface.'
 
         else:
             try:
@@ -56,6 +97,165 @@ is not installed, please install wxWidgets.'
                 error = 'Could not start interactive mode as curses could \
 not be loaded. Please install curses.'
 
+        if values.refresh <= 0:
+            error = 'The refresh interval must be greater than 0.'
+
+    # Make sure the metrics endpoint can listen
+    if values.metrics_port is not None:
+        if not 0 <= values.metrics_port < 65536:
+            error = 'Invalid metrics port: %i' % values.metrics_port
+        if values.metrics_interval <= 0:
+            error = 'The metrics interval must be greater than 0.'
+
+    if values.checkpoint_interval <= 0:
+        error = 'The checkpoint interval must be greater than 0.'
+
+    # Make sure an agent can reach its collector and sends only deltas
+    if values.agent:
+        host, separator, port = values.agent.rpartition(':')
+        if host and port.isdigit() and 0 < int(port) < 65536:
+            values.agent = (host, int(port))
+        else:
+            error = 'Invalid collector address: %s' % values.agent
+        if values.agent_interval <= 0:
+            error = 'The agent interval must be greater than 0.'
+        if not values.gather or values.output != 'formatted' or \
+                values.checkpoint or values.metrics_port is not None:
+            error = 'An agent only sends deltas to its collector, it can \
+only run in gather mode without output, checkpoints or metrics.'
+        if values.collect is not None:
+            error = 'You can not run as both an agent and a collector.'
+        values.agent_name = values.agent_name or socket.gethostname()
+
+    # Make sure a collector can listen and has nothing to capture
+    if values.collect is not None:
+        if not 0 <= values.collect < 65536:
+            error = 'Invalid collector port: %i' % values.collect
+        if values.replay:
+            error = 'A collector merges the deltas of agents, it can not \
+replay a tcpdump file.'
+
+    # The fleet wide statistics only stay bounded tracking the top keys
+    if (values.agent or values.collect is not None) and \
+            values.top_keys is None:
+        error = 'Agents and collectors must track the most used keys with \
+--top-keys.'
+
+    # Make sure a replay file can be read
+    if values.replay and not os.path.isfile(values.replay):
+        error = 'Could not find the replay file %s.' % values.replay
+
+    if values.max_speed and not values.replay:
+        error = 'Max speed can only be used when replaying a tcpdump file.'
+
+    # Expand the port list and check the server addresses
+    try:
+        values.port = _parse_ports(values.port)
+    except ValueError:
+        error = 'Invalid port list: %s' % values.port
+
+    if values.servers:
+        values.servers = values.servers.split(',')
+        for server in values.servers:
+            try:
+                memcache.parse_address(server)
+            except ValueError:
+                error = 'Invalid server address: %s' % server
+
+    # Compile the key namespace rules
+    if values.namespaces:
+        collapse = [kind for kind in values.namespace_collapse.split(',')
+                    if kind]
+        try:
+            values.namespaces = namespace.Normalizer(
+                values.namespace_delimiters, collapse,
+                values.namespace_pattern)
+        except ValueError as exception:
+            error = 'Invalid key namespace rules: %s' % exception
+    else:
+        values.namespaces = None
+
+    # Turn the sampling rate into the sampling factor
+    try:
+        values.sample = sampling.parse_rate(values.sample)
+    except ValueError as exception:
+        error = 'Invalid sampling rate: %s' % exception
+
+    # Make sure the batching values are usable
+    if values.batch_size < 1:
+        error = 'The batch size must be at least 1.'
+
+    if values.flush_interval <= 0:
+        error = 'The flush interval must be greater than 0.'
+
+    if values.workers < 1:
+        error = 'The number of workers must be at least 1.'
+
+    # Make sure the queue can hold something and the policy can be applied
+    if values.queue_size < 1:
+        error = 'The queue size must be at least 1.'
+
+    if values.workers > 1 and values.overload == pipeline.DROP_OLDEST:
+        error = 'The drop-oldest overload policy can not be used with more \
+than one worker.'
+
+    # Make sure memcached could be started with the slab settings
+    if values.slab_factor <= 1:
+        error = 'The slab growth factor must be greater than 1.'
+
+    if values.slab_chunk_size < 1:
+        error = 'The slab chunk size must be at least 1.'
+
+    if not 1024 <= values.slab_page_size <= 1 << 30 or \
+            values.slab_page_size % 1024:
+        error = 'The slab page size must be a multiple of 1024 up to 1GB.'
+
+    # The reuse distances of the miss ratio curve need every use of a key
+    if values.mrc and (values.workers > 1 or values.sample > 1 or
+                       values.agent or values.collect is not None):
+        error = 'The miss ratio curve needs every request in one decoder, \
+it can not be used with more than one worker, sampling, agents or \
+collectors.'
+
+    if not 0 < values.mrc_rate <= 1:
+        error = 'The miss ratio curve sampling rate must be between 0 and 1.'
+
+    if values.mrc_keys < 1:
+        error = 'The miss ratio curve must follow at least 1 key.'
+
+    if values.mrc_memory is not None and values.mrc_memory < 1:
+        error = 'The cache memory must be at least 1 megabyte.'
+
+    # Make sure the key tracking bounds are usable
+    if values.top_keys is not None and values.top_keys < 1:
+        error = 'The number of top keys must be at least 1.'
+
+    if not 0 < values.key_error < 1:
+        error = 'The key error must be between 0 and 1.'
+
+    # Load the checkpoint to resume from, unless this is the first run,
+    # once the options the state depends on are parsed to compare
+    if values.resume:
+        if not values.checkpoint:
+            error = 'You must specify a checkpoint file to resume from.'
+        elif os.path.exists(values.checkpoint):
+            try:
+                settings, values.resume = checkpoint.read(values.checkpoint)
+            except (IOError, ValueError) as exception:
+                error = 'Can not resume: %s' % exception
+            else:
+                mismatched = checkpoint.mismatched(settings, values)
+                if mismatched:
+                    error = 'Can not resume from a checkpoint gathered with \
+different %s.' % ', '.join(mismatched)
+
+                # The connections of the earlier run are gone
+                values.resume['flows']['active'] = 0
+        else:
+            values.resume = None
+    else:
+        values.resume = None
+
     if error:
         parser.error(error)
 
@@ -85,11 +285,117 @@ def _options():
                             Default: eth0')
 
     parser.add_option('--port', '-p',
-                      default=11211,
-                      type="int",
-                      help='Specify the port memcached is running on\n\
+                      default='11211',
+                      help='Specify the port memcached is running on, or a\
+                            comma separated list of ports and port ranges\
+                            such as 11211,11213-11215\n\
                             Default: 11211')
 
+    parser.add_option('--servers', '-s',
+                      help='Comma separated list of memcached server\
+                            addresses to limit decoding to\n\
+                            Default: any address')
+
+    parser.add_option('--responses', '-R',
+                      action='store_true',
+                      default=False,
+                      help='Also decode server responses to report value\
+                            sizes and hit ratios')
+
+    parser.add_option('--top-keys', '-k',
+                      type='int',
+                      help='Only track the given number of most used keys,\
+                            in fixed memory, instead of every key\n\
+                            Default: every key, or %i when streaming \
+                            records' % output.TOP_KEYS)
+
+    parser.add_option('--key-error',
+                      default=0.001,
+                      type='float',
+                      help='Bound on the overcount of a top key as a share\
+                            of all key uses, sizing the key tracking memory\n\
+                            Default: 0.001')
+
+    parser.add_option('--distinct', '-D',
+                      action='store_true',
+                      default=False,
+                      help='Estimate the number of distinct keys used by\
+                            each command and in each key namespace')
+
+    parser.add_option('--slabs',
+                      action='store_true',
+                      default=False,
+                      help='Simulate the slab classes of the items stored\
+                            and sweep for the best growth factor')
+
+    parser.add_option('--slab-factor',
+                      default=slabs.FACTOR,
+                      type='float',
+                      help='Growth factor of the slab classes, -f\n\
+                            Default: %.2f' % slabs.FACTOR)
+
+    parser.add_option('--slab-chunk-size',
+                      default=slabs.CHUNK_SIZE,
+                      type='int',
+                      help='Minimum chunk size of the slab classes, -n\n\
+                            Default: %i' % slabs.CHUNK_SIZE)
+
+    parser.add_option('--slab-page-size',
+                      default=slabs.PAGE_SIZE,
+                      type='int',
+                      help='Slab page size in bytes, -I\n\
+                            Default: %i' % slabs.PAGE_SIZE)
+
+    parser.add_option('--mrc',
+                      action='store_true',
+                      default=False,
+                      help='Estimate the miss ratio of an LRU cache of each\
+                            size from the keys read and stored')
+
+    parser.add_option('--mrc-rate',
+                      default=mrc.RATE,
+                      type='float',
+                      help='Share of keys followed for the miss ratio\
+                            curve, lowered to stay within --mrc-keys\n\
+                            Default: %.2f' % mrc.RATE)
+
+    parser.add_option('--mrc-keys',
+                      default=mrc.MAX_KEYS,
+                      type='int',
+                      help='Most keys followed at once for the miss ratio\
+                            curve\n\
+                            Default: %i' % mrc.MAX_KEYS)
+
+    parser.add_option('--mrc-memory',
+                      type='int',
+                      help='Memory of the cache in megabytes, -m, to report\
+                            the miss ratio at 0.5, 1, 2 and 4 times')
+
+    parser.add_option('--namespaces', '-N',
+                      action='store_true',
+                      default=False,
+                      help='Add up requests, responses and latencies for\
+                            each key namespace')
+
+    parser.add_option('--namespace-delimiters',
+                      default=namespace.DELIMITERS,
+                      help='Characters that separate the segments of a key\n\
+                            Default: %s' % namespace.DELIMITERS)
+
+    parser.add_option('--namespace-collapse',
+                      default=','.join(namespace.COLLAPSE),
+                      help='Kinds of key segment replaced with * in a\
+                            namespace, from %s\n\
+                            Default: %s' % (', '.join(namespace.COLLAPSE),
+                                            ','.join(namespace.COLLAPSE)))
+
+    parser.add_option('--namespace-pattern',
+                      action='append',
+                      help='A namespace pattern matched before collapsing,\
+                            with * for any one segment and a trailing ** for\
+                            the rest, such as user:*:profile. Can be given\
+                            more than once')
+
     parser.add_option('--interactive', '-i',
                       action='store_true',
                       default=False,
@@ -103,16 +409,24 @@ def _options():
     parser.add_option('--timeout', '-t',
                       default=60,
                       type='int',
-                      help='Duration in seconds to listen in gather mode\n\
+                      help='Duration in seconds to listen in gather mode,\
+                            0 to listen until interrupted\n\
                             Default: 60')
 
+    parser.add_option('--interval',
+                      default=10.0,
+                      type='float',
+                      help='Seconds between the records written in gather\
+                            mode with csv, jsonl or binary output\n\
+                            Default: 10.0')
+
     parser.add_option('--output', '-o',
                       default='formatted',
                       type='choice',
                       choices=OUTPUT_FORMATS,
                       help='Output format for gather mode\n\
                             Default: formatted\n\
-                            values: formatted, csv, xsl')
+                            values: formatted, csv, jsonl, binary')
 
     parser.add_option('--file', '-f',
                       help='File to write output to when using gather mode')
@@ -122,11 +436,122 @@ def _options():
                             network device. Note that the -d and -t values\
                             are ignored when replying a tcpdump file.')
 
+    parser.add_option('--max-speed', '-m',
+                      action='store_true',
+                      default=False,
+                      help='Replay the tcpdump file as fast as possible\
+                            instead of at the pace it was captured')
+
     parser.add_option('--window', '-w',
                       action='store_true',
                       default=False,
                       help='Use wx instead of curses for interactive mode')
 
+    parser.add_option('--refresh',
+                      default=1.0,
+                      type='float',
+                      help='Seconds between screen refreshes in interactive\
+                            mode\n\
+                            Default: 1.0')
+
+    parser.add_option('--metrics-port',
+                      type='int',
+                      help='Serve Prometheus metrics over HTTP on this\
+                            port, such as %i' % exporter.PORT)
+
+    parser.add_option('--metrics-address',
+                      default=exporter.ADDRESS,
+                      help='Address the Prometheus metrics are served on\n\
+                            Default: %s' % exporter.ADDRESS)
+
+    parser.add_option('--metrics-interval',
+                      default=exporter.INTERVAL,
+                      type='float',
+                      help='Seconds between renders of the Prometheus metrics,\
+                            scrapes are answered with the last one\n\
+                            Default: %.1f' % exporter.INTERVAL)
+
+    parser.add_option('--agent',
+                      help='Send deltas of the statistics to the collector\
+                            at HOST:PORT instead of reporting them')
+
+    parser.add_option('--agent-name',
+                      help='Name the collector knows the agent by\n\
+                            Default: the host name')
+
+    parser.add_option('--agent-interval',
+                      default=collector.INTERVAL,
+                      type='float',
+                      help='Seconds between the deltas an agent sends\n\
+                            Default: %.1f' % collector.INTERVAL)
+
+    parser.add_option('--collect',
+                      type='int',
+                      help='Merge the deltas agents send to PORT into fleet\
+                            wide statistics instead of capturing')
+
+    parser.add_option('--collect-address',
+                      default=collector.ADDRESS,
+                      help='Address the collector listens on\n\
+                            Default: %s' % collector.ADDRESS)
+
+    parser.add_option('--checkpoint',
+                      help='File the aggregated state is checkpointed to\
+                            periodically and on exit')
+
+    parser.add_option('--checkpoint-interval',
+                      default=checkpoint.INTERVAL,
+                      type='float',
+                      help='Seconds between checkpoints\n\
+                            Default: %.1f' % checkpoint.INTERVAL)
+
+    parser.add_option('--resume',
+                      action='store_true',
+                      default=False,
+                      help='Carry on from the checkpoint file, if there is\
+                            one')
+
+    parser.add_option('--batch-size', '-b',
+                      default=128,
+                      type='int',
+                      help='Maximum packets read per dispatch and payloads\
+                            handed to the decoder at once\n\
+                            Default: 128')
+
+    parser.add_option('--flush-interval',
+                      default=0.05,
+                      type='float',
+                      help='Maximum seconds a partial batch of payloads\
+                            waits before it is handed to the decoder\n\
+                            Default: 0.05')
+
+    parser.add_option('--workers', '-W',
+                      default=1,
+                      type='int',
+                      help='Number of processes to decode in, with each\
+                            connection always decoded by the same one\n\
+                            Default: 1')
+
+    parser.add_option('--queue-size',
+                      default=pipeline.QUEUE_SIZE,
+                      type='int',
+                      help='Maximum batches waiting for the decoder thread\n\
+                            Default: %i' % pipeline.QUEUE_SIZE)
+
+    parser.add_option('--overload',
+                      default=pipeline.BLOCK,
+                      type='choice',
+                      choices=pipeline.POLICIES,
+                      help='What to do when decoding falls behind: block\
+                            the capture, drop-newest or drop-oldest\n\
+                            Default: %s' % pipeline.BLOCK)
+
+    parser.add_option('--sample', '-S',
+                      default='1/1',
+                      help='Decode 1/N of the connections to the memcached\
+                            servers, scaling the counts up by N\n\
+                            Default: 1/1')
+
     parser.add_option('--verbose', '-v',
                       default=False,
                       action='store_true',
@@ -140,8 +565,11 @@ def main():
     # Get the options
     options, args = _options()
 
+    # Keep log messages from drawing over the interactive screen
     if options.verbose:
         logging.basicConfig(level=logging.DEBUG)
+    elif options.interactive:
+        logging.basicConfig(level=logging.WARNING)
     else:
         logging.basicConfig(level=logging.INFO)
 
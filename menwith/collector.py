@@ -0,0 +1,746 @@
+"""
+Agents that send deltas of their statistics to a collector
+
+An agent decodes the traffic of one host and, every interval, drains its
+decoders of what they gathered since the last interval and sends that
+delta to the collector, which merges the deltas of every agent into fleet
+wide statistics that are shown and reported as a decoder's would be.
+
+Each delta is pickled with the highest binary protocol and compressed with
+zlib on its own, and sent in frames over TCP, each a header naming the
+format and its version and the length of the body, a pickled batch of
+compressed deltas. The deltas the collector has not yet acknowledged are
+sent again, so deltas are batched while the collector can not be reached,
+up to a limit after which the oldest are dropped, and split between as
+many frames as it takes to keep each under the size a collector accepts.
+Each delta is numbered, and the collector acknowledges a frame with the
+number of the next delta it expects from the agent, so a delta sent again
+after a lost acknowledgement is only merged once. The agent sends from a
+thread of its own, so waiting on the collector never holds up decoding.
+
+The collector bounds what each agent costs it. A frame may only be so
+large, compressed and not, the deltas may only be made of the classes the
+statistics are made of, and an agent is only known by its name, session
+and the last delta merged. Every delta of a frame is checked to have each
+statistic a decoder merges, of the type it merges, before any is merged, so
+the fleet wide statistics are never left half merged by an agent sending
+something else. The fleet wide statistics are kept in one
+decoder, tracking only the most used keys, so they do not grow with the
+number of agents or the time they have been sending.
+
+"""
+import cPickle
+import cStringIO
+import logging
+import os
+import Queue
+import socket
+import SocketServer
+import struct
+import threading
+import time
+import zlib
+
+from . import histogram
+from . import memcache
+from . import sampling
+from . import sketch
+from . import slabs
+from . import window
+
+# The default address and port a collector listens on, and seconds
+# between the deltas an agent sends
+ADDRESS = '0.0.0.0'
+PORT = 9437
+INTERVAL = 5.0
+
+# The frame header, the format magic and version and the body length
+MAGIC = 'MNWD'
+VERSION = 3
+_FRAME = struct.Struct('!4sHI')
+
+# The acknowledgement of a frame, the number of the next delta expected
+_ACK = struct.Struct('!Q')
+
+# The largest frame body a collector accepts, and its deltas decompressed
+MAX_FRAME = 16 << 20
+MAX_BODY = 64 << 20
+
+# Room left in a frame body for what is sent along with the deltas
+_FRAME_OVERHEAD = 4096
+
+# The most deltas an agent keeps while the collector can not be reached
+MAX_PENDING = 120
+
+# Seconds an agent waits to connect to or hear from the collector
+_TIMEOUT = 10.0
+
+# The only classes the statistics in a delta are made of
+_CLASSES = dict([((cls.__module__, cls.__name__), cls) for cls in
+                 [bytearray, set, frozenset, histogram.Histogram,
+                  sketch.HyperLogLog, sketch.SpaceSaving,
+                  slabs.SizeHistogram, window.RollingWindow]])
+
+# The types of the counts and times in a delta
+_NUMBERS = (int, long)
+_TIMES = (int, long, float)
+
+# The stats of each key, namespace and server in a delta
+_KEY_STATS = 3
+_NAMESPACE_STATS = 5
+_SERVER_STATS = ['keys', 'hits', 'misses', 'value_bytes']
+_HISTOGRAM_BUCKETS = len(histogram.Histogram().buckets)
+
+
+def _find_class(module, name):
+    """Return one of the classes a delta may be made of, refusing any
+    other, so unpickling a delta can not run anything.
+
+    :param str module: The module of the class
+    :param str name: The name of the class
+    :returns: type
+    :raises: cPickle.UnpicklingError
+
+    """
+    try:
+        return _CLASSES[(module, name)]
+    except KeyError:
+        raise cPickle.UnpicklingError('%s.%s is not allowed in a delta' %
+                                      (module, name))
+
+
+def _refuse_class(module, name):
+    """Refuse any class in a frame, which is only plain values.
+
+    :param str module: The module of the class
+    :param str name: The name of the class
+    :raises: cPickle.UnpicklingError
+
+    """
+    raise cPickle.UnpicklingError('%s.%s is not allowed in a frame' %
+                                  (module, name))
+
+
+def _unpickle(data, find_class):
+    """Return the value pickled in data, only allowing the classes found.
+
+    :param str data: The pickled value
+    :param callable find_class: Returns a class allowed, or raises
+    :returns: object
+    :raises: ValueError
+
+    """
+    unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+    unpickler.find_global = find_class
+    try:
+        return unpickler.load()
+    except Exception as error:
+        raise ValueError('Could not unpickle the frame: %s' % error)
+
+
+def _receive(connection, size):
+    """Return exactly size bytes read from the connection.
+
+    :param socket.socket connection: The connection to read from
+    :param int size: The number of bytes to read
+    :returns: str
+    :raises: EOFError
+
+    """
+    parts = list()
+    while size:
+        data = connection.recv(min(size, 65536))
+        if not data:
+            raise EOFError('Connection closed')
+        parts.append(data)
+        size -= len(data)
+    return ''.join(parts)
+
+
+def compress(delta):
+    """Return a delta pickled and compressed, as it is sent in a frame, and
+    the length of it pickled.
+
+    :param dict delta: The statistics gathered since the last delta
+    :returns: tuple
+
+    """
+    data = cPickle.dumps(delta, cPickle.HIGHEST_PROTOCOL)
+    return zlib.compress(data), len(data)
+
+
+def encode(message):
+    """Return the frame of a message, its deltas already compressed.
+
+    :param dict message: The message
+    :returns: str
+
+    """
+    body = cPickle.dumps(message, cPickle.HIGHEST_PROTOCOL)
+    return _FRAME.pack(MAGIC, VERSION, len(body)) + body
+
+
+def decode(body):
+    """Return the message in a frame body, with its deltas decompressed.
+
+    :param str body: The frame body
+    :returns: dict
+    :raises: ValueError
+
+    """
+    message = _unpickle(body, _refuse_class)
+    if not isinstance(message, dict) or \
+            set(message) != set(['agent', 'session', 'sample', 'sequence',
+                                 'deltas']) or \
+            not isinstance(message['agent'], str) or \
+            not isinstance(message['session'], str) or \
+            not isinstance(message['sample'], _NUMBERS) or \
+            not isinstance(message['sequence'], _NUMBERS) or \
+            not isinstance(message['deltas'], list):
+        raise ValueError('The frame is not a batch of deltas')
+    deltas = list()
+    remaining = MAX_BODY
+    for compressed in message['deltas']:
+        if not isinstance(compressed, str):
+            raise ValueError('The frame is not a batch of deltas')
+        decompressor = zlib.decompressobj()
+        try:
+            data = decompressor.decompress(compressed, remaining)
+        except zlib.error as error:
+            raise ValueError('Could not decompress the frame: %s' % error)
+        if decompressor.unconsumed_tail:
+            raise ValueError('The frame is over %i bytes decompressed' %
+                             MAX_BODY)
+        remaining -= len(data)
+        delta = _unpickle(data, _find_class)
+        if not isinstance(delta, dict):
+            raise ValueError('The frame is not a batch of deltas')
+        deltas.append(delta)
+    message['deltas'] = deltas
+    return message
+
+
+def _counts(value, names=None):
+    """Return if a value is a dict of counts, of only the names given.
+
+    :param mixed value: The value to check
+    :param set names: The names that may be counted, any if not set
+    :returns: bool
+
+    """
+    return isinstance(value, dict) and \
+        (names is None or names.issuperset(value)) and \
+        all([isinstance(count, _NUMBERS) for count in value.itervalues()])
+
+
+def _histogram(value):
+    """Return if a value is a latency or value size histogram.
+
+    :param mixed value: The value to check
+    :returns: bool
+
+    """
+    return isinstance(value, histogram.Histogram) and \
+        isinstance(getattr(value, 'buckets', None), list) and \
+        len(value.buckets) == _HISTOGRAM_BUCKETS and \
+        all([isinstance(count, _NUMBERS) for count in value.buckets]) and \
+        all([isinstance(getattr(value, name, None), _NUMBERS)
+             for name in ['count', 'total', 'maximum']])
+
+
+def _distinct(value):
+    """Return if a value is a distinct key estimate.
+
+    :param mixed value: The value to check
+    :returns: bool
+
+    """
+    return isinstance(value, sketch.HyperLogLog) and \
+        getattr(value, 'precision', None) == sketch.PRECISION and \
+        isinstance(getattr(value, 'registers', None), bytearray) and \
+        len(value.registers) == 1 << sketch.PRECISION
+
+
+def _top_keys(value):
+    """Return if a value is a summary of the most used keys.
+
+    :param mixed value: The value to check
+    :returns: bool
+
+    """
+    return isinstance(value, sketch.SpaceSaving) and \
+        _counts(getattr(value, '_counts', None)) and \
+        _counts(getattr(value, '_errors', None)) and \
+        set(value._counts) == set(value._errors) and \
+        all([isinstance(getattr(value, name, None), _NUMBERS)
+             for name in ['capacity', 'total', '_minimum']])
+
+
+def _item_sizes(value):
+    """Return if a value is a histogram of the sizes of the items stored.
+
+    :param mixed value: The value to check
+    :returns: bool
+
+    """
+    return isinstance(value, slabs.SizeHistogram) and \
+        _counts(getattr(value, 'counts', None)) and \
+        _counts(getattr(value, 'bytes', None)) and \
+        set(value.counts) == set(value.bytes)
+
+
+def _window(value, template):
+    """Return if a value is a rolling window of the same intervals and
+    names as the template, counting only those names.
+
+    :param mixed value: The value to check
+    :param window.RollingWindow template: A window of the collector
+    :returns: bool
+
+    """
+    names = set(template.current)
+    return isinstance(value, window.RollingWindow) and \
+        getattr(value, 'width', None) == template.width and \
+        getattr(value, 'windows', None) == template.windows and \
+        isinstance(getattr(value, '_buckets', None), list) and \
+        len(value._buckets) == len(template._buckets) and \
+        all([_counts(bucket, names) for bucket in value._buckets]) and \
+        isinstance(getattr(value, '_interval', None), (_NUMBERS,
+                                                         type(None))) and \
+        isinstance(getattr(value, '_completed', None), _NUMBERS)
+
+
+def check(delta, template):
+    """Check a delta has every statistic a decoder state has, each of the
+    type the decoder merges, so merging it can not fail partway through.
+
+    :param dict delta: The delta sent by an agent
+    :param dict template: The state of an empty decoder of the collector
+    :raises: ValueError
+
+    """
+    if set(delta) != set(template):
+        raise ValueError('The delta is not of the statistics collected')
+    if isinstance(delta['keys'], dict):
+        raise ValueError('The agent is not tracking the most used keys')
+    commands = set(template['counts'])
+    invalid = [name for name, valid in [
+        ('counts', _counts(delta['counts'])),
+        ('hits', _counts(delta['hits'])),
+        ('misses', _counts(delta['misses'])),
+        ('value_bytes', _counts(delta['value_bytes'])),
+        ('keys', _top_keys(delta['keys'])),
+        ('key_responses', isinstance(delta['key_responses'], dict) and all([
+            isinstance(stats, list) and len(stats) == _KEY_STATS and
+            all([isinstance(count, _NUMBERS) for count in stats])
+            for stats in delta['key_responses'].itervalues()])),
+        ('command_latency', isinstance(delta['command_latency'], dict) and
+         all(map(_histogram, delta['command_latency'].itervalues()))),
+        ('port_latency', isinstance(delta['port_latency'], dict) and
+         all(map(_histogram, delta['port_latency'].itervalues()))),
+        ('value_sizes', isinstance(delta['value_sizes'], dict) and
+         all(map(_histogram, delta['value_sizes'].itervalues()))),
+        ('command_distinct', isinstance(delta['command_distinct'], dict) and
+         all(map(_distinct, delta['command_distinct'].itervalues()))),
+        ('namespace_distinct', isinstance(delta['namespace_distinct'],
+                                          dict) and
+         all(map(_distinct, delta['namespace_distinct'].itervalues()))),
+        ('namespaces', isinstance(delta['namespaces'], dict) and all([
+            isinstance(stats, list) and len(stats) == _NAMESPACE_STATS and
+            all([isinstance(count, _NUMBERS) for count in stats[:-1]]) and
+            _histogram(stats[-1])
+            for stats in delta['namespaces'].itervalues()])),
+        ('endpoints', isinstance(delta['endpoints'], dict) and all([
+            isinstance(endpoint, tuple) and len(endpoint) == 2 and
+            all([isinstance(value, _NUMBERS) for value in endpoint]) and
+            isinstance(stats, dict) and
+            set(stats) == set(['counts'] + _SERVER_STATS) and
+            _counts(stats['counts'], commands) and
+            all([isinstance(stats[name], _NUMBERS)
+                 for name in _SERVER_STATS])
+            for endpoint, stats in delta['endpoints'].iteritems()])),
+        ('flows', _counts(delta['flows']) and
+         set(delta['flows']) == set(template['flows'])),
+        ('sample_groups', isinstance(delta['sample_groups'], list) and
+         len(delta['sample_groups']) == sampling.GROUPS and
+         all([isinstance(count, _NUMBERS)
+              for count in delta['sample_groups']])),
+        ('item_sizes', _item_sizes(delta['item_sizes'])),
+        ('mrc', delta['mrc'] is None),
+        ('started', isinstance(delta['started'], (_TIMES, type(None)))),
+        ('windows', isinstance(delta['windows'], dict) and
+         set(delta['windows']) == set(template['windows']) and
+         all([_window(delta['windows'][name], template['windows'][name])
+              for name in template['windows']])),
+        ('snapshot', isinstance(delta['snapshot'], dict) and
+         'timestamp' in delta['snapshot'] and
+         isinstance(delta['snapshot']['timestamp'],
+                    (_TIMES, type(None))))] if not valid]
+    if invalid:
+        raise ValueError('The delta has invalid %s' % ', '.join(invalid))
+
+
+class Agent(threading.Thread):
+    """Thread that sends the deltas of the statistics to a collector every
+    interval, keeping those not yet acknowledged to send again with the
+    next.
+
+    """
+    def __init__(self, address, name, sample, interval=INTERVAL):
+        """Create a new Agent sending to the collector at the address.
+
+        :param tuple address: The host and port of the collector
+        :param str name: The name the collector knows the agent by
+        :param int sample: The sampling factor the traffic is sampled by
+        :param float interval: The seconds between deltas
+
+        """
+        super(Agent, self).__init__(name='agent')
+        self.daemon = True
+        self._logger = logging.getLogger('menwith.collector.Agent')
+        self.address = address
+        self.name = name
+        self.sample = sample
+        self.interval = interval
+        self.deadline = time.time() + interval
+        self.sent = 0
+        self.dropped = 0
+        self.frames = 0
+        self.bytes = 0
+        self._session = os.urandom(8).encode('hex')
+        self._sequence = 0
+        self._pending = list()
+        self._deltas = Queue.Queue()
+        self._connection = None
+
+    def _add(self, delta):
+        """Compress a delta and keep it to send, dropping the oldest if too
+        many are waiting, or the delta itself if it could never be sent.
+
+        :param dict delta: The statistics gathered since the last delta
+
+        """
+        compressed, length = compress(delta)
+        if len(compressed) > MAX_FRAME - _FRAME_OVERHEAD or \
+                length > MAX_BODY:
+            self.dropped += 1
+            self._logger.error('Dropped a delta of %i bytes, %i compressed, '
+                               'too large for a frame', length,
+                               len(compressed))
+            return
+        self._pending.append((compressed, length))
+        if len(self._pending) > MAX_PENDING:
+            del self._pending[0]
+            self._sequence += 1
+            self.dropped += 1
+            self._logger.warning('Dropped a delta the collector did not '
+                                 'acknowledge in time')
+
+    def _close(self):
+        """Close the connection to the collector, if open."""
+        if self._connection:
+            self._connection.close()
+            self._connection = None
+
+    def _flush(self):
+        """Send the deltas not yet acknowledged, as many to a frame as fit,
+        forgetting those the collector has merged, and return if they were
+        all merged.
+
+        :returns: bool
+
+        """
+        while self._pending:
+            count = size = length = 0
+            for compressed, pickled in self._pending:
+                size += len(compressed)
+                length += pickled
+                if count and (size > MAX_FRAME - _FRAME_OVERHEAD or
+                              length > MAX_BODY):
+                    break
+                count += 1
+            frame = encode({'agent': self.name,
+                            'session': self._session,
+                            'sample': self.sample,
+                            'sequence': self._sequence,
+                            'deltas': [compressed for compressed, pickled in
+                                       self._pending[:count]]})
+            try:
+                if not self._connection:
+                    self._connection = socket.create_connection(
+                        self.address, _TIMEOUT)
+                self._connection.sendall(frame)
+                expected = _ACK.unpack(_receive(self._connection,
+                                                _ACK.size))[0]
+            except (EOFError, socket.error) as error:
+                self._close()
+                self._logger.warning('Could not send %i deltas to the '
+                                     'collector at %s:%i: %s',
+                                     len(self._pending), self.address[0],
+                                     self.address[1], error)
+                return False
+            merged = max(0, min(expected - self._sequence, count))
+            del self._pending[:merged]
+            self._sequence += merged
+            self.sent += merged
+            self.frames += 1
+            self.bytes += len(frame)
+            if merged < count:
+                return False
+        return True
+
+    def due(self):
+        """Return if the next delta is due.
+
+        :returns: bool
+
+        """
+        return time.time() >= self.deadline
+
+    def run(self):
+        while True:
+            deltas = [self._deltas.get()]
+            while True:
+                try:
+                    deltas.append(self._deltas.get_nowait())
+                except Queue.Empty:
+                    break
+            for delta in deltas:
+                if delta is not None:
+                    self._add(delta)
+            self._flush()
+            if None in deltas:
+                break
+
+    def send(self, delta):
+        """Hand a delta to the thread to send with any not yet acknowledged.
+
+        :param dict delta: The statistics gathered since the last delta,
+            not used again by the caller
+
+        """
+        self.deadline = time.time() + self.interval
+        self._deltas.put(delta)
+
+    def finish(self, delta):
+        """Send the last delta, wait for the thread to send what it can and
+        close the connection to the collector.
+
+        :param dict delta: The statistics gathered since the last delta
+
+        """
+        self._deltas.put(delta)
+        self._deltas.put(None)
+        self.join()
+        if self._pending:
+            self._logger.error('The collector did not acknowledge the last '
+                               '%i deltas', len(self._pending))
+        self._close()
+        self._logger.info('Sent %i deltas in %i frames of %i bytes, '
+                          'dropped %i', self.sent, self.frames, self.bytes,
+                          self.dropped)
+
+
+class _Handler(SocketServer.BaseRequestHandler):
+    """Merges each frame an agent sends and acknowledges it"""
+
+    def handle(self):
+        collector = self.server.collector
+        peer = '%s:%i' % self.client_address[:2]
+        try:
+            while True:
+                try:
+                    header = _receive(self.request, _FRAME.size)
+                except EOFError:
+                    return
+                magic, version, length = _FRAME.unpack(header)
+                if magic != MAGIC or version != VERSION:
+                    raise ValueError('Not a version %i menwith agent' %
+                                     VERSION)
+                if length > MAX_FRAME:
+                    raise ValueError('The frame is over %i bytes' %
+                                     MAX_FRAME)
+                message = decode(_receive(self.request, length))
+                expected = collector.merge(message, peer)
+                self.request.sendall(_ACK.pack(expected))
+        except (EOFError, socket.error, ValueError) as error:
+            collector._logger.warning('Dropped the agent at %s: %s', peer,
+                                      error)
+
+
+class _Server(SocketServer.ThreadingTCPServer):
+    """Serves each agent connection in a thread of its own"""
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class Collector(object):
+    """Merges the deltas the agents send into fleet wide statistics,
+    standing in for the Decode thread in the manager.
+
+    """
+    def __init__(self, options):
+        """Create a new Collector, listening on options.collect_address
+        and options.collect.
+
+        :param optparse.Values options: The command line options
+        :raises: socket.error
+
+        """
+        self._logger = logging.getLogger('menwith.collector.Collector')
+        self.options = options
+        self._lock = threading.Lock()
+        self._agents = dict()
+        self._decoder = memcache.Decoder(None, options.port, options.responses,
+                                         options.top_keys, options.key_error,
+                                         options.distinct, options.servers,
+                                         options.namespaces, options.sample,
+                                         options.slabs)
+        self._template = memcache.Decoder(None).state()
+
+        # Carry on from the checkpoint of an earlier run
+        if options.resume:
+            self._decoder.merge(options.resume)
+        self._server = _Server((options.collect_address, options.collect),
+                               _Handler)
+        self._server.collector = self
+        self.address = self._server.server_address
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='collector')
+        self._thread.daemon = True
+
+    def agents(self):
+        """Return the address, session, deltas merged and lost, and the
+        connections being reassembled of each agent, by name.
+
+        :returns: dict
+
+        """
+        with self._lock:
+            return dict([(name, dict(agent))
+                         for name, agent in self._agents.iteritems()])
+
+    def checkpoint(self, checkpointer):
+        """Write a checkpoint of the fleet wide statistics from a child
+        forked while no agent is being merged, so it has a copy of them as
+        they were without pickling them here.
+
+        :param checkpoint.Checkpointer checkpointer: The checkpoint writer
+
+        """
+        with self._lock:
+            checkpointer.checkpoint(self._decoder.state())
+
+    def is_alive(self):
+        """Return if the collector is listening.
+
+        :returns: bool
+
+        """
+        return self._thread.is_alive()
+
+    def join(self):
+        """Wait for the collector to stop listening."""
+        self._thread.join()
+
+    def merge(self, message, peer):
+        """Merge the deltas of a frame not merged before and return the
+        number of the next delta expected from the agent.
+
+        :param dict message: The frame sent by the agent
+        :param str peer: The address and port of the agent
+        :returns: int
+        :raises: ValueError
+
+        """
+        if message['sample'] != self.options.sample:
+            raise ValueError('The agent samples 1/%i of the connections, '
+                             'the collector 1/%i' % (message['sample'],
+                                                     self.options.sample))
+        for delta in message['deltas']:
+            check(delta, self._template)
+        with self._lock:
+            agent = self._agents.get(message['agent'])
+            if not agent or agent['session'] != message['session']:
+                agent = self._agents[message['agent']] = {
+                    'address': peer,
+                    'session': message['session'],
+                    'sequence': message['sequence'],
+                    'merged': 0,
+                    'lost': 0,
+                    'active': 0}
+            agent['address'] = peer
+
+            # Deltas dropped by the agent are lost, those merged are skipped
+            if message['sequence'] > agent['sequence']:
+                agent['lost'] += message['sequence'] - agent['sequence']
+                agent['sequence'] = message['sequence']
+            timestamp = None
+            for delta in message['deltas'][agent['sequence'] -
+                                           message['sequence']:]:
+
+                # The connections being reassembled are a level, not a sum
+                agent['active'] = delta['flows']['active']
+                delta['flows']['active'] = 0
+
+                # The snapshot is published again from the merged statistics
+                # rather than added up, leaving those already read alone
+                timestamp = max(timestamp, delta['snapshot']['timestamp'])
+                delta['snapshot'] = {'timestamp': None}
+                self._decoder.merge(delta)
+                agent['sequence'] += 1
+                agent['merged'] += 1
+            if timestamp is not None:
+                self._decoder.advance(timestamp)
+            return agent['sequence']
+
+    def snapshot(self):
+        """Return the latest snapshot of the fleet wide statistics.
+
+        :returns: dict
+
+        """
+        with self._lock:
+            return self._decoder.snapshot()
+
+    def start(self):
+        """Start listening for agents."""
+        self._thread.start()
+        self._logger.info('Collecting deltas on %s:%i', self.address[0],
+                          self.address[1])
+
+    def state(self):
+        """Return a copy of the fleet wide statistics, as returned by the
+        Decoder state method, so they can be pickled while agents are
+        still being merged.
+
+        :returns: dict
+
+        """
+        with self._lock:
+            return cPickle.loads(cPickle.dumps(self._decoder.state(),
+                                               cPickle.HIGHEST_PROTOCOL))
+
+    def stop_process(self):
+        """Stop listening and close the listening socket."""
+        if self._thread.is_alive():
+            self._server.shutdown()
+        self._server.server_close()
+
+    def values(self):
+        """Return the fleet wide statistics, with the connections being
+        reassembled by every agent.
+
+        :returns: tuple
+
+        """
+        with self._lock:
+            decoder = self._decoder
+            flows = decoder.flows
+            flows['active'] = sum([agent['active']
+                                   for agent in self._agents.itervalues()])
+            return (decoder.counts, decoder.distinct, decoder.keys, flows,
+                    decoder.servers, decoder.responses,
+                    decoder.key_responses, decoder.latencies,
+                    decoder.namespaces, decoder.estimates,
+                    decoder.item_sizes, decoder.miss_ratio_curve)
@@ -0,0 +1,293 @@
+"""
+Prometheus metrics endpoint
+
+Serves the command rates and totals, the most used keys, the latency and
+value size histograms and the health of the capture pipeline in the
+Prometheus text exposition format over HTTP. The exporter thread renders the
+text from the latest decoder snapshot once per interval and keeps it, while
+a second thread answers scrapes with the kept text, so scrapes, however
+frequent, never render, wait on or add work to decoding.
+
+"""
+import BaseHTTPServer
+import logging
+import threading
+
+# The default address and port to listen on, and seconds between renders
+ADDRESS = '127.0.0.1'
+PORT = 9436
+INTERVAL = 1.0
+
+# The path the metrics are served on and their content type
+_PATH = '/metrics'
+_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# The counters of each command in a snapshot and their metric names
+_TOTALS = [('counts', 'menwith_requests_total',
+            'Requests decoded by command'),
+           ('hits', 'menwith_hits_total',
+            'Responses that found the key by command'),
+           ('misses', 'menwith_misses_total',
+            'Responses that did not find the key by command'),
+           ('value_bytes', 'menwith_value_bytes_total',
+            'Bytes of values returned by command')]
+
+# The response rates in a snapshot and their metric names
+_RESPONSE_RATES = [('hits', 'menwith_hit_rate',
+                    'Hits per second over the window'),
+                   ('misses', 'menwith_miss_rate',
+                    'Misses per second over the window'),
+                   ('value_bytes', 'menwith_value_bytes_rate',
+                    'Bytes of values returned per second over the window')]
+
+# The histograms in a snapshot and their metric names
+_HISTOGRAMS = [('latency', 'menwith_latency_microseconds',
+                'Time from a request to the start of its response'),
+               ('value_size', 'menwith_value_size_bytes',
+                'Size of the values returned')]
+
+# The pipeline counters and their metric names
+_QUEUE = [('enqueued', 'menwith_queue_enqueued_total', 'counter',
+           'Payloads put on the decoder queue'),
+          ('dropped', 'menwith_queue_dropped_total', 'counter',
+           'Payloads dropped by the decoder queue'),
+          ('peak_fill', 'menwith_queue_peak_fill', 'gauge',
+           'Largest share of the decoder queue in use')]
+_CAPTURE = [('received', 'menwith_pcap_received_total',
+             'Packets received by libpcap'),
+            ('dropped', 'menwith_pcap_dropped_total',
+             'Packets dropped by the kernel'),
+            ('ifdropped', 'menwith_pcap_ifdropped_total',
+             'Packets dropped by the interface')]
+
+
+def _escape(value):
+    """Return a label value escaped for the exposition format, with bytes
+    that are not UTF-8 replaced.
+
+    :param str|int value: The label value
+    :returns: str
+
+    """
+    if not isinstance(value, basestring):
+        value = str(value)
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    return value.encode('utf-8').replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    """Return a sample value as it is written.
+
+    :param int|float value: The value
+    :returns: str
+
+    """
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class _Metrics(object):
+    """Collects the lines of the exposition, writing the help and type of
+    each metric before its first sample.
+
+    """
+    def __init__(self):
+        self.lines = list()
+        self._described = set()
+
+    def add(self, name, kind, description, value, labels=None, suffix=''):
+        """Add a sample of a metric.
+
+        :param str name: The metric name
+        :param str kind: The metric type
+        :param str description: The help text of the metric
+        :param int|float value: The sample value
+        :param list labels: The label names and values of the sample
+        :param str suffix: Appended to the name, for histogram samples
+
+        """
+        if name not in self._described:
+            self._described.add(name)
+            self.lines.append('# HELP %s %s' % (name, description))
+            self.lines.append('# TYPE %s %s' % (name, kind))
+        if labels:
+            self.lines.append('%s%s{%s} %s' % (
+                name, suffix, ','.join(['%s="%s"' % (label, _escape(text))
+                                        for label, text in labels]),
+                _number(value)))
+        else:
+            self.lines.append('%s%s %s' % (name, suffix, _number(value)))
+
+    def text(self):
+        """Return the exposition text.
+
+        :returns: str
+
+        """
+        return '\n'.join(self.lines) + '\n'
+
+
+def render(snapshot, telemetry=None):
+    """Return the exposition text of a decoder snapshot and the pipeline
+    stats.
+
+    :param dict snapshot: The decoder snapshot
+    :param dict telemetry: The queue and capture stats, if known
+    :returns: str
+
+    """
+    metrics = _Metrics()
+    if snapshot and snapshot['timestamp'] is not None:
+        metrics.add('menwith_snapshot_timestamp_seconds', 'gauge',
+                    'Packet time the statistics are up to',
+                    snapshot['timestamp'])
+
+        # The totals and rates of each command
+        for source, name, description in _TOTALS:
+            for command, value in sorted(snapshot[source].iteritems()):
+                if value:
+                    metrics.add(name, 'counter', description, value,
+                                [('command', command)])
+        for window, rates in sorted(snapshot['requests'].iteritems()):
+            for command, rate in sorted(rates.iteritems()):
+                metrics.add('menwith_request_rate', 'gauge',
+                            'Requests per second over the window by command',
+                            rate, [('command', command), ('window', window)])
+        for source, name, description in _RESPONSE_RATES:
+            for window, rates in sorted(snapshot['responses'].iteritems()):
+                if source in rates:
+                    metrics.add(name, 'gauge', description, rates[source],
+                                [('window', window)])
+
+        # The most used keys, most used first
+        for key, count in snapshot['keys']:
+            metrics.add('menwith_top_key_requests', 'gauge',
+                        'Requests using each of the most used keys', count,
+                        [('key', key)])
+
+        # The latency and value size histograms of each command
+        for source, name, description in _HISTOGRAMS:
+            for command, values in sorted(
+                    snapshot['histograms'][source].iteritems()):
+                labels = [('command', command)]
+                for bound, count in values['buckets']:
+                    metrics.add(name, 'histogram', description, count,
+                                labels + [('le', bound)], '_bucket')
+                metrics.add(name, 'histogram', description, values['count'],
+                            labels + [('le', '+Inf')], '_bucket')
+                metrics.add(name, 'histogram', description, values['sum'],
+                            labels, '_sum')
+                metrics.add(name, 'histogram', description, values['count'],
+                            labels, '_count')
+
+        sample = snapshot['sample']
+        metrics.add('menwith_sample_rate', 'gauge',
+                    'One in this many connections is decoded',
+                    sample['rate'])
+        metrics.add('menwith_sample_design_effect', 'gauge',
+                    'Variance of the scaled counts over that of sampling '
+                    'requests one by one', sample['design_effect'])
+
+    # The health of the pipeline
+    if telemetry:
+        queue, capture = telemetry['queue'], telemetry['capture']
+        for source, name, kind, description in _QUEUE:
+            metrics.add(name, kind, description, queue[source])
+        for source, name, description in _CAPTURE:
+            if source in capture:
+                metrics.add(name, 'counter', description, capture[source])
+    return metrics.text()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers scrapes with the latest rendered exposition text"""
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != _PATH:
+            self.send_error(404)
+            return
+        text = self.server.exporter.exposition()
+        self.send_response(200)
+        self.send_header('Content-Type', _CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def log_message(self, format, *args):
+        self.server.exporter._logger.debug('%s %s', self.client_address[0],
+                                           format % args)
+
+
+class Exporter(threading.Thread):
+    """Thread that renders the Prometheus metrics each interval, serving
+    them from another thread.
+
+    """
+    def __init__(self, snapshot, telemetry=None, address=ADDRESS, port=PORT,
+                 interval=INTERVAL):
+        """Create a new Exporter, listening on the address and port.
+
+        :param callable snapshot: Returns the latest decoder snapshot
+        :param callable telemetry: Returns the queue and capture stats
+        :param str address: The address to listen on
+        :param int port: The port to listen on, any free port if 0
+        :param float interval: The seconds between renders
+        :raises: socket.error
+
+        """
+        super(Exporter, self).__init__(name='exporter')
+        self.daemon = True
+        self._logger = logging.getLogger('menwith.exporter.Exporter')
+        self._snapshot = snapshot
+        self._telemetry = telemetry
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._text = render(None)
+        self.renders = 0
+        self._server = BaseHTTPServer.HTTPServer((address, port), _Handler)
+        self._server.exporter = self
+        self.address = self._server.server_address
+        self._serving = threading.Thread(target=self._server.serve_forever,
+                                         name='exporter-http')
+        self._serving.daemon = True
+        self._logger.info('Serving metrics on http://%s:%i%s',
+                          self.address[0], self.address[1], _PATH)
+
+    def exposition(self):
+        """Return the exposition text last rendered.
+
+        :returns: str
+
+        """
+        return self._text
+
+    def render(self):
+        """Render the exposition text of the latest snapshot and pipeline
+        stats, replacing the text scrapes are answered with.
+
+        """
+        self._text = render(self._snapshot(),
+                            self._telemetry() if self._telemetry else None)
+        self.renders += 1
+
+    def run(self):
+        self.render()
+        self._serving.start()
+        while not self._stopped.wait(self._interval):
+            try:
+                self.render()
+            except Exception as error:
+                self._logger.exception('Error rendering metrics: %s', error)
+
+    def stop(self):
+        """Stop rendering and serving and close the listening socket."""
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+        if self._serving.is_alive():
+            self._server.shutdown()
+            self._serving.join()
+        self._server.server_close()
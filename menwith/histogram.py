@@ -0,0 +1,165 @@
+"""
+Fixed size, log bucketed histograms for latency measurements
+
+Values are whole microseconds, or whole bytes for value sizes. Each power
+of two is split into sixteen linear sub-buckets, keeping the relative error
+of a bucket under 6.25% with a fixed number of buckets, so recording a value
+is a couple of integer operations and a list increment no matter how many
+values are recorded.
+
+"""
+# The sub-buckets per power of two, as bits and as a count
+_SUB_BUCKET_BITS = 4
+_SUB_BUCKETS = 1 << _SUB_BUCKET_BITS
+_SUB_BUCKET_MASK = _SUB_BUCKETS - 1
+
+# Values are clamped to just over a minute in microseconds
+_MAXIMUM_BITS = 26
+MAXIMUM_VALUE = (1 << _MAXIMUM_BITS) - 1
+_BUCKETS = (_MAXIMUM_BITS - _SUB_BUCKET_BITS + 1) * _SUB_BUCKETS
+
+# The percentiles reported
+PERCENTILES = [('p50', 50.0), ('p90', 90.0), ('p99', 99.0), ('p999', 99.9)]
+
+
+def _bucket(value):
+    """Return the bucket index for value.
+
+    :param int value: The value in microseconds
+    :returns: int
+
+    """
+    if value < _SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - _SUB_BUCKET_BITS - 1
+    return ((shift + 1) << _SUB_BUCKET_BITS) + \
+        ((value >> shift) & _SUB_BUCKET_MASK)
+
+
+def _bucket_value(index):
+    """Return the highest value that falls in the bucket at index.
+
+    :param int index: The bucket index
+    :returns: int
+
+    """
+    if index < _SUB_BUCKETS:
+        return index
+    shift = (index >> _SUB_BUCKET_BITS) - 1
+    return ((_SUB_BUCKETS | (index & _SUB_BUCKET_MASK)) + 1 << shift) - 1
+
+
+class Histogram(object):
+    """Counts values in log buckets, reporting percentiles of them"""
+
+    def __init__(self):
+        """Create a new, empty, Histogram."""
+        self.buckets = [0] * _BUCKETS
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+
+    def cumulative(self, bounds):
+        """Return the number of recorded values at or below each of the
+        ascending bounds. A bound of one less than a power of two is the
+        edge of a bucket, so its count is exact.
+
+        :param list bounds: The ascending upper bounds
+        :returns: list
+
+        """
+        counts = list()
+        seen = 0
+        index = 0
+        for bound in bounds:
+            while index < _BUCKETS and _bucket_value(index) <= bound:
+                seen += self.buckets[index]
+                index += 1
+            counts.append(seen)
+        return counts
+
+    def merge(self, other):
+        """Add the values recorded in another histogram to this one.
+
+        :param Histogram other: The histogram to merge in
+
+        """
+        buckets = self.buckets
+        for index, count in enumerate(other.buckets):
+            if count:
+                buckets[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+
+    def pack(self):
+        """Return the recorded values as plain numbers, for sending to
+        another process without pickling: the index and count of each bucket
+        in use, the count, the total and the maximum.
+
+        :returns: tuple
+
+        """
+        return ([(index, count) for index, count in enumerate(self.buckets)
+                 if count], self.count, self.total, self.maximum)
+
+    @classmethod
+    def unpack(cls, packed):
+        """Return a histogram of the recorded values returned by pack.
+
+        :param tuple packed: The packed histogram
+        :returns: Histogram
+
+        """
+        histogram = cls()
+        buckets, histogram.count, histogram.total, histogram.maximum = packed
+        for index, count in buckets:
+            histogram.buckets[index] = count
+        return histogram
+
+    def percentile(self, percentile):
+        """Return the value below which the given percentage of the recorded
+        values fall, to within the bucket error.
+
+        :param float percentile: The percentile, 0 to 100
+        :returns: int
+
+        """
+        if not self.count:
+            return 0
+        threshold = self.count * percentile / 100.0
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= threshold:
+                return min(_bucket_value(index), self.maximum)
+        return self.maximum
+
+    def record(self, value):
+        """Record a value.
+
+        :param int value: The value in microseconds
+
+        """
+        if value > MAXIMUM_VALUE:
+            value = MAXIMUM_VALUE
+        elif value < 0:
+            value = 0
+        self.buckets[_bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.maximum:
+            self.maximum = value
+
+    def summary(self):
+        """Return the count, mean, maximum and reported percentiles.
+
+        :returns: dict
+
+        """
+        summary = {'count': self.count,
+                   'mean': float(self.total) / self.count if self.count else 0,
+                   'max': self.maximum}
+        for name, percentile in PERCENTILES:
+            summary[name] = self.percentile(percentile)
+        return summary
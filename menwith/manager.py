@@ -6,10 +6,15 @@ import signal
 import threading
 import time
 
-from Queue import Queue
-
 # Menwith modules
+import checkpoint
+import collector
+import exporter
+import output
+import pipeline
+import slabs
 import ui
+import workers
 
 threads = list()
 
@@ -19,16 +24,37 @@ class Capture(threading.Thread):
     def run(self):
         # Scope this here so we have prettier errors in initialization
         from . import network
+        from . import replay
 
-        self._tcp_capture = network.TCPCapture(self.queue,
-                                               self.options.device,
-                                               self.options.port)
+        # Replay a capture file or listen on the device
+        options = self.options
+        if options.replay:
+            self._tcp_capture = replay.ReplayCapture(self.queue,
+                                                     options.replay,
+                                                     options.max_speed,
+                                                     options.batch_size,
+                                                     options.flush_interval,
+                                                     options.sample)
+        else:
+            self._tcp_capture = network.TCPCapture(self.queue,
+                                                   options.device,
+                                                   options.port,
+                                                   options.batch_size,
+                                                   options.flush_interval,
+                                                   options.responses,
+                                                   options.servers,
+                                                   options.sample)
         self._tcp_capture.process()
 
     def stop_process(self):
 
         self._tcp_capture.stop()
 
+    def stats(self):
+        # The packet source is created once the thread is running
+        capture = getattr(self, '_tcp_capture', None)
+        return capture.stats() if capture else dict()
+
 
 class Decode(threading.Thread):
     """Thread that manages the memcached protocol decoder instance"""
@@ -36,14 +62,57 @@ class Decode(threading.Thread):
         # Scope this here so we have prettier errors in initialization
         from . import memcache
 
-        self._decoder = memcache.Decoder(self.queue)
-        self._decoder.process()
+        self._decoder = memcache.Decoder(self.queue,
+                                         self.options.port,
+                                         self.options.responses,
+                                         self.options.top_keys,
+                                         self.options.key_error,
+                                         self.options.distinct,
+                                         self.options.servers,
+                                         self.options.namespaces,
+                                         self.options.sample,
+                                         self.options.slabs,
+                                         self.options.mrc_rate if
+                                         self.options.mrc else None,
+                                         self.options.mrc_keys,
+                                         not self.options.replay)
+
+        # Carry on from the checkpoint of an earlier run
+        if self.options.resume:
+            self._decoder.merge(self.options.resume)
+        try:
+            self._decoder.process()
+        finally:
+            # Don't leave the capture waiting on a queue nobody reads
+            self.queue.close()
 
     def stop_process(self):
         self._decoder.stop()
 
+    def checkpoint(self, checkpointer):
+        # Fork between batches, so the child never has a statistic the
+        # decode thread was partway through updating
+        decoder = getattr(self, '_decoder', None)
+        if decoder:
+            with decoder.lock:
+                checkpointer.checkpoint(decoder.state())
+
+    def snapshot(self):
+        # The decoder is created once the thread is running
+        decoder = getattr(self, '_decoder', None)
+        return decoder.snapshot() if decoder else None
+
+    def state(self):
+        decoder = getattr(self, '_decoder', None)
+        return decoder.state() if decoder else None
+
     def values(self):
-        return self._decoder.counts, self._decoder.keys
+        return (self._decoder.counts, self._decoder.distinct,
+                self._decoder.keys, self._decoder.flows,
+                self._decoder.servers, self._decoder.responses,
+                self._decoder.key_responses, self._decoder.latencies,
+                self._decoder.namespaces, self._decoder.estimates,
+                self._decoder.item_sizes, self._decoder.miss_ratio_curve)
 
 def signal_handler(frame, signum, action):
     """
@@ -59,49 +128,193 @@ def start(options):
 
     signal.signal(signal.SIGTERM, signal_handler)
 
-    # Create a queue to share data
-    _data_queue = Queue()
+    # Merge the deltas agents send instead of decoding when collecting,
+    # and decode in worker processes if asked or to drain them as an agent
+    if options.collect is not None:
+        decoder = collector.Collector(options)
+        _data_queue = None
+    elif options.workers > 1 or options.agent:
+        decoder = workers.DecodeWorkers(options)
+        _data_queue = decoder.queue
+    else:
+        _data_queue = pipeline.BoundedQueue(options.queue_size,
+                                            options.overload)
+        decoder = Decode()
+        decoder.options = options
+        decoder.queue = _data_queue
 
-    # Start the memcached protocol decoder
-    decoder = Decode()
-    decoder.options = options
-    decoder.queue = _data_queue
-    decoder.start()
+    # The network data capture thread, started once everything is ready
+    capture = None
+    telemetry = None
+    if _data_queue:
+        capture = Capture()
+        capture.options = options
+        capture.queue = _data_queue
+
+        # Report on the pipeline itself next to the traffic
+        def telemetry():
+            return {'queue': _data_queue.stats(), 'capture': capture.stats()}
+
+    # Listen for metrics scrapes if asked, before anything is started so a
+    # port in use stops nothing midway
+    metrics = None
+    if options.metrics_port is not None:
+        metrics = exporter.Exporter(decoder.snapshot, telemetry,
+                                    options.metrics_address,
+                                    options.metrics_port,
+                                    options.metrics_interval)
 
     # Start our user interface if we're in interactive mode
     if options.interactive:
 
         # Pick which type of interface we will use
         if options.window:
-            interface = ui.wxWindows()
+            interface = ui.wxWidgets()
         else:
             interface = ui.Curses()
 
-        # Start the interface thread
+        # Start the interface thread, reading the decoder snapshots
         interface.options = options
+        interface.decoder = decoder
+        interface.telemetry = telemetry
         interface.start()
 
-    # Kick off the network data capture thread
-    capture = Capture()
-    capture.options = options
-    capture.queue = _data_queue
-    capture.start()
+    # Stream a record of each interval when gathering to csv, jsonl or binary
+    writer = None
+    if options.gather and options.output in output.WRITERS:
+        writer = output.WRITERS[options.output](options.file)
 
-    # Loop as long as our processor is alive
-    while capture.is_alive() and decoder.is_alive():
-        try:
-            time.sleep(.5)
-        except KeyboardInterrupt:
+    # Checkpoint the aggregated state periodically if asked, with a part
+    # written by each worker
+    checkpointer = None
+    if options.checkpoint:
+        checkpointer = checkpoint.Checkpointer(
+            options.checkpoint, checkpoint.settings(options),
+            options.checkpoint_interval,
+            options.workers if isinstance(decoder, workers.DecodeWorkers)
+            else 0)
+
+    # Kick off the decoder, the metrics endpoint and the network data
+    # capture thread
+    decoder.start()
+    if metrics:
+        metrics.start()
+    if capture:
+        capture.start()
+
+    # Send deltas of the statistics to the collector if an agent
+    agent = None
+    if options.agent:
+        agent = collector.Agent(options.agent, options.agent_name,
+                                options.sample, options.agent_interval)
+        agent.start()
+
+    # Live captures in gather mode only listen for the timeout
+    started = time.time()
+    next_record = started + options.interval
+    deadline = None
+    if options.gather and options.timeout and not options.replay:
+        deadline = started + options.timeout
+
+    # Loop as long as our processor is alive, or in interactive mode until
+    # the user quits, so a finished replay stays on the screen
+    if options.interactive:
+        running = interface.is_alive
+    elif capture:
+        running = capture.is_alive
+    else:
+        running = decoder.is_alive
+
+    # Shut everything down in order however the loop ends
+    try:
+        while decoder.is_alive() and running():
+            try:
+                time.sleep(.5)
+            except KeyboardInterrupt:
+                break
+            now = time.time()
+            if writer and now >= next_record:
+                writer.add(decoder.snapshot())
+                next_record = max(next_record + options.interval, now)
+            if checkpointer and checkpointer.due():
+                decoder.checkpoint(checkpointer)
+            if agent and agent.due():
+                agent.send(decoder.drain())
+            if deadline and now >= deadline:
+                break
+    finally:
+        # Close the interface and endpoint before the decoder they read
+        # goes away
+        if options.interactive:
+            interface.stop()
+        if metrics:
+            metrics.stop()
+
+        # Stop capturing, then let the decoder finish what it was handed
+        if capture and capture.is_alive():
             capture.stop_process()
-            decoder.stop_process()
+            capture.join()
+
+        decoder.stop_process()
+        decoder.join()
 
-    # If we're running interactively shut everything down and exit
+    # Leave a checkpoint of everything decoded to resume from
+    if checkpointer and decoder.state():
+        checkpointer.finish(decoder.state())
+
+    # Let it be known when the results are missing traffic
+    stats = telemetry() if telemetry else None
+    if stats and (stats['queue']['dropped'] or
+                  stats['capture'].get('dropped') or
+                  stats['capture'].get('ifdropped')):
+        logging.warning('Traffic was dropped, the results are incomplete: '
+                        '%r', stats)
+
+    # The results of an agent are reported by its collector
+    if agent:
+        agent.finish(decoder.drain())
+        logging.info('Pipeline: %r', stats)
+        return
+
+    # If we're running interactively there is nothing left to show
     if options.interactive:
-        interface.stop()
+        return
+
+    # Write the record of whatever is left since the last one
+    if writer:
+        writer.add(decoder.snapshot())
+        writer.close()
+        if stats:
+            logging.info('Pipeline: %r', stats)
         return
 
     # Gather the data from the decoder
-    counts, keys = decoder.values()
+    (counts, distinct, keys, flows, servers, responses, key_responses,
+     latencies, namespaces, estimates, item_sizes,
+     miss_ratio_curve) = decoder.values()
 
     print counts
+    if options.distinct:
+        print distinct
     print keys
+    print flows
+    print servers
+    if options.namespaces:
+        print namespaces
+    if options.responses:
+        print responses
+        print key_responses
+        print latencies
+    if options.sample > 1:
+        print estimates
+    if options.slabs:
+        print slabs.report(item_sizes, options.slab_factor,
+                           options.slab_chunk_size, options.slab_page_size,
+                           options.sample)
+    if options.mrc:
+        print miss_ratio_curve.report(options.mrc_memory and
+                                      options.mrc_memory << 20)
+    if options.collect is not None:
+        print decoder.agents()
+    else:
+        print stats
@@ -1,47 +1,660 @@
 """
 Defines behaviors for decoding Memcached Protocols
 """
+import collections
+import cPickle
+import heapq
 import logging
 import Queue
-import re
+import socket
+import struct
+import threading
+import time
 
-_KEY_FORMAT = '([a-z0-9\:\-\_\.\!\?\@\#\$\%\^\&\*\(\)\=\+\~\`\;\"\'\<\>\,\/]*)'
+from . import histogram
+from . import mrc
+from . import sampling
+from . import sketch
+from . import slabs
+from . import stream
+from . import window
 
-_PATTERNS = {'get': re.compile('get %s\r\n' % _KEY_FORMAT),
-             'stats': re.compile('stats\r\n')
-            }
+# The ASCII protocol commands, each with the token positions its keys start
+# and end at and the position of its data block size, if it has one
+_COMMANDS = {'get': (1, None, None),
+             'gets': (1, None, None),
+             'set': (1, 2, 4),
+             'add': (1, 2, 4),
+             'replace': (1, 2, 4),
+             'append': (1, 2, 4),
+             'prepend': (1, 2, 4),
+             'cas': (1, 2, 4),
+             'incr': (1, 2, None),
+             'decr': (1, 2, None),
+             'delete': (1, 2, None),
+             'touch': (1, 2, None),
+             'gat': (2, None, None),
+             'gats': (2, None, None),
+             'mg': (1, 2, None),
+             'ms': (1, 2, 2),
+             'md': (1, 2, None),
+             'ma': (1, 2, None),
+             'me': (1, 2, None),
+             'mn': (0, 0, None),
+             'flush_all': (0, 0, None),
+             'version': (0, 0, None),
+             'verbosity': (0, 0, None),
+             'stats': (0, 0, None),
+             'quit': (0, 0, None)}
+
+# The binary protocol request header: magic, opcode, key length, extras
+# length, vbucket or status, total body length and opaque
+_BINARY_HEADER = struct.Struct('!BBHBxHII8x')
+_BINARY_HEADER_SIZE = 24
+
+# The client flags leading the extras of binary stores and get responses
+_BINARY_FLAGS = struct.Struct('!I')
+_BINARY_REQUEST = 0x80
+_BINARY_RESPONSE = 0x81
+_BINARY_MAGIC = frozenset(['\x80', '\x81'])
+_BINARY_STAT = 0x10
+
+# The binary protocol opcodes, counted under the matching ASCII command
+_BINARY_COMMANDS = {0x00: 'get',
+                    0x01: 'set',
+                    0x02: 'add',
+                    0x03: 'replace',
+                    0x04: 'delete',
+                    0x05: 'incr',
+                    0x06: 'decr',
+                    0x07: 'quit',
+                    0x08: 'flush_all',
+                    0x09: 'get',
+                    0x0a: 'noop',
+                    0x0b: 'version',
+                    0x0c: 'get',
+                    0x0d: 'get',
+                    0x0e: 'append',
+                    0x0f: 'prepend',
+                    0x10: 'stats',
+                    0x11: 'set',
+                    0x12: 'add',
+                    0x13: 'replace',
+                    0x14: 'delete',
+                    0x15: 'incr',
+                    0x16: 'decr',
+                    0x17: 'quit',
+                    0x18: 'flush_all',
+                    0x19: 'append',
+                    0x1a: 'prepend',
+                    0x1b: 'verbosity',
+                    0x1c: 'touch',
+                    0x1d: 'gat',
+                    0x1e: 'gat',
+                    0x20: 'sasl',
+                    0x21: 'sasl',
+                    0x22: 'sasl'}
+
+# Binary protocol opcodes that only respond on a hit
+_BINARY_QUIET_GET = frozenset([0x09, 0x0d, 0x1e])
+
+# Binary protocol response statuses
+_BINARY_STATUS_SUCCESS = 0x0000
+_BINARY_STATUS_KEY_NOT_FOUND = 0x0001
+
+# Commands that store a whole item, whose size is counted for the slab
+# class simulation
+_STORE_COMMANDS = frozenset(['set', 'add', 'replace', 'cas', 'ms'])
+
+# Commands that read an item, whose keys make up the reuse distances of the
+# miss ratio curve with those of the commands that store a whole item
+_READ_COMMANDS = frozenset(['get', 'gets', 'gat', 'gats', 'mg'])
+
+# Commands that only store when the key exists, so STORED is a hit
+_EXISTING_KEY_COMMANDS = frozenset(['replace', 'append', 'prepend', 'cas'])
+
+# ASCII responses that complete a request and whether each is a hit (True),
+# a miss (False) or neither (None)
+_RESPONSES = {'DELETED': True,
+              'TOUCHED': True,
+              'EXISTS': True,
+              'HD': True,
+              'NOT_FOUND': False,
+              'EN': False,
+              'NF': False,
+              'NS': None,
+              'MN': None,
+              'OK': None,
+              'VERSION': None,
+              'ERROR': None,
+              'CLIENT_ERROR': None,
+              'SERVER_ERROR': None}
+
+# The most requests remembered per connection while awaiting responses
+_MAX_PENDING = 4096
+
+# Keys are grouped into namespaces by the part before the first separator,
+# unless normalization rules are given, with the namespaces past the most
+# tracked grouped together
+_NAMESPACE_SEPARATOR = ':'
+_MAX_NAMESPACES = 1024
+_OTHER_NAMESPACE = '*'
+
+# The number of most used keys in a snapshot, and the most keys that may
+# be among them followed when counting every key
+_SNAPSHOT_KEYS = 20
+_SNAPSHOT_CANDIDATES = 8 * _SNAPSHOT_KEYS
+
+# The upper bounds of the latency and value size histogram buckets in a
+# snapshot, powers of four less one so each is a histogram bucket edge
+_SNAPSHOT_LATENCY_BOUNDS = [(1 << bits) - 1 for bits in xrange(4, 27, 2)]
+_SNAPSHOT_SIZE_BOUNDS = [(1 << bits) - 1 for bits in xrange(4, 25, 2)]
+
+# The request, hit, miss and value byte counters of each namespace, and
+# its latency histogram
+_NAMESPACE_REQUESTS = 0
+_NAMESPACE_HITS = 1
+_NAMESPACE_MISSES = 2
+_NAMESPACE_VALUE_BYTES = 3
+_NAMESPACE_LATENCY = 4
+
+# Server addresses are kept as unsigned ints, as unpacked from the packet,
+# IPv6 addresses as 128 bit ones made of their two halves
+_ADDRESS = struct.Struct('!I')
+_ADDRESS6 = struct.Struct('!QQ')
+_IPV4_MAX = 0xffffffff
+_HALF_MASK = 0xffffffffffffffff
 
 _QUEUE_GET_TIMEOUT = 1
 
 
+def parse_address(value):
+    """Return the unsigned int an IPv4 or IPv6 address is kept as.
+
+    :param str value: The address
+    :returns: int
+    :raises: ValueError
+
+    """
+    try:
+        return _ADDRESS.unpack(socket.inet_pton(socket.AF_INET, value))[0]
+    except socket.error:
+        pass
+    try:
+        high, low = _ADDRESS6.unpack(socket.inet_pton(socket.AF_INET6,
+                                                      value))
+    except socket.error:
+        raise ValueError('Invalid address: %s' % value)
+    return (high << 64) | low
+
+
+def format_endpoint(address, port):
+    """Return the address and port of a server as a string, with IPv6
+    addresses in brackets.
+
+    :param int address: The address as kept
+    :param int port: The port
+    :returns: str
+
+    """
+    if address > _IPV4_MAX:
+        return '[%s]:%i' % (socket.inet_ntop(socket.AF_INET6, _ADDRESS6.pack(
+            address >> 64, address & _HALF_MASK)), port)
+    return '%s:%i' % (socket.inet_ntoa(_ADDRESS.pack(address)), port)
+
+
+def _ascii_flags(command, tokens):
+    """Return the client flags of an ASCII protocol store, the token after
+    the key, or the F flag of a meta set, 0 if there are none.
+
+    :param str command: The store command
+    :param list tokens: The tokens of the request line
+    :returns: int
+
+    """
+    if command == 'ms':
+        flags = [token[1:] for token in tokens[3:] if token[0] == 'F']
+        value = flags[0] if flags else '0'
+    else:
+        value = tokens[2]
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+
+def _ascii_value_flags(word, tokens):
+    """Return the client flags of an ASCII protocol value, the token after
+    the key, or the f flag of a meta get, 0 if there are none.
+
+    :param str word: VALUE or VA
+    :param list tokens: The tokens of the value line
+    :returns: int
+
+    """
+    if word == 'VA':
+        flags = [token[1:] for token in tokens[2:] if token[0] == 'f']
+        value = flags[0] if flags else '0'
+    else:
+        value = tokens[2]
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+
+def _empty_snapshot(sample):
+    """Return a snapshot of no statistics.
+
+    :param int sample: The sampling factor the traffic was sampled by
+    :returns: dict
+
+    """
+    return {'started': None,
+            'timestamp': None,
+            'counts': dict(),
+            'hits': dict(),
+            'misses': dict(),
+            'value_bytes': dict(),
+            'requests': dict(),
+            'responses': dict(),
+            'keys': list(),
+            'latencies': dict(),
+            'histograms': {'latency': dict(),
+                           'value_size': dict()},
+            'sample': {'rate': sample,
+                       'design_effect': 1.0}}
+
+
+def _add_snapshot(merged, snapshot):
+    """Add the totals and rates of a snapshot to those of another, taking
+    the earliest start and the latest packet time of the two.
+
+    :param dict merged: The snapshot added to
+    :param dict snapshot: The snapshot to add
+
+    """
+    merged['timestamp'] = max(merged['timestamp'], snapshot['timestamp'])
+    if merged['started'] is None or \
+            snapshot['started'] < merged['started']:
+        merged['started'] = snapshot['started']
+    for name in ['counts', 'hits', 'misses', 'value_bytes', 'requests',
+                 'responses']:
+        for key, value in snapshot[name].iteritems():
+            if isinstance(value, dict):
+                rates = merged[name].setdefault(key, dict())
+                for rate_name, rate in value.iteritems():
+                    rates[rate_name] = rates.get(rate_name, 0) + rate
+            else:
+                merged[name][key] = merged[name].get(key, 0) + value
+
+
+def merge_summaries(summaries, sample=1):
+    """Return one snapshot of the statistics of several decoders, merged
+    from the summaries they published with Decoder.summary. The totals,
+    rates and histograms are added up and the latency percentiles taken
+    from the merged latency histograms. The most used keys are those with
+    the largest counts across the snapshots, so a key that is not among the
+    most used of every decoder is undercounted.
+
+    :param list summaries: The summaries of the decoders
+    :param int sample: The sampling factor the traffic was sampled by
+    :returns: dict
+
+    """
+    merged = _empty_snapshot(sample)
+    keys = dict()
+    latencies = dict()
+    groups = [0] * sampling.GROUPS
+    for summary in summaries:
+        snapshot = summary['snapshot']
+        if snapshot['timestamp'] is None:
+            continue
+        _add_snapshot(merged, snapshot)
+        for key, count in snapshot['keys']:
+            keys[key] = keys.get(key, 0) + count
+        for command, packed in summary['command_latency'].iteritems():
+            latency = histogram.Histogram.unpack(packed)
+            if command in latencies:
+                latencies[command].merge(latency)
+            else:
+                latencies[command] = latency
+        for name, histograms in snapshot['histograms'].iteritems():
+            totals = merged['histograms'][name]
+            for command, values in histograms.iteritems():
+                total = totals.get(command)
+                if total is None:
+                    totals[command] = {'buckets': list(values['buckets']),
+                                       'count': values['count'],
+                                       'sum': values['sum']}
+                    continue
+                total['buckets'] = [(bound, count + added[1]) for
+                                    (bound, count), added in
+                                    zip(total['buckets'], values['buckets'])]
+                total['count'] += values['count']
+                total['sum'] += values['sum']
+        for index, count in enumerate(summary['sample_groups']):
+            groups[index] += count
+    merged['keys'] = heapq.nlargest(_SNAPSHOT_KEYS, keys.iteritems(),
+                                    key=lambda item: item[1])
+    merged['latencies'] = dict([(command, latency.summary())
+                                for command, latency in
+                                latencies.iteritems()])
+    merged['sample']['design_effect'] = sampling.design_effect(sample,
+                                                               groups)
+    return merged
+
+
 class Decoder(object):
     """Takes raw data from the TCP packet and attempts to decode it against
     the memcached protocol and increment counters as appropriate.
 
     """
-    def __init__(self, queue):
-        """Create a new Decoder object.
+    def __init__(self, queue, port=11211, responses=False, top_keys=None,
+                 key_error=sketch.KEY_ERROR, distinct=False, servers=None,
+                 namespaces=None, sample=1, item_sizes=False, mrc_rate=None,
+                 mrc_keys=mrc.MAX_KEYS, live=False):
+        """Create a new Decoder object. When top_keys is set only the most
+        used keys are tracked, in fixed memory, instead of every key. When
+        a namespace normalizer is given, requests, responses and latencies
+        are also added up for the namespace of each key. When the traffic
+        is sampled, the counts reported are scaled up by the sampling factor,
+        while the latencies and distinct keys are those of the sampled
+        connections. When item_sizes is set, the sizes of the items stored
+        are counted for simulating memcached's slab classes. When mrc_rate
+        is set, the keys read and stored are sampled at that rate to
+        estimate the miss ratio curve of an LRU cache. When live is set, the
+        traffic is being captured as it happens and the rolling windows move
+        on with the clock while none arrives, rather than only with packet
+        time.
 
         :param Queue.Queue queue: The queue that will have the TCP payload
+        :param int|list port: The port or ports memcached is running on
+        :param bool responses: Decode server responses as well as requests
+        :param int top_keys: The number of most used keys to track
+        :param float key_error: The bound on the overestimate of a key count
+            as a share of all key uses when tracking the most used keys
+        :param bool distinct: Estimate the distinct keys used per command
+            and per key namespace
+        :param list servers: The addresses of the memcached servers, any
+            address on the ports if not set
+        :param namespace.Normalizer namespaces: The rules that map keys to
+            namespaces
+        :param int sample: The sampling factor the traffic was sampled by
+        :param bool item_sizes: Count the sizes of the items stored
+        :param float mrc_rate: The share of keys to follow for the miss
+            ratio curve, not estimated if not set
+        :param int mrc_keys: The most keys to follow for the miss ratio
+            curve
+        :param bool live: The traffic is captured live, not replayed
 
         """
         self._logger = logging.getLogger('menwith.memcache.Decoder')
         self._logger.debug('Setup with queue: %r', queue)
         self._queue = queue
+        if isinstance(port, int):
+            port = [port]
+        self._ports = frozenset(port)
+        self._servers = None
+        if servers:
+            self._servers = frozenset([parse_address(server)
+                                       for server in servers])
+        self._responses = responses
         self._running = False
+        self._top_keys = top_keys
+        self._key_error = key_error
+        self._distinct = distinct
+        self._namespaces = namespaces
+        self._sample = sample
+        self._count_item_sizes = item_sizes
+        self._mrc_rate = mrc_rate
+        self._mrc_keys = mrc_keys
+        self._live = live
+        self.lock = threading.Lock()
+        self._flows = stream.FlowTable(self._process_payload)
+        self._debug = self._logger.isEnabledFor(logging.DEBUG)
+        self._clear()
+
+    def _clear(self):
+        """Set up the statistics, empty, as when created or drained."""
+        self._endpoints = dict()
         self._counts = self._setup_counter()
         self._keys = dict()
+        self._candidates = dict()
+        self._candidate_floor = 0
+        self._hits = self._setup_counter()
+        self._misses = self._setup_counter()
+        self._value_bytes = self._setup_counter()
+        self._key_responses = dict()
+        self._command_latency = dict()
+        self._port_latency = dict()
+        self._value_sizes = dict()
+        self._command_distinct = dict()
+        self._namespace_distinct = dict()
+        self._namespace_stats = dict()
+        self._merged_flows = {'active': 0, 'evicted': 0}
+        self._sample_groups = [0] * sampling.GROUPS
+        self._item_sizes = slabs.SizeHistogram()
+        self._mrc = None
+        if self._mrc_rate:
+            self._mrc = mrc.MissRatioCurve(self._mrc_rate, self._mrc_keys)
+        self._request_window = window.RollingWindow(self._counts.keys())
+        self._response_window = window.RollingWindow(['hits', 'misses',
+                                                      'value_bytes'])
+        self._next_interval = 0
+        self._started = None
+        self._timestamp = None
+        self._snapshot = _empty_snapshot(self._sample)
+
+        # Count keys in the fixed size sketch, forgetting replaced keys
+        if self._top_keys:
+            self._keys = sketch.SpaceSaving(self._top_keys, self._key_error,
+                                            self._forget_key)
+
+    def _forget_key(self, key):
+        """Drop the response stats of a key that is no longer tracked.
 
-    def _count_key_use(self, key):
+        :param str key: The key that was replaced
+
+        """
+        self._key_responses.pop(key, None)
+
+    def _count_key_use(self, command, key):
         """Append the key to the key count if it doesn't exist and then
-        increment the counter.
+        increment the counter, estimating distinct keys when enabled.
 
+        :param str command: The command using the key
         :param str key: The key to append
         """
-        if key not in self._keys:
-            self._keys[key] = 0
-        self._keys[key] += 1
-        self._logger.debug('Key %s incremented to %i', key, self._keys[key])
+        if self._top_keys:
+            self._keys.increment(key)
+        else:
+            keys = self._keys
+            count = keys[key] = keys.get(key, 0) + 1
+            if count >= self._candidate_floor:
+                self._add_candidate(key, count)
+            if self._debug:
+                self._logger.debug('Key %s incremented to %i', key, count)
+
+        if self._namespaces:
+            self._namespace(key)[_NAMESPACE_REQUESTS] += 1
+
+        if self._distinct:
+            self._count_distinct_key(command, key)
+
+    def _add_candidate(self, key, count):
+        """Follow the count of a key that may be among the most used, when
+        counting every key, so a snapshot does not look through them all.
+        Once too many are followed, only the most used are kept and a key
+        used less than the least of those can not be among them.
+
+        :param str key: The key used
+        :param int count: The use count of the key
+
+        """
+        candidates = self._candidates
+        candidates[key] = count
+        if len(candidates) > _SNAPSHOT_CANDIDATES:
+            self._set_candidates(candidates)
+
+    def _set_candidates(self, keys):
+        """Follow only the most used of the keys counted.
+
+        :param dict keys: The keys and their use counts
+
+        """
+        top = heapq.nlargest(_SNAPSHOT_KEYS, keys.iteritems(),
+                             key=lambda item: item[1])
+        self._candidates = dict(top)
+        self._candidate_floor = top[-1][1] if len(top) == _SNAPSHOT_KEYS \
+            else 0
+
+    def _count_distinct_key(self, command, key):
+        """Add the key to the distinct key estimates for the command and for
+        the namespace of the key, hashing it once for both.
+
+        :param str command: The command using the key
+        :param str key: The key to add
+
+        """
+        index, rank = sketch.key_register(key)
+        counter = self._command_distinct.get(command)
+        if counter is None:
+            counter = self._command_distinct[command] = sketch.HyperLogLog()
+        if rank > counter.registers[index]:
+            counter.registers[index] = rank
+
+        # Group the namespaces past the most tracked together
+        if self._namespaces:
+            namespace = self._namespaces.namespace(key)
+        else:
+            namespace = key[:max(key.find(_NAMESPACE_SEPARATOR), 0)]
+        counter = self._namespace_distinct.get(namespace)
+        if counter is None:
+            if len(self._namespace_distinct) >= _MAX_NAMESPACES:
+                namespace = _OTHER_NAMESPACE
+            counter = self._namespace_distinct.get(namespace)
+            if counter is None:
+                counter = self._namespace_distinct[namespace] = \
+                    sketch.HyperLogLog()
+        if rank > counter.registers[index]:
+            counter.registers[index] = rank
+
+    def _namespace(self, key):
+        """Return the counters of the namespace of a key, grouping the
+        namespaces past the most tracked together.
+
+        :param str key: The key
+        :returns: list
+
+        """
+        namespace = self._namespaces.namespace(key)
+        stats = self._namespace_stats.get(namespace)
+        if stats is None:
+            if len(self._namespace_stats) >= _MAX_NAMESPACES:
+                namespace = _OTHER_NAMESPACE
+            stats = self._namespace_stats.get(namespace)
+            if stats is None:
+                stats = self._namespace_stats[namespace] = \
+                    [0, 0, 0, 0, histogram.Histogram()]
+        return stats
+
+    def _endpoint(self, address, port):
+        """Return the stats of the memcached server at the address and
+        port, creating them the first time the server is seen.
+
+        :param int address: The server address
+        :param int port: The server port
+        :returns: dict
+
+        """
+        endpoint = self._endpoints.get((address, port))
+        if endpoint is None:
+            endpoint = self._endpoints[(address, port)] = {
+                'counts': self._setup_counter(),
+                'keys': 0,
+                'hits': 0,
+                'misses': 0,
+                'value_bytes': 0}
+        return endpoint
+
+    def _record_hit(self, server, command, key, value_bytes=None, flags=0):
+        """Record a response that found the key, and the size of the value
+        returned with it, if any, in the value size histogram of the command.
+
+        :param dict server: The stats of the server that responded
+        :param str command: The command the response is for
+        :param str key: The key the response is for
+        :param int value_bytes: The size of the value returned
+        :param int flags: The client flags returned with the value
+
+        """
+        if value_bytes is None:
+            value_bytes = 0
+        else:
+            if command not in self._value_sizes:
+                self._value_sizes[command] = histogram.Histogram()
+            self._value_sizes[command].record(value_bytes)
+        self._hits[command] += 1
+        self._value_bytes[command] += value_bytes
+        server['hits'] += 1
+        server['value_bytes'] += value_bytes
+        interval = self._response_window.current
+        interval['hits'] += 1
+        interval['value_bytes'] += value_bytes
+        if self._namespaces:
+            stats = self._namespace(key)
+            stats[_NAMESPACE_HITS] += 1
+            stats[_NAMESPACE_VALUE_BYTES] += value_bytes
+        if self._mrc is not None and value_bytes:
+            self._mrc.resize(key, slabs.item_size(len(key), value_bytes,
+                                                  flags))
+        if self._top_keys and key not in self._keys:
+            return
+        if key not in self._key_responses:
+            self._key_responses[key] = [0, 0, 0]
+        stats = self._key_responses[key]
+        stats[0] += 1
+        stats[2] += value_bytes
+
+    def _record_latency(self, flow, request):
+        """Record the time from a request to the start of its response in
+        the histograms for the command, the server port and the namespace of
+        the first key of the request.
+
+        :param stream.Flow flow: The response flow
+        :param tuple request: The request being responded to
+
+        """
+        latency = int((flow.last_seen - request[4]) * 1000000)
+        command, port = request[0], flow.key[1]
+        if command not in self._command_latency:
+            self._command_latency[command] = histogram.Histogram()
+        self._command_latency[command].record(latency)
+        if port not in self._port_latency:
+            self._port_latency[port] = histogram.Histogram()
+        self._port_latency[port].record(latency)
+        if self._namespaces and request[1]:
+            self._namespace(request[1][0])[_NAMESPACE_LATENCY].record(latency)
+
+    def _record_miss(self, server, command, key):
+        """Record a response that did not find the key.
+
+        :param dict server: The stats of the server that responded
+        :param str command: The command the response is for
+        :param str key: The key the response is for
+
+        """
+        self._misses[command] += 1
+        server['misses'] += 1
+        self._response_window.current['misses'] += 1
+        if self._namespaces:
+            self._namespace(key)[_NAMESPACE_MISSES] += 1
+        if self._top_keys and key not in self._keys:
+            return
+        if key not in self._key_responses:
+            self._key_responses[key] = [0, 0, 0]
+        self._key_responses[key][1] += 1
 
     def _setup_counter(self):
         """Create a counter object with a default value of 0 for all supported
@@ -51,27 +664,465 @@ class Decoder(object):
 
         """
         counter = dict()
-        for key in _PATTERNS:
+        for key in _COMMANDS:
+            counter[key] = 0
+        for key in _BINARY_COMMANDS.itervalues():
             counter[key] = 0
         return counter
 
-    def _process_payload(self, data):
-        """Process a TCP payload looking for data to match the expected
-        patterns.
+    def _process_payload(self, flow, data):
+        """Process the reassembled data of a flow with the decoder for its
+        protocol, classifying the flow by its first byte the first time it
+        has data: binary protocol magic or otherwise ASCII. The stats of the
+        server the flow belongs to are looked up once and kept on the flow.
+
+        :param stream.Flow flow: The flow the data belongs to
+        :param str data: The contiguous data of the flow
+        :returns: int
+
+        """
+        if flow.protocol is None:
+            binary = data[0] in _BINARY_MAGIC
+
+            # Requests go to a memcached server, responses come from one
+            source, source_port, destination, destination_port = flow.key
+            if destination_port in self._ports and \
+                    (self._servers is None or destination in self._servers):
+                flow.server = self._endpoint(destination, destination_port)
+                if self._sample > 1:
+                    flow.group = sampling.group(*flow.key)
+                if self._responses:
+                    flow.pending = collections.deque(maxlen=_MAX_PENDING)
+                if binary:
+                    flow.protocol = self._process_binary
+                else:
+                    flow.protocol = self._process_ascii
+            elif self._responses and source_port in self._ports and \
+                    (self._servers is None or source in self._servers):
+                flow.server = self._endpoint(source, source_port)
+                if binary:
+                    flow.protocol = self._process_binary_response
+                else:
+                    flow.protocol = self._process_ascii_response
+            else:
+                flow.protocol = self._process_nothing
+        return flow.protocol(flow, data)
+
+    def _process_nothing(self, flow, data):
+        """Discard the data of a flow that is not being decoded.
+
+        :param stream.Flow flow: The flow the data belongs to
+        :param str data: The contiguous data of the flow
+        :returns: int
+
+        """
+        return len(data)
+
+    def _pending(self, flow):
+        """Return the requests awaiting a response on the connection the
+        response flow belongs to, or None if its requests were not seen.
+
+        :param stream.Flow flow: The response flow
+        :returns: collections.deque
+
+        """
+        source, source_port, destination, destination_port = flow.key
+        request = self._flows.get((destination, destination_port, source,
+                                   source_port))
+        if request:
+            return request.pending
+
+    def _process_ascii(self, flow, data):
+        """Tokenize the reassembled data of a flow in a single pass, counting
+        every complete command in it and the keys it uses. Each line is
+        found and split with one scan and the data block of a storage
+        command is jumped over by its declared size. A data block that has
+        not all arrived yet is skipped by the flow table as it arrives.
+
+        :param stream.Flow flow: The flow the data belongs to
+        :param str data: The contiguous data of the flow
+        :returns: int
+
+        """
+        commands = _COMMANDS
+        counts = self._counts
+        interval = self._request_window.current
+        server = flow.server
+        server_counts = server['counts']
+        groups = self._sample_groups
+        group = flow.group
+        count_key_use = self._count_key_use
+        pending = flow.pending
+        record_size = (self._item_sizes.record if self._count_item_sizes
+                       else None)
+        reference = (self._mrc.reference if self._mrc is not None
+                     else None)
+        find = data.find
+        offset = 0
+        size = len(data)
+
+        # After a gap in the stream, start again at the next line
+        if not flow.synchronized:
+            end = find('\r\n')
+            if end < 0:
+                return size
+            offset = end + 2
+            flow.synchronized = True
+
+        while offset < size:
+            end = find('\r\n', offset)
+            if end < 0:
+                break
+            tokens = data[offset:end].split()
+            offset = end + 2
+
+            # Skip blank lines and anything that is not a command
+            if not tokens:
+                continue
+            command = tokens[0]
+            layout = commands.get(command)
+            if layout is None:
+                continue
+            counts[command] += 1
+            interval[command] += 1
+            server_counts[command] += 1
+            groups[group] += 1
+            first_key, last_key, bytes_token = layout
+
+            # Count the use of each key
+            if first_key:
+                keys = tokens[first_key:last_key]
+                for key in keys:
+                    count_key_use(command, key)
+                server['keys'] += len(keys)
+                if reference and command in _READ_COMMANDS:
+                    for key in keys:
+                        reference(key)
+
+            # Remember the request if a response will come back for it
+            if pending is not None and command != 'quit' and \
+                    tokens[-1] != 'noreply' and \
+                    not (command[0] == 'm' and 'q' in tokens):
+                pending.append((command, tokens[first_key:last_key], None,
+                                False, flow.last_seen))
 
-        :param str data: The data to process.
+            # Jump over the data block and its trailing CRLF
+            if bytes_token:
+                try:
+                    length = int(tokens[bytes_token])
+                except (IndexError, ValueError):
+                    continue
+                offset += length + 2
+                if (record_size or reference) and \
+                        command in _STORE_COMMANDS:
+                    item_size = slabs.item_size(len(tokens[first_key]),
+                                                length,
+                                                _ascii_flags(command, tokens))
+                    if record_size:
+                        record_size(item_size)
+                    if reference:
+                        reference(tokens[first_key], item_size)
+                if offset > size:
+                    flow.skip = offset - size
+                    return size
+
+        return offset
+
+    def _process_binary(self, flow, data):
+        """Walk the binary protocol requests in the reassembled data of a
+        flow, counting each command and the key it uses. The header is read
+        with one precompiled struct, the key sliced out from behind the
+        extras and the value jumped over using the total body length. A
+        value that has not all arrived yet is skipped by the flow table as
+        it arrives.
+
+        :param stream.Flow flow: The flow the data belongs to
+        :param str data: The contiguous data of the flow
+        :returns: int
 
         """
-        for command in _PATTERNS:
-            response = _PATTERNS[command].match(data)
-            if response:
-                self._counts[command] += 1
-                self._logger.debug('Incremented %s command count', command)
-                data = response.groups()
-                if data:
-                    self._count_key_use(data[0])
+        counts = self._counts
+        interval = self._request_window.current
+        server = flow.server
+        server_counts = server['counts']
+        groups = self._sample_groups
+        group = flow.group
+        count_key_use = self._count_key_use
+        pending = flow.pending
+        record_size = (self._item_sizes.record if self._count_item_sizes
+                       else None)
+        reference = (self._mrc.reference if self._mrc is not None
+                     else None)
+        unpack_from = _BINARY_HEADER.unpack_from
+        offset = 0
+        size = len(data)
+
+        # After a gap in the stream, start again at the next request header
+        if not flow.synchronized:
+            offset = self._binary_resynchronize(data, _BINARY_REQUEST)
+            if offset < 0:
+                return size
+            flow.synchronized = True
+
+        while offset + _BINARY_HEADER_SIZE <= size:
+            (magic, opcode, key_length, extras_length, status, body_length,
+             opaque) = unpack_from(data, offset)
+
+            # Wait for the key to arrive before counting the command
+            key_offset = offset + _BINARY_HEADER_SIZE + extras_length
+            if key_offset + key_length > size:
                 break
 
+            command = _BINARY_COMMANDS.get(opcode)
+            if magic == _BINARY_REQUEST and command:
+                counts[command] += 1
+                interval[command] += 1
+                server_counts[command] += 1
+                groups[group] += 1
+                key = data[key_offset:key_offset + key_length]
+                if key:
+                    count_key_use(command, key)
+                    server['keys'] += 1
+                    if reference and command in _READ_COMMANDS:
+                        reference(key)
+                if (record_size or reference) and \
+                        command in _STORE_COMMANDS:
+                    flags = 0
+                    if extras_length >= _BINARY_FLAGS.size:
+                        flags = _BINARY_FLAGS.unpack_from(
+                            data, offset + _BINARY_HEADER_SIZE)[0]
+                    item_size = slabs.item_size(
+                        key_length, body_length - key_length - extras_length,
+                        flags)
+                    if record_size:
+                        record_size(item_size)
+                    if reference and key:
+                        reference(key, item_size)
+
+                # Remember the request to pair with the response by opaque
+                if pending is not None:
+                    pending.append((command, (key,), opaque,
+                                    opcode in _BINARY_QUIET_GET,
+                                    flow.last_seen))
+
+            # Jump over the extras, key and value
+            offset += _BINARY_HEADER_SIZE + body_length
+            if offset > size:
+                flow.skip = offset - size
+                return size
+
+        return offset
+
+    def _process_binary_response(self, flow, data):
+        """Walk the binary protocol responses in the reassembled data of a
+        flow, pairing each with its request by opaque and recording hits,
+        misses and value sizes. Only the header is read, the body is jumped
+        over using the total body length.
+
+        :param stream.Flow flow: The flow the data belongs to
+        :param str data: The contiguous data of the flow
+        :returns: int
+
+        """
+        pending = self._pending(flow)
+        server = flow.server
+        unpack_from = _BINARY_HEADER.unpack_from
+        offset = 0
+        size = len(data)
+
+        # After a gap in the stream, start again at the next response header
+        if not flow.synchronized:
+            offset = self._binary_resynchronize(data, _BINARY_RESPONSE)
+            if offset < 0:
+                return size
+            flow.synchronized = True
+
+        while offset + _BINARY_HEADER_SIZE <= size:
+            (magic, opcode, key_length, extras_length, status, body_length,
+             opaque) = unpack_from(data, offset)
+            extras = offset + _BINARY_HEADER_SIZE
+            offset += _BINARY_HEADER_SIZE + body_length
+
+            # Each statistic is a response, the last one has no key
+            if opcode == _BINARY_STAT and key_length:
+                continue
+
+            # Find the request, quiet gets skipped over were misses
+            while pending:
+                request = pending.popleft()
+                if request[2] == opaque:
+                    break
+                if request[3]:
+                    self._record_miss(server, request[0], request[1][0])
+            else:
+                continue
+            self._record_latency(flow, request)
+
+            command, keys = request[0], request[1]
+            if status == _BINARY_STATUS_SUCCESS:
+                if command == 'get' or command == 'gat':
+                    flags = 0
+                    if self._mrc is not None and \
+                            extras_length >= _BINARY_FLAGS.size and \
+                            extras + _BINARY_FLAGS.size <= size:
+                        flags = _BINARY_FLAGS.unpack_from(data, extras)[0]
+                    self._record_hit(server, command, keys[0],
+                                     body_length - extras_length - key_length,
+                                     flags)
+                elif command != 'set' and command != 'add' and keys[0]:
+                    self._record_hit(server, command, keys[0])
+            elif status == _BINARY_STATUS_KEY_NOT_FOUND:
+                self._record_miss(server, command, keys[0])
+
+        # Jump over the rest of a body that has not arrived yet
+        if offset > size:
+            flow.skip = offset - size
+            return size
+        return offset
+
+    def _process_ascii_response(self, flow, data):
+        """Tokenize the ASCII protocol responses in the reassembled data of a
+        flow, pairing them with their requests in order and recording hits,
+        misses and value sizes. Values are jumped over by their declared
+        size without being scanned.
+
+        :param stream.Flow flow: The flow the data belongs to
+        :param str data: The contiguous data of the flow
+        :returns: int
+
+        """
+        pending = self._pending(flow)
+        server = flow.server
+        find = data.find
+        offset = 0
+        size = len(data)
+
+        # After a gap in the stream, start again at the next line
+        if not flow.synchronized:
+            end = find('\r\n')
+            if end < 0:
+                return size
+            offset = end + 2
+            flow.synchronized = True
+            flow.response = None
+
+        while offset < size:
+            end = find('\r\n', offset)
+            if end < 0:
+                break
+            tokens = data[offset:end].split()
+            offset = end + 2
+            if not tokens:
+                continue
+            word = tokens[0]
+
+            # A value from a retrieval, the request stays current until END
+            if word == 'VALUE' or word == 'VA':
+                try:
+                    if word == 'VALUE':
+                        value_bytes = int(tokens[3])
+                    else:
+                        value_bytes = int(tokens[1])
+                except (IndexError, ValueError):
+                    continue
+
+                # Jump over the value and its trailing CRLF
+                offset += value_bytes + 2
+
+                if flow.response is None and pending:
+                    flow.response = [pending.popleft(), list()]
+                    self._record_latency(flow, flow.response[0])
+                if flow.response is not None:
+                    request, found = flow.response
+                    if word == 'VALUE':
+                        key = tokens[1]
+                    else:
+                        key = request[1][0] if request[1] else ''
+
+                        # A meta get has a single value and no END
+                        flow.response = None
+                    found.append(key)
+                    flags = 0
+                    if self._mrc is not None:
+                        flags = _ascii_value_flags(word, tokens)
+                    self._record_hit(server, request[0], key, value_bytes,
+                                     flags)
+
+                if offset > size:
+                    flow.skip = offset - size
+                    return size
+
+            # Statistics are returned a line at a time up to END
+            elif word == 'STAT':
+                continue
+
+            # The end of a retrieval, any key not returned was a miss
+            elif word == 'END':
+                if flow.response is not None:
+                    request, found = flow.response
+                    flow.response = None
+                elif pending:
+                    request, found = pending.popleft(), ()
+                    self._record_latency(flow, request)
+                else:
+                    continue
+                for key in request[1]:
+                    if key not in found:
+                        self._record_miss(server, request[0], key)
+
+            # Every other response is a single line
+            elif pending:
+                request = pending.popleft()
+                self._record_latency(flow, request)
+                command = request[0]
+                if word in _RESPONSES:
+                    hit = _RESPONSES[word]
+                elif word == 'STORED' or word == 'NOT_STORED':
+                    if command not in _EXISTING_KEY_COMMANDS:
+                        continue
+                    hit = word == 'STORED'
+                else:
+                    hit = word.isdigit() or None
+                if hit is None or not request[1]:
+                    continue
+                if hit:
+                    self._record_hit(server, command, request[1][0])
+                else:
+                    self._record_miss(server, command, request[1][0])
+
+        return offset
+
+    def _binary_resynchronize(self, data, magic):
+        """Return the offset of the first plausible binary protocol header
+        with the given magic in data, or -1 if there is none.
+
+        :param str data: The data to search
+        :param int magic: The request or response magic
+        :returns: int
+
+        """
+        character = chr(magic)
+        offset = data.find(character)
+        while 0 <= offset <= len(data) - _BINARY_HEADER_SIZE:
+            (magic, opcode, key_length, extras_length, status, body_length,
+             opaque) = _BINARY_HEADER.unpack_from(data, offset)
+            if opcode in _BINARY_COMMANDS and \
+                    key_length + extras_length <= body_length:
+                return offset
+            offset = data.find(character, offset + 1)
+        return -1
+
+    def _scaled(self, counter):
+        """Return a copy of a counter scaled up by the sampling factor.
+
+        :param dict counter: The counter to scale
+        :returns: dict
+
+        """
+        sample = self._sample
+        return dict([(name, value * sample)
+                     for name, value in counter.iteritems()])
+
     @property
     def counts(self):
         """Return the value of the counts dictionary.
@@ -79,20 +1130,513 @@ class Decoder(object):
         :returns: dict
 
         """
-        return self._counts.copy()
+        return self._scaled(self._counts)
+
+    def _estimate(self, count, effect):
+        """Return a count scaled up by the sampling factor and the bounds
+        of its 95% confidence interval.
+
+        :param int count: The count of the sampled connections
+        :param float effect: The design effect of the sample
+        :returns: dict
+
+        """
+        estimate = count * self._sample
+        low, high = sampling.bounds(estimate, self._sample, effect)
+        return {'estimate': estimate, 'low': low, 'high': high}
+
+    @property
+    def estimates(self):
+        """Return the sampling factor, the design effect of sampling whole
+        connections, the scaled count of each command with the bounds of its
+        95% confidence interval and the scaled counts of the most used keys.
+        The design effect is measured on the totals, a key used by only a few
+        connections varies far more, so the keys are given no bounds.
+
+        :returns: dict
+
+        """
+        effect = sampling.design_effect(self._sample, self._sample_groups)
+        return {'sample': self._sample,
+                'design_effect': effect,
+                'counts': dict([(command, self._estimate(count, effect))
+                                for command, count in
+                                self._counts.iteritems() if count]),
+                'keys': [(key, count * self._sample)
+                         for key, count in self._top_key_counts()]}
+
+    @property
+    def item_sizes(self):
+        """Return the histogram of the sizes of the items stored, as
+        sampled.
+
+        :returns: slabs.SizeHistogram
+
+        """
+        return self._item_sizes
+
+    @property
+    def miss_ratio_curve(self):
+        """Return the miss ratio curve of the keys read and stored, if it
+        is being estimated.
+
+        :returns: mrc.MissRatioCurve
+
+        """
+        return self._mrc
+
+    @property
+    def distinct(self):
+        """Return the estimated number of distinct keys used by each command
+        and in each key namespace.
+
+        :returns: dict
+
+        """
+        return {'commands': dict([(command, counter.estimate())
+                                  for command, counter in
+                                  self._command_distinct.iteritems()]),
+                'namespaces': dict([(namespace, counter.estimate())
+                                    for namespace, counter in
+                                    self._namespace_distinct.iteritems()])}
+
+    @property
+    def flows(self):
+        """Return the number of flows being reassembled and the number
+        evicted from the flow table.
+
+        :returns: dict
+
+        """
+        return {'active': self._flows.active + self._merged_flows['active'],
+                'evicted': (self._flows.evicted +
+                            self._merged_flows['evicted'])}
+
+    @property
+    def latencies(self):
+        """Return the count, mean, maximum and p50/p90/p99/p999 server
+        latency in microseconds for each command and each server port.
+
+        :returns: dict
+
+        """
+        return {'commands': dict([(command, latency.summary())
+                                  for command, latency in
+                                  self._command_latency.iteritems()]),
+                'ports': dict([(port, latency.summary())
+                               for port, latency in
+                               self._port_latency.iteritems()])}
+
+    @property
+    def key_responses(self):
+        """Return the hits, misses and value bytes returned for each key
+        that has seen a response.
+
+        :returns: dict
+
+        """
+        sample = self._sample
+        return dict([(key, {'hits': stats[0] * sample,
+                            'misses': stats[1] * sample,
+                            'value_bytes': stats[2] * sample})
+                      for key, stats in self._key_responses.iteritems()])
 
     @property
     def keys(self):
-        """Return the value of the keys dictionary.
+        """Return the value of the keys dictionary, or when tracking the
+        most used keys, a list of the key, use count and the most the count
+        may be over by for each, most used first.
 
-        :returns dict
+        :returns dict or list
 
         """
+        sample = self._sample
+        if self._top_keys:
+            return [(key, count * sample, error * sample)
+                    for key, count, error in self._keys.most_common()]
+        if sample > 1:
+            return self._scaled(self._keys)
         return self._keys
 
+    def snapshot(self):
+        """Return the latest snapshot of the packet time decoding started
+        at, the command, hit, miss and value byte totals, the per second
+        request and response rates over the last 1s, 10s, 60s and 5m of
+        packet time, the most used keys, the latency percentiles and the
+        latency and value size histograms of each command, and the sampling
+        factor. A new snapshot replaces the reference each second, so it is
+        read without locking and must not be modified.
+
+        :returns: dict
+
+        """
+        return self._snapshot
+
+    def summary(self):
+        """Return the latest snapshot with what merging it with those of
+        other decoders takes, the latency histogram of each command and the
+        requests counted in each sampling group. It is made of numbers,
+        strings and containers only, so a decode worker can publish it
+        without pickling each time it publishes a snapshot.
+
+        :returns: dict
+
+        """
+        return {'snapshot': self._snapshot,
+                'command_latency': dict([(command, latency.pack())
+                                         for command, latency in
+                                         self._command_latency.iteritems()]),
+                'sample_groups': self._sample_groups}
+
+    @property
+    def servers(self):
+        """Return the command counts, key uses, hits, misses and value bytes
+        returned for each memcached server, by address and port.
+
+        :returns: dict
+
+        """
+        sample = self._sample
+        servers = dict()
+        for (address, port), stats in self._endpoints.iteritems():
+            name = format_endpoint(address, port)
+            servers[name] = {'counts': dict([(command, value * sample)
+                                             for command, value in
+                                             stats['counts'].iteritems()
+                                             if value]),
+                             'keys': stats['keys'] * sample,
+                             'hits': stats['hits'] * sample,
+                             'misses': stats['misses'] * sample,
+                             'value_bytes': stats['value_bytes'] * sample}
+        return servers
+
+    @property
+    def namespaces(self):
+        """Return the requests, hits, misses, value bytes returned and
+        latency of each key namespace.
+
+        :returns: dict
+
+        """
+        sample = self._sample
+        return dict([(namespace,
+                      {'requests': stats[_NAMESPACE_REQUESTS] * sample,
+                       'hits': stats[_NAMESPACE_HITS] * sample,
+                       'misses': stats[_NAMESPACE_MISSES] * sample,
+                       'value_bytes': (stats[_NAMESPACE_VALUE_BYTES] *
+                                       sample),
+                       'latency': stats[_NAMESPACE_LATENCY].summary()})
+                     for namespace, stats in
+                     self._namespace_stats.iteritems()])
+
+    @property
+    def responses(self):
+        """Return the hits, misses, hit ratio and average value size for
+        each command that has seen a response.
+
+        :returns: dict
+
+        """
+        responses = dict()
+        for command in self._hits:
+            hits = self._hits[command] * self._sample
+            misses = self._misses[command] * self._sample
+            if hits or misses:
+                responses[command] = {
+                    'hits': hits,
+                    'misses': misses,
+                    'hit_ratio': float(hits) / (hits + misses),
+                    'average_value_bytes': (float(self._value_bytes[command]) *
+                                            self._sample / hits
+                                            if hits else 0.0)}
+        return responses
+
+    def add_batch(self, batch):
+        """Reassemble and process each TCP segment in a batch.
+
+        :param list batch: The segments handed over by the capture
+
+        """
+        # Avoid the attribute lookup for every segment in a batch
+        add_segment = self._flows.segment
+        next_interval = self._next_interval
+        for segment in batch:
+            if segment[0] >= next_interval:
+                next_interval = self._advance(segment[0])
+            add_segment(*segment)
+        if batch:
+            self._timestamp = batch[-1][0]
+
+    def _advance(self, timestamp):
+        """Move the rolling windows on to the interval the packet time falls
+        in, publishing a new snapshot, and return when that interval ends.
+
+        :param float timestamp: The packet time
+        :returns: float
+
+        """
+        if self._started is None:
+            self._started = timestamp
+        self._request_window.advance(timestamp)
+        self._response_window.advance(timestamp)
+        self._next_interval = self._request_window.end
+        self._publish(self._next_interval - self._request_window.width)
+        return self._next_interval
+
+    def idle(self):
+        """Move the rolling windows on to the current time while no traffic
+        arrives on a live capture, so the rates fall once traffic stops
+        instead of staying at their last values. A replay keeps to packet
+        time.
+
+        """
+        if self._live and self._started is not None:
+            now = time.time()
+            if now >= self._next_interval:
+                self._advance(now)
+
+    def finish(self):
+        """Publish a last snapshot that includes everything decoded since
+        the start of the current interval, once there is nothing left to
+        decode.
+
+        """
+        if self._timestamp is not None:
+            self._publish(self._timestamp)
+
+    def _publish(self, timestamp):
+        """Replace the snapshot with one of the statistics at the packet
+        time.
+
+        :param float timestamp: The packet time the statistics are up to
+
+        """
+        # Replace the snapshot rather than update it, so readers never wait
+        sample = self._sample
+        self._snapshot = {
+            'started': self._started,
+            'timestamp': timestamp,
+            'counts': self._scaled(self._counts),
+            'hits': self._scaled(self._hits),
+            'misses': self._scaled(self._misses),
+            'value_bytes': self._scaled(self._value_bytes),
+            'requests': dict([(name, dict([(command, rate * sample)
+                                           for command, rate in
+                                           rates.iteritems() if rate]))
+                              for name, rates in
+                              self._request_window.rates().iteritems()]),
+            'responses': dict([(name, self._scaled(rates))
+                               for name, rates in
+                               self._response_window.rates().iteritems()]),
+            'keys': [(key, count * sample)
+                     for key, count in self._top_key_counts()],
+            'latencies': self.latencies['commands'],
+            'histograms': self._histograms(),
+            'sample': self._sample_state()}
+
+    def _histograms(self):
+        """Return the latency and value size histograms of each command,
+        each as the count at or below each bucket bound, the number of
+        values and their sum, for the snapshot.
+
+        :returns: dict
+
+        """
+        histograms = dict()
+        for name, source, bounds in [('latency', self._command_latency,
+                                      _SNAPSHOT_LATENCY_BOUNDS),
+                                     ('value_size', self._value_sizes,
+                                      _SNAPSHOT_SIZE_BOUNDS)]:
+            histograms[name] = dict([(command,
+                                      {'buckets': zip(bounds,
+                                                      values.cumulative(
+                                                          bounds)),
+                                       'count': values.count,
+                                       'sum': values.total})
+                                     for command, values in
+                                     source.iteritems()])
+        return histograms
+
+    def _sample_state(self):
+        """Return the sampling factor and the design effect of sampling
+        whole connections, for the snapshot.
+
+        :returns: dict
+
+        """
+        return {'rate': self._sample,
+                'design_effect': sampling.design_effect(self._sample,
+                                                        self._sample_groups)}
+
+    def _top_key_counts(self):
+        """Return the most used keys and their use counts, most used first.
+
+        :returns: list
+
+        """
+        if self._top_keys:
+            return [(key, count) for key, count, error in
+                    self._keys.most_common(_SNAPSHOT_KEYS)]
+        return heapq.nlargest(_SNAPSHOT_KEYS, self._candidates.iteritems(),
+                              key=lambda item: item[1])
+
+    def merge(self, state):
+        """Add the statistics of another decoder, as returned by its state
+        method, to those of this one.
+
+        :param dict state: The statistics of the other decoder
+
+        """
+        for name in ['counts', 'hits', 'misses', 'value_bytes']:
+            counter = getattr(self, '_%s' % name)
+            for command, value in state[name].iteritems():
+                counter[command] = counter.get(command, 0) + value
+
+        # Add up the key counts, keeping the key stats for tracked keys
+        if self._top_keys:
+            self._keys.merge(state['keys'])
+        else:
+            for key, value in state['keys'].iteritems():
+                self._keys[key] = self._keys.get(key, 0) + value
+            self._set_candidates(self._keys)
+        for key, stats in state['key_responses'].iteritems():
+            if self._top_keys and key not in self._keys:
+                continue
+            if key in self._key_responses:
+                self._key_responses[key] = map(sum, zip(
+                    self._key_responses[key], stats))
+            else:
+                self._key_responses[key] = list(stats)
+
+        # Merge the latency histograms and distinct key estimates
+        for name in ['command_latency', 'port_latency', 'value_sizes',
+                     'command_distinct', 'namespace_distinct']:
+            merged = getattr(self, '_%s' % name)
+            for key, value in state[name].iteritems():
+                if key in merged:
+                    merged[key].merge(value)
+                else:
+                    merged[key] = value
+
+        for name in self._merged_flows:
+            self._merged_flows[name] += state['flows'][name]
+
+        # Add up the counts of each interval of the rolling windows
+        self._request_window.merge(state['windows']['requests'])
+        self._response_window.merge(state['windows']['responses'])
+        if self._started is None or \
+                state['started'] is not None and \
+                state['started'] < self._started:
+            self._started = state['started']
+        for index, count in enumerate(state['sample_groups']):
+            self._sample_groups[index] += count
+        self._item_sizes.merge(state['item_sizes'])
+        if self._mrc is not None and state['mrc'] is not None:
+            self._mrc.merge(state['mrc'])
+
+        # Add up the rates of the latest snapshots, taking the keys and
+        # latencies from the merged statistics
+        snapshot = state['snapshot']
+        if snapshot['timestamp'] is not None:
+            merged = self._snapshot
+            merged['keys'] = [(key, count * self._sample)
+                              for key, count in self._top_key_counts()]
+            merged['latencies'] = self.latencies['commands']
+            merged['histograms'] = self._histograms()
+            merged['sample'] = self._sample_state()
+            _add_snapshot(merged, snapshot)
+
+        # Add up the stats of each namespace
+        for namespace, stats in state['namespaces'].iteritems():
+            merged = self._namespace_stats.get(namespace)
+            if merged is None:
+                if len(self._namespace_stats) >= _MAX_NAMESPACES:
+                    namespace = _OTHER_NAMESPACE
+                merged = self._namespace_stats.setdefault(
+                    namespace, [0, 0, 0, 0, histogram.Histogram()])
+            for index in xrange(_NAMESPACE_LATENCY):
+                merged[index] += stats[index]
+            merged[_NAMESPACE_LATENCY].merge(stats[_NAMESPACE_LATENCY])
+
+        # Add up the stats of each server
+        for (address, port), stats in state['endpoints'].iteritems():
+            endpoint = self._endpoint(address, port)
+            for command, value in stats['counts'].iteritems():
+                endpoint['counts'][command] += value
+            for name in ['keys', 'hits', 'misses', 'value_bytes']:
+                endpoint[name] += stats[name]
+
+    def state(self):
+        """Return the statistics gathered so far in a form that can be
+        pickled and merged into another decoder. The statistics are not
+        copied, so pickle them before decoding any more.
+
+        :returns: dict
+
+        """
+        return {'counts': self._counts,
+                'hits': self._hits,
+                'misses': self._misses,
+                'value_bytes': self._value_bytes,
+                'keys': self._keys,
+                'key_responses': self._key_responses,
+                'command_latency': self._command_latency,
+                'port_latency': self._port_latency,
+                'value_sizes': self._value_sizes,
+                'command_distinct': self._command_distinct,
+                'namespace_distinct': self._namespace_distinct,
+                'namespaces': self._namespace_stats,
+                'endpoints': self._endpoints,
+                'flows': self.flows,
+                'sample_groups': self._sample_groups,
+                'item_sizes': self._item_sizes,
+                'mrc': self._mrc,
+                'started': self._started,
+                'windows': {'requests': self._request_window,
+                            'responses': self._response_window},
+                'snapshot': self._snapshot}
+
+    def drain(self):
+        """Return a copy of the statistics gathered since the decoder was
+        created or last drained, as the state method returns them, and start
+        gathering afresh. The connections being reassembled and the requests
+        waiting on their responses are kept, so nothing in flight is lost or
+        counted twice, and so are the stats of the servers they count in,
+        zeroed.
+
+        :returns: dict
+
+        """
+        state = cPickle.loads(cPickle.dumps(self.state(),
+                                            cPickle.HIGHEST_PROTOCOL))
+        endpoints = self._endpoints
+        self._clear()
+        self._flows.evicted = 0
+        for endpoint in endpoints.itervalues():
+            for command in endpoint['counts']:
+                endpoint['counts'][command] = 0
+            for name in ['keys', 'hits', 'misses', 'value_bytes']:
+                endpoint[name] = 0
+        self._endpoints = endpoints
+        return state
+
+    def advance(self, timestamp):
+        """Move the rolling windows on to the packet time and publish a new
+        snapshot, for a decoder that merges statistics instead of decoding.
+
+        :param float timestamp: The packet time the statistics are up to
+
+        """
+        if timestamp >= self._next_interval:
+            self._advance(timestamp)
+        self._timestamp = max(self._timestamp, timestamp)
+        self.finish()
+
     def process(self):
         """Blocking method to process packets as they come in to be decoded.
-        Will exit when we are no longer running.
+        Will exit when we are no longer running. The lock is held while each
+        batch is decoded, so another thread holding it has the statistics
+        as they were between two batches.
 
         """
         # Set the runtime state
@@ -102,12 +1646,18 @@ class Decoder(object):
         while self._running:
 
             try:
-                tcp_payload = self._queue.get(timeout=_QUEUE_GET_TIMEOUT)
+                batch = self._queue.get(timeout=_QUEUE_GET_TIMEOUT)
             except Queue.Empty:
+                with self.lock:
+                    self.idle()
                 continue
+            with self.lock:
+                self.add_batch(batch)
 
-            # Process the tcp_payload
-            self._process_payload(tcp_payload)
+        # Decode anything still waiting in the queue
+        while not self._queue.empty():
+            self.add_batch(self._queue.get())
+        self.finish()
 
         # We're done
         self._logger.debug('Exiting process')
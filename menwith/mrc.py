@@ -0,0 +1,314 @@
+"""
+Miss ratio curve of an LRU cache estimated from the key stream
+
+The reuse distance of a request is the bytes of the distinct items used
+since the last request for the same key, plus its own. An LRU cache of a
+given size hits every request with a reuse distance no larger than the
+cache, so the histogram of reuse distances gives the miss ratio of every
+cache size at once.
+
+Keys are sampled spatially, as SHARDS does, by their hash: a key is
+followed when its hash is under a threshold, so every request for a
+followed key is seen and the reuse distances among them are those of the
+whole stream scaled down by the sampling rate. When more keys are followed
+than the most allowed, the key with the largest hash is dropped and the
+threshold lowered to it, so memory stays fixed however many keys there
+are. Each distance is scaled back up by the rate it was measured at and
+counted with the weight of the requests it stands for.
+
+The last use of each followed key is marked with its size in a Fenwick
+tree indexed by the order of use, so the bytes used since any earlier use
+are summed in logarithmic time. The tree is renumbered once its positions
+are all taken.
+
+"""
+import heapq
+import math
+
+from . import sketch
+from . import slabs
+
+# The share of keys followed by default and the most followed at once
+RATE = 0.01
+MAX_KEYS = 8192
+
+# Key hashes are 32 bit
+_HASH_RANGE = 1 << 32
+
+# The positions in the Fenwick tree per followed key
+_POSITIONS_PER_KEY = 4
+
+# Reuse distances are counted in buckets of a sixteenth of each power of two
+_SUB_BUCKET_BITS = 4
+_SUB_BUCKETS = 1 << _SUB_BUCKET_BITS
+
+# The multiples of the cache memory the miss ratio is reported at
+MULTIPLES = [0.5, 1, 2, 4]
+
+
+def _bucket(distance):
+    """Return the histogram bucket of a reuse distance.
+
+    :param float distance: The reuse distance in bytes
+    :returns: int
+
+    """
+    mantissa, exponent = math.frexp(distance)
+    return (exponent << _SUB_BUCKET_BITS) + \
+        int((mantissa - 0.5) * 2 * _SUB_BUCKETS)
+
+
+def _upper_bound(bucket):
+    """Return the reuse distance the histogram bucket ends at.
+
+    :param int bucket: The histogram bucket
+    :returns: float
+
+    """
+    exponent, sub_bucket = divmod(bucket, _SUB_BUCKETS)
+    return math.ldexp(0.5 + (sub_bucket + 1) / (2.0 * _SUB_BUCKETS), exponent)
+
+
+class MissRatioCurve(object):
+    """Estimates the miss ratio of an LRU cache of any size from the reuse
+    distances of a spatially sampled share of the keys used.
+
+    """
+    def __init__(self, rate=RATE, max_keys=MAX_KEYS):
+        """Create a new, empty, MissRatioCurve.
+
+        :param float rate: The share of keys to follow
+        :param int max_keys: The most keys to follow at once
+
+        """
+        self.rate = float(rate)
+        self.references = 0
+        self._threshold = int(self.rate * _HASH_RANGE)
+        self._max_keys = max_keys
+        self._keys = dict()
+        self._largest = list()
+        self._tree = [0] * (max_keys * _POSITIONS_PER_KEY + 1)
+        self._position = 0
+        self._cold = 0.0
+        self._distances = dict()
+        self._item_bytes = 0
+        self._items = 0
+
+    def __len__(self):
+        """Return the number of keys followed.
+
+        :returns: int
+
+        """
+        return len(self._keys)
+
+    def _add(self, position, size):
+        """Add size to the bytes at a position of the tree.
+
+        :param int position: The position of a use
+        :param int size: The bytes to add
+
+        """
+        tree = self._tree
+        position += 1
+        length = len(tree)
+        while position < length:
+            tree[position] += size
+            position += position & -position
+
+    def _sum(self, position):
+        """Return the bytes at the positions before the one given.
+
+        :param int position: The position of a use
+        :returns: int
+
+        """
+        tree = self._tree
+        total = 0
+        while position:
+            total += tree[position]
+            position &= position - 1
+        return total
+
+    def _renumber(self):
+        """Give the last uses of the followed keys the first positions of
+        the tree, in the order they were used, and rebuild the tree.
+
+        """
+        tree = [0] * len(self._tree)
+        length = len(tree)
+        uses = sorted(self._keys.itervalues())
+        for position, use in enumerate(uses):
+            use[0] = position
+            tree[position + 1] = use[1]
+        for position in xrange(1, length):
+            parent = position + (position & -position)
+            if parent < length:
+                tree[parent] += tree[position]
+        self._tree = tree
+        self._position = len(uses)
+
+    def _drop_largest(self):
+        """Stop following the key with the largest hash and lower the
+        threshold and sampling rate to its hash.
+
+        """
+        negated, key = heapq.heappop(self._largest)
+        position, size = self._keys.pop(key)
+        self._add(position, -size)
+        self._threshold = -negated
+        self.rate = float(self._threshold) / _HASH_RANGE
+
+    def _size(self, key):
+        """Return the size of an item stored for a key that has not been
+        seen stored, the mean of those that have, if any.
+
+        :param str key: The key of the item
+        :returns: int
+
+        """
+        if self._items:
+            return self._item_bytes // self._items
+        return slabs.item_size(len(key), 0)
+
+    def reference(self, key, size=None):
+        """Count a request for the key, with the size of the item when it
+        is being stored.
+
+        :param str key: The key requested
+        :param int size: The size of the item stored
+
+        """
+        self.references += 1
+        value = sketch.key_hash(key)
+        if value >= self._threshold:
+            return
+        if size is not None:
+            self._item_bytes += size
+            self._items += 1
+        weight = 1 / self.rate
+        if self._position == len(self._tree) - 1:
+            self._renumber()
+        position = self._position
+        self._position += 1
+        use = self._keys.get(key)
+
+        # The first request for a key misses whatever the cache size
+        if use is None:
+            if size is None:
+                size = self._size(key)
+            self._keys[key] = [position, size]
+            self._add(position, size)
+            self._cold += weight
+            heapq.heappush(self._largest, (-value, key))
+            if len(self._keys) > self._max_keys:
+                self._drop_largest()
+            return
+
+        # Sum the bytes of the keys used since, scaled up by the rate, and
+        # add the bytes of the item itself
+        last, previous = use
+        if size is None:
+            size = previous
+        distance = (self._sum(position) - self._sum(last + 1)) * weight + size
+        bucket = _bucket(distance)
+        self._distances[bucket] = self._distances.get(bucket, 0) + weight
+        self._add(last, -previous)
+        self._add(position, size)
+        use[0] = position
+        use[1] = size
+
+    def resize(self, key, size):
+        """Set the size of the item of a followed key, as returned by a hit.
+
+        :param str key: The key of the item
+        :param int size: The size of the item
+
+        """
+        use = self._keys.get(key)
+        if use is not None and use[1] != size:
+            self._add(use[0], size - use[1])
+            use[1] = size
+
+    def merge(self, other):
+        """Carry on from another curve when this one has not counted any
+        requests, otherwise add its reuse distances to those of this one.
+        The distances of separate key streams do not make those of the
+        streams combined, so the curve is only exact for a single stream.
+        A curve following a different number of keys, or more of them than
+        this one would, is refused, as carrying on from it would replace the
+        limits this curve was created with.
+
+        :param MissRatioCurve other: The curve to merge in
+        :raises: ValueError
+
+        """
+        if other._max_keys != self._max_keys or other.rate > self.rate:
+            raise ValueError('Can not merge a miss ratio curve following up '
+                             'to %i keys at %.4f into one following up to %i '
+                             'at %.4f' % (other._max_keys, other.rate,
+                                          self._max_keys, self.rate))
+        if not self.references:
+            self.__dict__.update(other.__dict__)
+            return
+        self.references += other.references
+        self._cold += other._cold
+        for bucket, weight in other._distances.iteritems():
+            self._distances[bucket] = self._distances.get(bucket, 0) + weight
+
+    def miss_ratios(self, sizes):
+        """Return the miss ratio of an LRU cache of each size.
+
+        :param list sizes: The cache sizes in bytes
+        :returns: list
+
+        """
+        if not self.references:
+            return [None for size in sizes]
+
+        # The requests the sample stands for differ from those made by the
+        # chance of the most used keys being sampled or not, so the
+        # difference is counted as hits at no distance, as SHARDS_adj does
+        total = float(self.references)
+        adjustment = total - self._cold - sum(self._distances.itervalues())
+        buckets = sorted(self._distances)
+        bounds = [_upper_bound(bucket) for bucket in buckets]
+        ratios = list()
+        for size in sizes:
+            hits = sum([self._distances[bucket] for bucket, bound in
+                        zip(buckets, bounds) if bound <= size])
+            ratios.append(min(max(1 - (hits + adjustment) / total, 0.0), 1.0))
+        return ratios
+
+    def curve(self):
+        """Return the miss ratio of an LRU cache of each power of two bytes
+        from the smallest reuse distance counted to the largest, as pairs
+        of the size and the miss ratio.
+
+        :returns: list
+
+        """
+        if not self._distances:
+            return list()
+        smallest, largest = min(self._distances), max(self._distances)
+        sizes = [1 << bits for bits in
+                 xrange((smallest >> _SUB_BUCKET_BITS) - 1,
+                        (largest >> _SUB_BUCKET_BITS) + 1)]
+        return zip(sizes, self.miss_ratios(sizes))
+
+    def report(self, memory=None):
+        """Return the miss ratio curve and, when the memory of the cache is
+        given, the miss ratio at each multiple of it.
+
+        :param int memory: The memory of the cache in bytes
+        :returns: dict
+
+        """
+        result = {'rate': self.rate,
+                  'references': self.references,
+                  'keys': len(self._keys),
+                  'curve': self.curve()}
+        if memory:
+            sizes = [int(memory * multiple) for multiple in MULTIPLES]
+            result['memory'] = zip(MULTIPLES, sizes, self.miss_ratios(sizes))
+        return result
@@ -0,0 +1,183 @@
+"""
+Normalize raw keys into key namespaces
+
+Keys are split into segments on a set of delimiters. A key that matches
+one of the explicit patterns, such as user:*:profile, takes the pattern as
+its namespace. The patterns are compiled once into a prefix trie of their
+segments, so a key is matched against all of them in one walk. Any other
+key has the segments that look like identifiers, runs of digits, long
+hexadecimal strings and UUIDs, replaced with a wildcard.
+
+Normalizing a key is far slower than looking it up, so recent results are
+kept in a bounded cache of two generations. Keys are added to the young
+generation, and when it fills the old generation is dropped and the young
+one takes its place. A key found in the old generation is moved back to the
+young one, so the keys in use stay cached, as in an LRU, without the
+bookkeeping of reordering on every hit.
+
+"""
+import re
+
+# The default delimiters between key segments
+DELIMITERS = ':'
+
+# The kinds of segment that can be collapsed into the wildcard
+COLLAPSE = ['digits', 'hex', 'uuid']
+_SEGMENT_PATTERNS = {'digits': r'\d+',
+                     'hex': r'[0-9a-fA-F]{8,}',
+                     'uuid': (r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+                              r'[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')}
+
+# A pattern segment matching any one segment, or every segment left
+WILDCARD = '*'
+_REMAINDER = '**'
+
+# The trie node slot holding the pattern that ends at it
+_PATTERN = None
+
+# The default number of raw keys with a cached namespace
+CACHE_SIZE = 65536
+
+
+class Normalizer(object):
+    """Maps raw keys to their namespaces by the explicit patterns and the
+    segment collapsing rules, caching the most recent results.
+
+    """
+    def __init__(self, delimiters=DELIMITERS, collapse=None, patterns=None,
+                 cache_size=CACHE_SIZE):
+        """Create a new Normalizer, compiling the rules.
+
+        :param str delimiters: The characters that separate key segments
+        :param list collapse: The kinds of segment to replace with the
+            wildcard, digits, hex and uuid by default
+        :param list patterns: The explicit namespace patterns
+        :param int cache_size: The number of raw keys to cache
+        :raises: ValueError
+
+        """
+        if not delimiters:
+            raise ValueError('At least one delimiter is required')
+        if collapse is None:
+            collapse = COLLAPSE
+        for kind in collapse:
+            if kind not in _SEGMENT_PATTERNS:
+                raise ValueError('Unknown segment kind: %s' % kind)
+        self.delimiters = delimiters
+        self.collapse = list(collapse)
+        self.patterns = list(patterns or [])
+        self._split = re.compile('([%s])' % re.escape(delimiters)).split
+        self._identifier = None
+        if collapse:
+            self._identifier = re.compile('(?:%s)$' % '|'.join(
+                [_SEGMENT_PATTERNS[kind] for kind in collapse])).match
+        self._trie = dict()
+        for pattern in self.patterns:
+            self._add_pattern(pattern)
+        self._cache_size = max(cache_size // 2, 1)
+        self._young = dict()
+        self._old = dict()
+
+    def __getstate__(self):
+        """Return the state to pickle, the rules without the compiled
+        matchers or the cache, which are rebuilt when unpickled.
+
+        :returns: dict
+
+        """
+        return {'delimiters': self.delimiters,
+                'collapse': self.collapse,
+                'patterns': self.patterns,
+                'cache_size': self._cache_size * 2}
+
+    def __setstate__(self, state):
+        """Rebuild the normalizer from its pickled rules.
+
+        :param dict state: The pickled rules
+
+        """
+        self.__init__(**state)
+
+    def _add_pattern(self, pattern):
+        """Add an explicit pattern to the trie, one node per segment.
+
+        :param str pattern: The pattern to add
+        :raises: ValueError
+
+        """
+        segments = self._split(pattern)[::2]
+        node = self._trie
+        for index, segment in enumerate(segments):
+            if segment == _REMAINDER:
+                if index != len(segments) - 1:
+                    raise ValueError('%s can only end a pattern: %s' %
+                                     (_REMAINDER, pattern))
+                node.setdefault(_REMAINDER, pattern)
+                return
+            node = node.setdefault(segment, dict())
+        node.setdefault(_PATTERN, pattern)
+
+    def _match(self, node, segments, index):
+        """Return the pattern the segments from index on match in the trie
+        below node, preferring literal segments over wildcards.
+
+        :param dict node: The trie node to match from
+        :param list segments: The segments of the key
+        :param int index: The segment to match next
+        :returns: str or None
+
+        """
+        if index == len(segments):
+            return node.get(_PATTERN)
+        child = node.get(segments[index])
+        if child is not None:
+            pattern = self._match(child, segments, index + 1)
+            if pattern:
+                return pattern
+        child = node.get(WILDCARD)
+        if child is not None:
+            pattern = self._match(child, segments, index + 1)
+            if pattern:
+                return pattern
+        return node.get(_REMAINDER)
+
+    def normalize(self, key):
+        """Return the namespace of a key, without using the cache.
+
+        :param str key: The raw key
+        :returns: str
+
+        """
+        parts = self._split(key)
+        if self._trie:
+            pattern = self._match(self._trie, parts[::2], 0)
+            if pattern:
+                return pattern
+        if self._identifier:
+            identifier = self._identifier
+            for index in xrange(0, len(parts), 2):
+                if identifier(parts[index]):
+                    parts[index] = WILDCARD
+        return ''.join(parts)
+
+    def namespace(self, key):
+        """Return the namespace of a key, from the cache when it was seen
+        recently.
+
+        :param str key: The raw key
+        :returns: str
+
+        """
+        namespace = self._young.get(key)
+        if namespace is not None:
+            return namespace
+        namespace = self._old.get(key)
+        if namespace is None:
+            namespace = self.normalize(key)
+
+        # Start a new generation once the young one is full
+        if len(self._young) >= self._cache_size:
+            self._old = self._young
+            self._young = dict()
+        self._young[key] = namespace
+        return namespace
@@ -4,20 +4,66 @@ Main PCAP interface for listening on the NIC for data
 """
 import logging
 import pcap
-from socket import ntohs, IPPROTO_TCP, IPPROTO_UDP
+from socket import inet_ntoa, inet_ntop, AF_INET6, IPPROTO_TCP
 import struct
+import time
 
 from . import memcache
+from . import sampling
+
+# The link layer types decoded, as numbered by libpcap and capture files
+LINKTYPE_ETHERNET = 1
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+LINKTYPES = frozenset([LINKTYPE_ETHERNET, LINKTYPE_LINUX_SLL,
+                       LINKTYPE_LINUX_SLL2])
 
 # Ethernet constants
-_ETHERTYPE_IPV4 = '\x08\x00'
+_ETHERNET_HEADER_SIZE = 14
+_ETHERNET_HEADER = struct.Struct('!6s6sH')
+_ETHERTYPE = struct.Struct('!12xH')
+_ETHERTYPE_IPV4 = 0x0800
+_ETHERTYPE_IPV6 = 0x86dd
+
+# 802.1Q VLAN and 802.1ad QinQ tags, each followed by the next ethertype
+_VLAN_ETHERTYPES = frozenset([0x8100, 0x88a8, 0x9100])
+_VLAN_TAG_SIZE = 4
+_VLAN_ETHERTYPE = struct.Struct('!2xH')
+
+# Linux cooked capture headers, of -i any captures, and their protocol
+_SLL_HEADER_SIZE = 16
+_SLL_PROTOCOL = struct.Struct('!14xH')
+_SLL2_HEADER_SIZE = 20
+_SLL2_PROTOCOL = struct.Struct('!H')
 
 # IPv4 Constants
 _IPV4_BASE_HEADER_SIZE = 20 # Default IPv4 header size
-_IPV4_OPTIONS_OFFSET = 20  # Bit 160
+_IPV4_HEADER = struct.Struct('!BBHHHBBH4s4s')
+_IPV4_FAST_HEADER = struct.Struct('!BxH5xBxxII')
+
+# IPv6 Constants, the addresses are unpacked as their two halves
+_IPV6_HEADER_SIZE = 40
+_IPV6_HEADER = struct.Struct('!IHBB16s16s')
+_IPV6_FAST_HEADER = struct.Struct('!4xHBxQQQQ')
+
+# IPv6 extension headers skipped to find the TCP header: those whose length
+# is in 8 byte units past the first 8, the fragment header, of which only
+# the first fragment has the TCP header, and the authentication header,
+# whose length is in 4 byte units past the first 8
+_IPV6_EXTENSIONS = frozenset([0, 43, 60, 135, 139, 140])
+_IPV6_EXTENSION = struct.Struct('!BB')
+_IPV6_FRAGMENT = 44
+_IPV6_FRAGMENT_HEADER = struct.Struct('!BxH')
+_IPV6_FRAGMENT_SIZE = 8
+_IPV6_FRAGMENT_OFFSET = 0xfff8
+_IPV6_AUTHENTICATION = 51
 
 # TCP Constants
-_TCP_BASE_HEADER_SIZE = 24
+_TCP_HEADER = struct.Struct('!HHIIBB')
+_TCP_FAST_HEADER = struct.Struct('!HHI4xBB')
+
+# Segments without a payload that still matter to stream reassembly
+_TCP_FIN_SYN_RST = 0x07
 
 # Port we want to use by default
 _MEMCACHED_PORT = 11211
@@ -28,47 +74,150 @@ _SNAPSHOT_LENGTH = 65535
 # Doesn't do anything in Linux
 _TIMEOUT = 100
 
+# Maximum number of packets dispatched and payloads handed off at once
+BATCH_SIZE = 128
+
+# Maximum number of seconds a partial batch waits before being handed off
+FLUSH_INTERVAL = 0.05
+
+# How often the libpcap counters are read, often enough to catch each time
+# the 32 bit counters wrap
+_STATS_INTERVAL = 1.0
+_COUNTER_WRAP = 1 << 32
+
+
+def _bpf_direction(qualifier, ranges, servers):
+    """Return the BPF filter expression for one direction of the traffic.
+
+    :param str qualifier: The BPF direction qualifier, dst or src
+    :param list ranges: The first and last port of each run of ports
+    :param list servers: The server addresses, any address if not set
+    :returns: str
+
+    """
+    expression = ' or '.join(['%s port %i' % (qualifier, first)
+                              if first == last else
+                              '%s portrange %i-%i' % (qualifier, first, last)
+                              for first, last in ranges])
+    if servers:
+        expression = '(%s) and (%s)' % (' or '.join(['%s host %s' %
+                                                     (qualifier, server)
+                                                     for server in servers]),
+                                        expression)
+    return expression
+
+
+def bpf_filter(ports, servers=None, responses=False):
+    """Return the BPF filter expression matching the requests to, and if
+    asked, the responses from, the memcached servers on the ports. Runs of
+    consecutive ports are matched as a range.
+
+    :param list ports: The ports memcached is running on
+    :param list servers: The server addresses, any address if not set
+    :param bool responses: Match server responses as well as requests
+    :returns: str
+
+    """
+    ranges = list()
+    for port in sorted(set(ports)):
+        if ranges and ranges[-1][1] == port - 1:
+            ranges[-1][1] = port
+        else:
+            ranges.append([port, port])
+    if responses:
+        return '(%s) or (%s)' % (_bpf_direction('dst', ranges, servers),
+                                 _bpf_direction('src', ranges, servers))
+    return _bpf_direction('dst', ranges, servers)
+
+
+def bpf_vlan(expression):
+    """Return the BPF filter expression matching the packets the expression
+    matches untagged or in an 802.1Q VLAN tagged Ethernet frame. The vlan
+    primitive moves the offsets of everything after it, so the expression
+    is given whole, sampling included.
+
+    :param str expression: The filter expression for untagged frames
+    :returns: str
+
+    """
+    return '(%s) or (vlan and (%s))' % (expression, expression)
+
 
-class TCPCapture(object):
+class PacketCapture(object):
+    """Decodes IPv4 and IPv6 TCP packets handed to _process_packet by a
+    packet source, putting batches of TCP segments on the decoder queue.
+    _process_packet is the decoding for the link type of the source, picked
+    when it is opened: Ethernet, with or without VLAN tags, or Linux cooked
+    capture. Each segment is a tuple of the timestamp, source address,
+    source port, destination address, destination port, sequence number,
+    flags and payload. When sampling, only the segments of the connections
+    the flow hash keeps are added.
 
-    def __init__(self, queue, device, port=_MEMCACHED_PORT):
-        """Create a new TCPCapture object for the given device and port.
+    """
+
+    def __init__(self, queue, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, sample=1,
+                 linktype=LINKTYPE_ETHERNET):
+        """Create a new PacketCapture object handing payloads to queue.
 
         :param Queue queue: The cross-thread queue to create
-        :param str device: The device name (eth0, en1, etc)
-        :param int port: The port to listen on
+        :param int batch_size: Max packets per dispatch and payloads per batch
+        :param float flush_interval: Max seconds a partial batch waits
+        :param int sample: Keep 1 in this many connections
+        :param int linktype: The link layer type of the packets
         :raises: ValueError
 
         """
-        self._logger = logging.getLogger('menwith.network.TCPCapture')
+        self._logger = logging.getLogger('%s.%s' % (self.__module__,
+                                                    self.__class__.__name__))
         self._logger.debug('Setup with queue: %r', queue)
         self._queue = queue
         self._running = False
 
-        # Create the PCAP object
-        self._pcap = self._setup_libpcap(device, port)
+        # Payloads are handed to the decoder in batches
+        self._batch = list()
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._flush_deadline = 0
 
-    def _char_conversion(self, value):
-        """Convert the bytes to a character returning the converted string.
+        # Whole connections are dropped right after the headers are read
+        self._sample = sample
 
-        :param str value: The string to convert
-        :returns: str
+        # Only build the full header dictionaries when they will be logged
+        self._debug = self._logger.isEnabledFor(logging.DEBUG)
 
-        """
-        return ''.join(['%c' % byte for byte in value])
+        # Packets are decoded for the link type of the source
+        self._set_linktype(linktype)
 
     def _ethernet_decode(self, packet_in):
-        """Extract the ethernet header, returning the ethernet header and
-        the remaining parts of the packet.
+        """Extract the ethernet header, returning the destination and source
+        MAC addresses and the ethertype.
 
         :param str packet_in: The full packet
         :returns: tuple
 
         """
-        return (self._format_bytes(packet_in[0:6], ':'),
-                self._format_bytes(packet_in[6:12], ':'),
-                packet_in[12:14],
-                packet_in[14:])
+        dest, source, ethertype = _ETHERNET_HEADER.unpack_from(packet_in)
+        return (self._format_bytes(dest, ':'),
+                self._format_bytes(source, ':'),
+                ethertype)
+
+    def _flush(self):
+        """Hand the current batch of TCP segments to the decoder queue and
+        start a new one.
+
+        """
+        self._queue.put(self._batch)
+        self._batch = list()
+
+    def stats(self):
+        """Return the packet counters of the packet source, if it keeps
+        any.
+
+        :returns: dict
+
+        """
+        return dict()
 
     def _format_bytes(self, value, delimiter=''):
         """Format a byte string returning the formatted value with the
@@ -81,78 +230,401 @@ class TCPCapture(object):
         """
         return delimiter.join(['%0.2x' % ord(byte) for byte in value])
 
-    def _ipv4_decode(self, packet_in):
-        """Extract the IP header and populate a dictionary of values, returning
-        a the dictionary and the remaining data to extract.
+    def _ipv4_decode(self, packet_in, offset):
+        """Extract the IP header starting at offset and populate a dictionary
+        of values.
 
-        :param str packet_in: The IP packet data
-        :returns: tuple
+        :param str packet_in: The full packet
+        :param int offset: The offset of the IPv4 header in the packet
+        :returns: dict
 
         """
-        out = {'version': struct.unpack('b', packet_in[0])[0] >> 4,
-               'ihl': (struct.unpack('b', packet_in[0])[0] & 0x0F) * 4,
-               'total_length': ntohs(struct.unpack('H', packet_in[2:4])[0]),
-               'identification': ntohs(struct.unpack('H', packet_in[4:6])[0]),
-               'flags': (ord(packet_in[6]) & 0xe0) >> 5,
-               'fragment_offset': (ntohs(struct.unpack('H',
-                                                       packet_in[6:8])[0]) &
-                                   0x1f),
-               'ttl': ord(packet_in[8]),
-               'protocol': ord(packet_in[9]),
-               'checksum': ntohs(struct.unpack('H', packet_in[10:12])[0]),
-               'source': pcap.ntoa(struct.unpack('i', packet_in[12:16])[0]),
-               'destination': pcap.ntoa(struct.unpack('i',
-                                                      packet_in[16:20])[0])}
+        (version_ihl, tos, total_length, identification, flags_fragment, ttl,
+         protocol, checksum, source,
+         destination) = _IPV4_HEADER.unpack_from(packet_in, offset)
+        out = {'version': version_ihl >> 4,
+               'ihl': (version_ihl & 0x0F) * 4,
+               'total_length': total_length,
+               'identification': identification,
+               'flags': flags_fragment >> 13,
+               'fragment_offset': flags_fragment & 0x1fff,
+               'ttl': ttl,
+               'protocol': protocol,
+               'checksum': checksum,
+               'source': inet_ntoa(source),
+               'destination': inet_ntoa(destination)}
 
         # If our header size is more than 5 bytes, we have options
         if out['ihl'] > _IPV4_BASE_HEADER_SIZE:
-            out['options'] = packet_in[_IPV4_BASE_HEADER_SIZE:out['ihl']]
+            out['options'] = packet_in[offset + _IPV4_BASE_HEADER_SIZE:
+                                       offset + out['ihl']]
         else:
             out['options'] = None
 
-        # Return the decoded packet
-        return out, packet_in[out['ihl']:]
+        # Return the decoded header
+        return out
 
-    def _process_packet(self, packet_length, packet_in, timestamp):
-        """Called by libpcap's dispatch call, we receive raw data that needs
-        to be decoded then appended to the tcp buffer. When a full IP packet
-        is received, construct the TCP header dictionary.
+    def _ipv6_decode(self, packet_in, offset):
+        """Extract the IPv6 header starting at offset and populate a
+        dictionary of values.
+
+        :param str packet_in: The full packet
+        :param int offset: The offset of the IPv6 header in the packet
+        :returns: dict
+
+        """
+        (version_class_flow, payload_length, next_header, hop_limit, source,
+         destination) = _IPV6_HEADER.unpack_from(packet_in, offset)
+        return {'version': version_class_flow >> 28,
+                'traffic_class': (version_class_flow >> 20) & 0xff,
+                'flow_label': version_class_flow & 0xfffff,
+                'payload_length': payload_length,
+                'next_header': next_header,
+                'hop_limit': hop_limit,
+                'source': inet_ntop(AF_INET6, source),
+                'destination': inet_ntop(AF_INET6, destination)}
+
+    def _log_headers(self, packet_in, ip_offset, tcp_offset):
+        """Decode and log the full Ethernet, IP and TCP headers of a packet.
+        Only called when debug logging is enabled.
+
+        :param str packet_in: The full packet
+        :param int ip_offset: The offset of the IP header in the packet
+        :param int tcp_offset: The offset of the TCP header in the packet
+
+        """
+        if self._linktype == LINKTYPE_ETHERNET:
+            dest, source, ethertype = self._ethernet_decode(packet_in)
+            self._logger.debug(('Destination MAC Address: %s '
+                                'Source MAC Address: %s'), dest, source)
+        if ord(packet_in[ip_offset]) >> 4 == 4:
+            self._logger.debug('IPv4 Header: %r',
+                               self._ipv4_decode(packet_in, ip_offset))
+        else:
+            self._logger.debug('IPv6 Header: %r',
+                               self._ipv6_decode(packet_in, ip_offset))
+        self._logger.debug('TCP Header: %r',
+                           self._tcp_decode(packet_in, tcp_offset))
+
+    def _process_ethernet(self, packet_length, packet_in, timestamp):
+        """Called by libpcap's dispatch call for Ethernet frames. Untagged
+        IPv4, the common case, is decoded here without a call for each
+        layer: only the fields needed to find the TCP payload are unpacked,
+        straight from the packet with precompiled structs, so the only copy
+        made is of the payload itself. Any other ethertype is handed on.
 
         :param int packet_length: The length of the packet received
         :param str packet_in: The packet to be processed
         :param float timestamp: The timestamp the packet was received
 
         """
-        # Extract the parts of the packet
-        dest, source, ethertype, payload = self._ethernet_decode(packet_in)
-        self._logger.debug(('Destination MAC Address: %s '
-                            'Source MAC Address: %s'), dest, source)
+        try:
+            # Hand on tagged frames and other protocols
+            ethertype = _ETHERTYPE.unpack_from(packet_in)[0]
+            if ethertype != _ETHERTYPE_IPV4:
+                self._process_ethertype(packet_in, ethertype,
+                                        _ETHERNET_HEADER_SIZE, timestamp)
+                return
+
+            # Get the header length, packet length, protocol and addresses
+            version_ihl, total_length, protocol, source, destination = \
+                _IPV4_FAST_HEADER.unpack_from(packet_in, _ETHERNET_HEADER_SIZE)
+            if protocol != IPPROTO_TCP:
+                return
+
+            # Find the TCP payload using the TCP data offset
+            tcp_offset = _ETHERNET_HEADER_SIZE + (version_ihl & 0x0F) * 4
+            source_port, dest_port, sequence, data_offset, flags = \
+                _TCP_FAST_HEADER.unpack_from(packet_in, tcp_offset)
+
+        except struct.error:
+            self._logger.debug('Skipping truncated packet: %r', packet_in)
+            return
+
+        # The IPv4 total length excludes any ethernet frame padding
+        self._add_segment(packet_in, timestamp, _ETHERNET_HEADER_SIZE,
+                          tcp_offset, _ETHERNET_HEADER_SIZE + total_length,
+                          source, source_port, destination, dest_port,
+                          sequence, data_offset, flags)
+
+    def _process_ethertype(self, packet_in, ethertype, offset, timestamp):
+        """Skip any 802.1Q VLAN and QinQ tags at offset and hand the IPv4 or
+        IPv6 packet after them to its decoder.
 
-        # If we have an IPv4 ethertype, process it
+        :param str packet_in: The packet to be processed
+        :param int ethertype: The ethertype of the link layer header
+        :param int offset: The offset the link layer header ends at
+        :param float timestamp: The timestamp the packet was received
+
+        """
+        try:
+            while ethertype in _VLAN_ETHERTYPES:
+                ethertype = _VLAN_ETHERTYPE.unpack_from(packet_in, offset)[0]
+                offset += _VLAN_TAG_SIZE
+        except struct.error:
+            self._logger.debug('Skipping truncated packet: %r', packet_in)
+            return
         if ethertype == _ETHERTYPE_IPV4:
+            self._process_ipv4(packet_in, offset, timestamp)
+        elif ethertype == _ETHERTYPE_IPV6:
+            self._process_ipv6(packet_in, offset, timestamp)
+
+    def _process_ipv4(self, packet_in, offset, timestamp):
+        """Decode the IPv4 packet at offset and append its TCP segment to
+        the batch. Only the fields needed to find the TCP payload are
+        unpacked, straight from the packet with precompiled structs, so the
+        only copy made is of the payload itself.
+
+        :param str packet_in: The packet to be processed
+        :param int offset: The offset of the IPv4 header in the packet
+        :param float timestamp: The timestamp the packet was received
+
+        """
+        try:
+            # Get the header length, packet length, protocol and addresses
+            version_ihl, total_length, protocol, source, destination = \
+                _IPV4_FAST_HEADER.unpack_from(packet_in, offset)
+            if protocol != IPPROTO_TCP:
+                return
+
+            # Find the TCP payload using the TCP data offset
+            tcp_offset = offset + (version_ihl & 0x0F) * 4
+            source_port, dest_port, sequence, data_offset, flags = \
+                _TCP_FAST_HEADER.unpack_from(packet_in, tcp_offset)
+
+        except struct.error:
+            self._logger.debug('Skipping truncated packet: %r', packet_in)
+            return
+
+        # The IPv4 total length excludes any ethernet frame padding
+        self._add_segment(packet_in, timestamp, offset, tcp_offset,
+                          offset + total_length, source, source_port,
+                          destination, dest_port, sequence, data_offset, flags)
+
+    def _process_ipv6(self, packet_in, offset, timestamp):
+        """Decode the IPv6 packet at offset, skipping any extension headers
+        in front of the TCP header, and append its TCP segment to the batch.
+        The addresses are kept as 128 bit integers, as IPv4 addresses are
+        kept as 32 bit ones.
+
+        :param str packet_in: The packet to be processed
+        :param int offset: The offset of the IPv6 header in the packet
+        :param float timestamp: The timestamp the packet was received
+
+        """
+        try:
+            (payload_length, next_header, source_high, source_low,
+             destination_high,
+             destination_low) = _IPV6_FAST_HEADER.unpack_from(packet_in,
+                                                              offset)
+
+            # Walk the extension headers up to the TCP header
+            tcp_offset = offset + _IPV6_HEADER_SIZE
+            while next_header != IPPROTO_TCP:
+                if next_header in _IPV6_EXTENSIONS:
+                    next_header, length = _IPV6_EXTENSION.unpack_from(
+                        packet_in, tcp_offset)
+                    tcp_offset += (length + 1) * 8
+                elif next_header == _IPV6_FRAGMENT:
+                    next_header, fragment = _IPV6_FRAGMENT_HEADER.unpack_from(
+                        packet_in, tcp_offset)
+                    if fragment & _IPV6_FRAGMENT_OFFSET:
+                        return
+                    tcp_offset += _IPV6_FRAGMENT_SIZE
+                elif next_header == _IPV6_AUTHENTICATION:
+                    next_header, length = _IPV6_EXTENSION.unpack_from(
+                        packet_in, tcp_offset)
+                    tcp_offset += (length + 2) * 4
+                else:
+                    return
+
+            # Find the TCP payload using the TCP data offset
+            source_port, dest_port, sequence, data_offset, flags = \
+                _TCP_FAST_HEADER.unpack_from(packet_in, tcp_offset)
+
+        except struct.error:
+            self._logger.debug('Skipping truncated packet: %r', packet_in)
+            return
+
+        source = (source_high << 64) | source_low
+        destination = (destination_high << 64) | destination_low
+
+        # The IPv6 payload length excludes any ethernet frame padding
+        self._add_segment(packet_in, timestamp, offset, tcp_offset,
+                          offset + _IPV6_HEADER_SIZE + payload_length,
+                          source, source_port, destination, dest_port,
+                          sequence, data_offset, flags)
+
+    def _add_segment(self, packet_in, timestamp, ip_offset, tcp_offset,
+                     payload_end, source, source_port, destination,
+                     dest_port, sequence, data_offset, flags):
+        """Append the TCP segment of a decoded packet to the batch unless
+        its connection is not sampled, handing the batch off when it is
+        full.
+
+        :param str packet_in: The packet to be processed
+        :param float timestamp: The timestamp the packet was received
+        :param int ip_offset: The offset of the IP header in the packet
+        :param int tcp_offset: The offset of the TCP header in the packet
+        :param int payload_end: The offset the IP packet ends at
+        :param int source: The source address
+        :param int source_port: The source port
+        :param int destination: The destination address
+        :param int dest_port: The destination port
+        :param int sequence: The TCP sequence number
+        :param int data_offset: The TCP data offset byte
+        :param int flags: The TCP flags
+
+        """
+        # Drop the connections that are not sampled before anything else
+        if self._sample > 1 and not sampling.keep(self._sample, source,
+                                                  source_port, destination,
+                                                  dest_port):
+            return
+
+        # Log the full header values
+        if self._debug:
+            self._log_headers(packet_in, ip_offset, tcp_offset)
+
+        # Add the TCP segment to the batch, handing it off when it is full
+        payload_offset = tcp_offset + (data_offset >> 4) * 4
+        if payload_offset < payload_end or flags & _TCP_FIN_SYN_RST:
+            if not self._batch:
+                self._flush_deadline = time.time() + self._flush_interval
+            self._batch.append((timestamp, source, source_port, destination,
+                                dest_port, sequence, flags,
+                                packet_in[payload_offset:payload_end]))
+            if len(self._batch) >= self._batch_size:
+                self._flush()
+
+    def _process_sll(self, packet_length, packet_in, timestamp):
+        """Called by libpcap's dispatch call for Linux cooked capture
+        packets, as captured on the any device.
+
+        :param int packet_length: The length of the packet received
+        :param str packet_in: The packet to be processed
+        :param float timestamp: The timestamp the packet was received
+
+        """
+        try:
+            ethertype = _SLL_PROTOCOL.unpack_from(packet_in)[0]
+        except struct.error:
+            self._logger.debug('Skipping truncated packet: %r', packet_in)
+            return
+        self._process_ethertype(packet_in, ethertype, _SLL_HEADER_SIZE,
+                                timestamp)
 
-            # Process the IPv4 Header
-            ipv4_header, ipv4_payload = self._ipv4_decode(payload)
+    def _process_sll2(self, packet_length, packet_in, timestamp):
+        """Called by libpcap's dispatch call for version 2 Linux cooked
+        capture packets.
 
-            # Log the IPv4 Header values
-            self._logger.debug('IPv4 Header: %r', ipv4_header)
+        :param int packet_length: The length of the packet received
+        :param str packet_in: The packet to be processed
+        :param float timestamp: The timestamp the packet was received
 
-            # Determine how to decode
-            if ipv4_header['protocol'] == IPPROTO_TCP:
+        """
+        try:
+            ethertype = _SLL2_PROTOCOL.unpack_from(packet_in)[0]
+        except struct.error:
+            self._logger.debug('Skipping truncated packet: %r', packet_in)
+            return
+        self._process_ethertype(packet_in, ethertype, _SLL2_HEADER_SIZE,
+                                timestamp)
+
+    def _set_linktype(self, linktype):
+        """Pick the packet decoding for the link layer type of the packet
+        source, once, as _process_packet, so each packet is only checked
+        for the headers that can occur on the link.
+
+        :param int linktype: The link layer type of the packets
+        :raises: ValueError
+
+        """
+        decoders = {LINKTYPE_ETHERNET: self._process_ethernet,
+                    LINKTYPE_LINUX_SLL: self._process_sll,
+                    LINKTYPE_LINUX_SLL2: self._process_sll2}
+        if linktype not in decoders:
+            raise ValueError('Unsupported link type: %i' % linktype)
+        self._linktype = linktype
+        self._process_packet = decoders[linktype]
+
+    def _tcp_decode(self, packet_in, offset):
+        """Extract the TCP header starting at offset and populate a dictionary
+        of values.
+
+        :param str packet_in: The full packet
+        :param int offset: The offset of the TCP header in the packet
+        :returns: dict
+
+        """
+        (source_port, dest_port, sequence, acknowledgement, data_offset,
+         flags) = _TCP_HEADER.unpack_from(packet_in, offset)
+        return {'source_port': source_port,
+                'dest_port': dest_port,
+                'sequence': sequence,
+                'acknowledgement': acknowledgement,
+                'data_offset': (data_offset >> 4) * 4,
+                'flags': flags}
+
+    def process(self):
+        """Start processing packets, passing each to the
+        PacketCapture._process_packet method. Implemented by the capture
+        sources.
+
+        """
+        raise NotImplementedError
+
+    def stop(self):
+        """Causes the blocking listen call to stop."""
+        # Toggle the bool looped on in the listen method
+        self._running = False
+
+        # Log that the processing has been told to stop
+        self._logger.info('Indicated that processing of packets should stop')
 
-                # Decode the TCP Header
-                tcp_header, tcp_payload = self._tcp_decode(ipv4_payload)
 
-                # Log the TCP Header values
-                self._logger.debug('TCP Header: %r', tcp_header)
+class TCPCapture(PacketCapture):
+    """Captures packets from a network device with libpcap"""
 
-                # Add the TCP data to the Queue for decoding
-                if tcp_payload:
-                    self._queue.put(tcp_payload)
+    def __init__(self, queue, device, port=_MEMCACHED_PORT,
+                 batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 responses=False, servers=None, sample=1):
+        """Create a new TCPCapture object for the given device and ports.
+        When sampling, the connections are picked by the BPF filter where
+        libpcap supports it, and after the headers are read where not. The
+        packets are decoded for the link type of the device.
 
-    def _setup_libpcap(self, device, port):
+        :param Queue queue: The cross-thread queue to create
+        :param str device: The device name (eth0, en1, etc)
+        :param int|list port: The port or ports to listen on
+        :param int batch_size: Max packets per dispatch and payloads per batch
+        :param float flush_interval: Max seconds a partial batch waits
+        :param bool responses: Capture server responses as well as requests
+        :param list servers: The server addresses to listen for
+        :param int sample: Keep 1 in this many connections
+        :raises: ValueError
+
+        """
+        super(TCPCapture, self).__init__(queue, batch_size, flush_interval,
+                                         sample)
+
+        # Create the PCAP object
+        if isinstance(port, int):
+            port = [port]
+        self._pcap = self._setup_libpcap(device, port, responses, servers)
+
+        # The libpcap counters, added up across wraps
+        self._stats = {'received': 0, 'dropped': 0, 'ifdropped': 0}
+        self._last_stats = (0, 0, 0)
+        self._stats_deadline = 0
+
+    def _setup_libpcap(self, device, ports, responses=False, servers=None):
         """Setup the pcap object and return the handle for it.
 
+        :param str device: The device name (eth0, en1, etc)
+        :param list ports: The ports to listen on
+        :param bool responses: Capture server responses as well as requests
+        :param list servers: The server addresses to listen for
         :returns: pcap.pcapObject
 
         """
@@ -170,12 +642,38 @@ class TCPCapture(object):
         except Exception as error:
             raise OSError('Permission error opening device %s' % error)
 
-        # Set our filter up
-        filter = 'dst port %i' % port
+        # Decode the packets for the link type of the device, which can
+        # carry VLAN tagged frames if it is Ethernet
+        self._set_linktype(pcap_object.datalink())
+        self._logger.info('Link type: %i', self._linktype)
+        vlan = self._linktype == LINKTYPE_ETHERNET
+
+        # Set our filter up, responses come from the servers and ports
+        filter = bpf_filter(ports, servers, responses)
+
+        # Sample in the kernel if libpcap can compile the flow hash, leaving
+        # nothing for the packet decoding to drop
+        if self._sample > 1:
+            sampled = '(%s) and %s' % (filter,
+                                       sampling.bpf_sample(self._sample))
+            if vlan:
+                sampled = bpf_vlan(sampled)
+            try:
+                pcap_object.setfilter(sampled, 1, 0)
+            except Exception as error:
+                self._logger.warning('Sampling after capture, libpcap can not '
+                                     'compile the sampling filter: %s', error)
+            else:
+                self._logger.info('Filter set to: %s', sampled)
+                self._sample = 1
+                filter = None
 
         # Create our pcap filter looking for ip packets for the memcached server
-        pcap_object.setfilter(filter, 1, 0)
-        self._logger.info('Filter set to: %s', filter)
+        if filter:
+            if vlan:
+                filter = bpf_vlan(filter)
+            pcap_object.setfilter(filter, 1, 0)
+            self._logger.info('Filter set to: %s', filter)
 
         # Set our operation to non-blocking
         pcap_object.setnonblock(1)
@@ -183,21 +681,6 @@ class TCPCapture(object):
         # Return the handle to the pcap object
         return pcap_object
 
-    def _tcp_decode(self, packet_in):
-        """Extract the TCP header and populate a dictionary of values, returning
-        a the dictionary and the remaining data to extract.
-
-        :param str packet_in: The TCP packet data
-        :returns: tuple
-
-        """
-        self._logger.debug('TCP Packet: %r', packet_in)
-        out = {'source_port': ntohs(struct.unpack('H', packet_in[0:2])[0]),
-               'dest_port': ntohs(struct.unpack('H', packet_in[2:4])[0]),
-               'data_offset': struct.unpack('B', packet_in[12])[0] >> 4}
-        return out, self._char_conversion(packet_in[(_TCP_BASE_HEADER_SIZE +
-                                                     out['data_offset']):])
-
     def _validate_device(self, device_name):
         """Validate the given device name as being available to the application.
         While this is more hoops than just pcap.lookupdev, we can get a full
@@ -231,9 +714,31 @@ class TCPCapture(object):
         # It was not found
         return False
 
+    def _collect_stats(self):
+        """Read the libpcap counters of packets received, dropped by the
+        kernel and dropped by the interface, adding what they went up by
+        since the last read to the totals.
+
+        """
+        current = self._pcap.stats()[:3]
+        for name, value, last in zip(['received', 'dropped', 'ifdropped'],
+                                     current, self._last_stats):
+            self._stats[name] += (value - last) % _COUNTER_WRAP
+        self._last_stats = current
+        self._stats_deadline = time.time() + _STATS_INTERVAL
+
+    def stats(self):
+        """Return the packets received, dropped by the kernel and dropped
+        by the interface as last read from libpcap.
+
+        :returns: dict
+
+        """
+        return dict(self._stats)
+
     def process(self):
         """Start processing packets, dispatching received packets to the
-        TCPCapture._process_raw_data method.
+        TCPCapture._process_packet method.
 
         Will loop as long as self._running is True
 
@@ -244,13 +749,17 @@ class TCPCapture(object):
         # Iterate as long as we're processing
         while self._running:
 
-            # Dispatch the reading of packets, as many as we can get
-            self._pcap.dispatch(1, self._process_packet)
+            # Dispatch the reading of packets, up to a batch at a time
+            self._pcap.dispatch(self._batch_size, self._process_packet)
 
-    def stop(self):
-        """Causes the blocking listen call to stop."""
-        # Toggle the bool looped on in the listen method
-        self._running = False
+            # Don't let a partial batch wait on more traffic for too long
+            now = time.time()
+            if self._batch and now >= self._flush_deadline:
+                self._flush()
+            if now >= self._stats_deadline:
+                self._collect_stats()
 
-        # Log that the processing has been told to stop
-        self._logger.info('Indicated that processing of packets should stop')
+        # Hand off whatever is left
+        if self._batch:
+            self._flush()
+        self._collect_stats()
@@ -0,0 +1,260 @@
+"""
+Streaming writers for gather mode
+
+Gather mode turns each decoder snapshot it reads into a record of what
+happened since the last one, the requests, hits, misses and value bytes of
+each command, and writes it as soon as it is made. Only the previous
+snapshot is kept, and only the most used keys are tracked unless asked
+otherwise, so memory use does not grow with the length of the run.
+Each record is rendered in full and written with a single call into the
+file buffer, which is flushed every few seconds and on close rather than
+after each record, so the disk is written to in bulk. A reader tailing the
+file may find the last record cut short by the end of the buffer until the
+next flush completes it.
+
+The binary format starts with a magic number and version, followed by
+records that are each prefixed with their length, so a reader can skip
+records it does not understand.
+
+"""
+import cStringIO
+import csv
+import json
+import struct
+import sys
+import time
+
+# The columns of each csv row, one row per command in each record
+CSV_FIELDS = ['timestamp', 'seconds', 'command', 'requests', 'hits',
+              'misses', 'value_bytes']
+
+# The counters of each command in a record, in the order they are written
+_COUNTERS = ['requests', 'hits', 'misses', 'value_bytes']
+
+# The snapshot totals each counter is taken from
+_TOTALS = [('requests', 'counts'), ('hits', 'hits'), ('misses', 'misses'),
+           ('value_bytes', 'value_bytes')]
+
+# The binary file header, and the parts of each binary record
+BINARY_MAGIC = 'MNWT'
+BINARY_VERSION = 1
+_BINARY_HEADER = struct.Struct('!4sH')
+_RECORD_LENGTH = struct.Struct('!I')
+_RECORD_HEADER = struct.Struct('!ddH')
+_COMMAND_NAME = struct.Struct('!B')
+_COMMAND_COUNTERS = struct.Struct('!QQQQ')
+
+# The size of the file buffer, enough for the records of many intervals,
+# and the seconds between flushes of it
+_BUFFER_SIZE = 65536
+FLUSH_INTERVAL = 10.0
+
+# The most used keys tracked while streaming records, which only report
+# totals, so the key tables stay the same size however long the run
+TOP_KEYS = 1000
+
+
+def interval_record(previous, snapshot):
+    """Return the record of what happened between two decoder snapshots,
+    the counters of each command that saw any use in that time.
+
+    :param dict previous: The earlier snapshot, None to count from the
+        start of decoding
+    :param dict snapshot: The later snapshot
+    :returns: dict
+
+    """
+    commands = dict()
+    for command, total in snapshot['counts'].iteritems():
+        counters = dict()
+        for name, source in _TOTALS:
+            counters[name] = snapshot[source].get(command, 0)
+            if previous:
+                counters[name] -= previous[source].get(command, 0)
+        if any(counters.values()):
+            commands[command] = counters
+    start = previous['timestamp'] if previous else snapshot['started']
+    return {'timestamp': snapshot['timestamp'],
+            'seconds': snapshot['timestamp'] - start,
+            'commands': commands}
+
+
+def read_binary(handle):
+    """Iterate over the records of a binary gather file.
+
+    :param file handle: The file to read, opened in binary mode
+    :returns: generator
+    :raises: ValueError
+
+    """
+    magic, version = _BINARY_HEADER.unpack(
+        handle.read(_BINARY_HEADER.size))
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError('Not a version %i menwith binary file' %
+                         BINARY_VERSION)
+    while True:
+        prefix = handle.read(_RECORD_LENGTH.size)
+        if len(prefix) < _RECORD_LENGTH.size:
+            return
+        length = _RECORD_LENGTH.unpack(prefix)[0]
+        data = handle.read(length)
+        if len(data) < length:
+            return
+        timestamp, seconds, count = _RECORD_HEADER.unpack_from(data)
+        offset = _RECORD_HEADER.size
+        commands = dict()
+        for index in xrange(count):
+            size = _COMMAND_NAME.unpack_from(data, offset)[0]
+            offset += _COMMAND_NAME.size
+            command = data[offset:offset + size]
+            offset += size
+            commands[command] = dict(zip(_COUNTERS,
+                                         _COMMAND_COUNTERS.unpack_from(
+                                             data, offset)))
+            offset += _COMMAND_COUNTERS.size
+        yield {'timestamp': timestamp,
+               'seconds': seconds,
+               'commands': commands}
+
+
+class Writer(object):
+    """Writes a record of each new decoder snapshot it is given. Extended by
+    each output format, which renders the records.
+
+    """
+    BINARY = False
+
+    def __init__(self, path=None, flush_interval=FLUSH_INTERVAL):
+        """Create a new Writer, writing to the file at path, or to stdout
+        if no path is given.
+
+        :param str path: The file to write to
+        :param float flush_interval: The seconds between flushes
+
+        """
+        if path:
+            self._handle = open(path, 'wb' if self.BINARY else 'w',
+                                _BUFFER_SIZE)
+        else:
+            self._handle = sys.stdout
+        self._previous = None
+        self._flush_interval = flush_interval
+        self._flush_deadline = time.time() + flush_interval
+        self._write(self._header())
+
+    def _header(self):
+        """Return what is written at the start of the output.
+
+        :returns: str
+
+        """
+        return ''
+
+    def _render(self, record):
+        """Return the record as it is written.
+
+        :param dict record: The record to render
+        :returns: str
+
+        """
+        raise NotImplementedError
+
+    def _write(self, data):
+        """Write the data, if there is any, flushing the file buffer once
+        the flush interval has passed.
+
+        :param str data: The data to write
+
+        """
+        if data:
+            self._handle.write(data)
+        now = time.time()
+        if now >= self._flush_deadline:
+            self._handle.flush()
+            self._flush_deadline = now + self._flush_interval
+
+    def add(self, snapshot):
+        """Write the record of what happened since the last snapshot added,
+        if the snapshot is newer than it.
+
+        :param dict snapshot: The decoder snapshot
+
+        """
+        if not snapshot or snapshot['timestamp'] is None:
+            return
+        if self._previous and \
+                snapshot['timestamp'] <= self._previous['timestamp']:
+            return
+        self._write(self._render(interval_record(self._previous, snapshot)))
+        self._previous = snapshot
+
+    def close(self):
+        """Flush what is left in the file buffer and close the file, unless
+        writing to stdout.
+
+        """
+        self._handle.flush()
+        if self._handle is not sys.stdout:
+            self._handle.close()
+
+
+class CSVWriter(Writer):
+    """Writes a csv row for each command in a record, after a header row."""
+
+    def _rows(self, rows):
+        """Return the rows rendered as csv.
+
+        :param list rows: The rows to render
+        :returns: str
+
+        """
+        buffer = cStringIO.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue()
+
+    def _header(self):
+        return self._rows([CSV_FIELDS])
+
+    def _render(self, record):
+        timestamp = '%.6f' % record['timestamp']
+        seconds = '%.6f' % record['seconds']
+        return self._rows([[timestamp, seconds, command] +
+                           [counters[name] for name in _COUNTERS]
+                           for command, counters in
+                           sorted(record['commands'].iteritems())])
+
+
+class JSONLinesWriter(Writer):
+    """Writes each record as a JSON object on a line of its own."""
+
+    def _render(self, record):
+        return json.dumps(record, sort_keys=True,
+                          separators=(',', ':')) + '\n'
+
+
+class BinaryWriter(Writer):
+    """Writes each record as length prefixed binary, after a header naming
+    the format and its version.
+
+    """
+    BINARY = True
+
+    def _header(self):
+        return _BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION)
+
+    def _render(self, record):
+        parts = [_RECORD_HEADER.pack(record['timestamp'], record['seconds'],
+                                     len(record['commands']))]
+        for command, counters in record['commands'].iteritems():
+            parts.append(_COMMAND_NAME.pack(len(command)))
+            parts.append(command)
+            parts.append(_COMMAND_COUNTERS.pack(*[counters[name]
+                                                  for name in _COUNTERS]))
+        data = ''.join(parts)
+        return _RECORD_LENGTH.pack(len(data)) + data
+
+
+# The writer for each streaming output format
+WRITERS = {'csv': CSVWriter,
+           'jsonl': JSONLinesWriter,
+           'binary': BinaryWriter}
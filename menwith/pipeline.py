@@ -0,0 +1,102 @@
+"""
+Bounded queues between the capture and the decoder
+
+When decoding falls behind the capture, the batches waiting for it are
+limited to a fixed number and the overload policy decides what gives: the
+capture waits for room, leaving any drops to the kernel where libpcap
+counts them, or the newest or oldest batch is dropped. The payloads
+enqueued and dropped are counted so the results can be checked for
+completeness, along with how full the queue has been at its fullest.
+
+"""
+import Queue
+
+# The overload policies
+BLOCK = 'block'
+DROP_NEWEST = 'drop-newest'
+DROP_OLDEST = 'drop-oldest'
+POLICIES = [BLOCK, DROP_NEWEST, DROP_OLDEST]
+
+# The default number of batches waiting to be decoded
+QUEUE_SIZE = 1024
+
+
+class BoundedQueue(Queue.Queue):
+    """A Queue.Queue of segment batches holding at most maxsize batches,
+    applying the overload policy when it is full and counting the segments
+    put on it and dropped.
+
+    """
+    def __init__(self, maxsize=QUEUE_SIZE, policy=BLOCK):
+        """Create a new BoundedQueue.
+
+        :param int maxsize: The most batches waiting at once
+        :param str policy: What to do with a batch when the queue is full
+        :raises: ValueError
+
+        """
+        if policy not in POLICIES:
+            raise ValueError('Unknown overload policy: %s' % policy)
+        Queue.Queue.__init__(self, maxsize)
+        self.policy = policy
+        self.closed = False
+        self.enqueued = 0
+        self.dropped = 0
+        self.peak = 0
+
+    def close(self):
+        """Mark the queue as no longer read, so batches are dropped instead
+        of waiting for room that will never come.
+
+        """
+        self.not_full.acquire()
+        try:
+            self.closed = True
+            self.not_full.notify_all()
+        finally:
+            self.not_full.release()
+
+    def put(self, batch, block=True, timeout=None):
+        """Add a batch of segments, applying the overload policy if the
+        queue is full.
+
+        :param list batch: The segments to add
+        :param bool block: Unused, the policy decides whether to wait
+        :param float timeout: Unused, the policy decides whether to wait
+
+        """
+        self.not_full.acquire()
+        try:
+            if self._qsize() >= self.maxsize:
+                if self.policy == DROP_NEWEST:
+                    self.dropped += len(batch)
+                    return
+                if self.policy == DROP_OLDEST:
+                    self.dropped += len(self._get())
+                    self.unfinished_tasks -= 1
+                else:
+                    while self._qsize() >= self.maxsize and not self.closed:
+                        self.not_full.wait()
+            if self.closed:
+                self.dropped += len(batch)
+                return
+            self._put(batch)
+            self.unfinished_tasks += 1
+            self.enqueued += len(batch)
+            self.peak = max(self.peak, self._qsize())
+            self.not_empty.notify()
+        finally:
+            self.not_full.release()
+
+    def stats(self):
+        """Return the overload policy, the payloads enqueued, including
+        those later dropped as the oldest, the payloads dropped and the
+        largest share of the queue that has been in use.
+
+        :returns: dict
+
+        """
+        return {'policy': self.policy,
+                'enqueued': self.enqueued,
+                'dropped': self.dropped,
+                'peak_fill': float(self.peak) / self.maxsize}
@@ -0,0 +1,328 @@
+"""
+Replay tcpdump capture files through the decode pipeline
+
+Classic pcap and pcapng files are memory mapped and their records walked in
+place, each packet being handed to the decoder as a zero-copy buffer of the
+map. The link type is read once, when the file is opened, to pick how the
+packets are decoded.
+
+"""
+import logging
+import mmap
+import struct
+import time
+
+from . import network
+
+# Classic pcap constants
+_PCAP_MAGIC_MICROSECONDS = 0xa1b2c3d4
+_PCAP_MAGIC_NANOSECONDS = 0xa1b23c4d
+_PCAP_HEADER_SIZE = 24
+_PCAP_RECORD_SIZE = 16
+
+# pcapng constants
+_PCAPNG_SECTION_HEADER = 0x0a0d0d0a
+_PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+_PCAPNG_INTERFACE_DESCRIPTION = 0x00000001
+_PCAPNG_OBSOLETE_PACKET = 0x00000002
+_PCAPNG_SIMPLE_PACKET = 0x00000003
+_PCAPNG_ENHANCED_PACKET = 0x00000006
+_PCAPNG_OPTION_END = 0
+_PCAPNG_OPTION_TSRESOL = 9
+
+
+class PcapFile(object):
+    """Memory maps a classic pcap or pcapng file and iterates over the
+    packets in it without copying them. The packets of a pcapng file are
+    those of the interfaces with the link type of the first.
+
+    """
+    def __init__(self, path):
+        """Open and map the capture file at path.
+
+        :param str path: The path to the capture file
+        :raises: ValueError
+
+        """
+        self._logger = logging.getLogger('menwith.replay.PcapFile')
+        self._handle = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._handle.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except ValueError:
+            self._handle.close()
+            raise ValueError('Can not replay the empty file %s' % path)
+
+        # Determine the format from the first four bytes
+        magic = self._map[0:4]
+        if len(magic) < 4:
+            self.close()
+            raise ValueError('%s is not a pcap or pcapng file' % path)
+        if struct.unpack('<I', magic)[0] == _PCAPNG_SECTION_HEADER:
+            self.packets = self._pcapng_packets
+            self.linktype = self._pcapng_linktype()
+            if self.linktype not in network.LINKTYPES:
+                self.close()
+                raise ValueError('Unsupported link type: %s' % self.linktype)
+            return
+        for endian in '<>':
+            if struct.unpack(endian + 'I', magic)[0] in \
+                    (_PCAP_MAGIC_MICROSECONDS, _PCAP_MAGIC_NANOSECONDS):
+                self._endian = endian
+                self.packets = self._pcap_packets
+                break
+        else:
+            self.close()
+            raise ValueError('%s is not a pcap or pcapng file' % path)
+
+        # Classic pcap files have a single link type for every packet
+        self.linktype = struct.unpack_from(self._endian + '20xI',
+                                           self._map)[0]
+        if self.linktype not in network.LINKTYPES:
+            self.close()
+            raise ValueError('Unsupported link type: %i' % self.linktype)
+
+    def _pcapng_linktype(self):
+        """Return the link type of the first interface description block of
+        a pcapng file, or None if it has none.
+
+        :returns: int
+
+        """
+        data = self._map
+        size = len(data)
+        offset = 0
+        endian = '<'
+        while offset + 12 <= size:
+            if struct.unpack_from('<I', data, offset)[0] == \
+                    _PCAPNG_SECTION_HEADER:
+                order = struct.unpack_from('<I', data, offset + 8)[0]
+                endian = '<' if order == _PCAPNG_BYTE_ORDER_MAGIC else '>'
+            block_type, block_length = struct.unpack_from(endian + 'II', data,
+                                                          offset)
+            if block_length < 12:
+                break
+            if block_type == _PCAPNG_INTERFACE_DESCRIPTION:
+                return struct.unpack_from(endian + 'H', data, offset + 8)[0]
+            offset += block_length
+        return None
+
+    def _pcap_packets(self):
+        """Iterate over the records of a classic pcap file, yielding the
+        timestamp, original length and a buffer of the captured bytes of
+        each packet.
+
+        :returns: generator
+
+        """
+        data = self._map
+        magic = struct.unpack_from(self._endian + 'I', data)[0]
+        if magic == _PCAP_MAGIC_NANOSECONDS:
+            resolution = 1e-9
+        else:
+            resolution = 1e-6
+
+        record = struct.Struct(self._endian + 'IIII')
+        unpack_from = record.unpack_from
+        size = len(data)
+        offset = _PCAP_HEADER_SIZE
+        while offset + _PCAP_RECORD_SIZE <= size:
+            seconds, fraction, captured, length = unpack_from(data, offset)
+            offset += _PCAP_RECORD_SIZE
+            if offset + captured > size:
+                break
+            yield (seconds + fraction * resolution, length,
+                   buffer(data, offset, captured))
+            offset += captured
+
+    def _pcapng_packets(self):
+        """Iterate over the packet blocks of a pcapng file, yielding the
+        timestamp, original length and a buffer of the captured bytes of
+        each packet. Simple packet blocks carry no timestamp and are yielded
+        with the timestamp of the previous packet.
+
+        :returns: generator
+
+        """
+        data = self._map
+        size = len(data)
+        offset = 0
+        endian = '<'
+        interfaces = list()
+        timestamp = 0.0
+        while offset + 12 <= size:
+
+            # The section header block defines the byte order that follows
+            if struct.unpack_from('<I', data, offset)[0] == \
+                    _PCAPNG_SECTION_HEADER:
+                order = struct.unpack_from('<I', data, offset + 8)[0]
+                if order == _PCAPNG_BYTE_ORDER_MAGIC:
+                    endian = '<'
+                else:
+                    endian = '>'
+                block = struct.Struct(endian + 'II')
+                enhanced = struct.Struct(endian + 'IIIII')
+                obsolete = struct.Struct(endian + 'HHIIII')
+                interfaces = list()
+
+            block_type, block_length = block.unpack_from(data, offset)
+            if block_length < 12 or offset + block_length > size:
+                break
+            body = offset + 8
+
+            if block_type == _PCAPNG_ENHANCED_PACKET:
+                (interface, high, low, captured,
+                 length) = enhanced.unpack_from(data, body)
+                if interface >= len(interfaces):
+                    self._skip_packet(interface, offset)
+                    offset += block_length
+                    continue
+                linktype, resolution = interfaces[interface]
+                if linktype == self.linktype:
+                    timestamp = ((high << 32) | low) * resolution
+                    yield timestamp, length, buffer(data, body + 20, captured)
+
+            elif block_type == _PCAPNG_SIMPLE_PACKET:
+                length = struct.unpack_from(endian + 'I', data, body)[0]
+                if interfaces and interfaces[0][0] == self.linktype:
+                    captured = min(length, block_length - 16)
+                    yield timestamp, length, buffer(data, body + 4, captured)
+
+            elif block_type == _PCAPNG_OBSOLETE_PACKET:
+                (interface, drops, high, low, captured,
+                 length) = obsolete.unpack_from(data, body)
+                if interface >= len(interfaces):
+                    self._skip_packet(interface, offset)
+                    offset += block_length
+                    continue
+                linktype, resolution = interfaces[interface]
+                if linktype == self.linktype:
+                    timestamp = ((high << 32) | low) * resolution
+                    yield timestamp, length, buffer(data, body + 20, captured)
+
+            elif block_type == _PCAPNG_INTERFACE_DESCRIPTION:
+                linktype = struct.unpack_from(endian + 'H', data, body)[0]
+                interfaces.append((linktype,
+                                   self._pcapng_resolution(data, endian,
+                                                           body + 8,
+                                                           offset +
+                                                           block_length - 4)))
+
+            offset += block_length
+
+    def _skip_packet(self, interface, offset):
+        """Log a packet block skipped for naming an interface that has not
+        been described in its section.
+
+        :param int interface: The interface id of the packet
+        :param int offset: The offset of the packet block
+
+        """
+        self._logger.debug('Skipped the packet at offset %i of the '
+                           'undescribed interface %i', offset, interface)
+
+    def _pcapng_resolution(self, data, endian, offset, end):
+        """Return the timestamp resolution in seconds from the if_tsresol
+        option of an interface description block, defaulting to
+        microseconds.
+
+        :param mmap data: The mapped file
+        :param str endian: The struct byte order character of the section
+        :param int offset: The offset of the first option
+        :param int end: The offset the options end at
+        :returns: float
+
+        """
+        option = struct.Struct(endian + 'HH')
+        while offset + 4 <= end:
+            code, length = option.unpack_from(data, offset)
+            if code == _PCAPNG_OPTION_END:
+                break
+            if code == _PCAPNG_OPTION_TSRESOL:
+                value = ord(data[offset + 4])
+                if value & 0x80:
+                    return 2.0 ** -(value & 0x7f)
+                return 10.0 ** -value
+            offset += 4 + ((length + 3) & ~3)
+        return 1e-6
+
+    def close(self):
+        """Unmap and close the capture file."""
+        self._map.close()
+        self._handle.close()
+
+
+class ReplayCapture(network.PacketCapture):
+    """Replays a capture file through the same packet decoding used for live
+    capture, either paced by the packet timestamps or as fast as possible.
+
+    """
+    def __init__(self, queue, path, max_speed=False,
+                 batch_size=network.BATCH_SIZE,
+                 flush_interval=network.FLUSH_INTERVAL, sample=1):
+        """Create a new ReplayCapture object for the given file.
+
+        :param Queue queue: The cross-thread queue to create
+        :param str path: The pcap or pcapng file to replay
+        :param bool max_speed: Ignore the packet timestamps
+        :param int batch_size: Max payloads per batch
+        :param float flush_interval: Max seconds a partial batch waits
+        :param int sample: Keep 1 in this many connections
+        :raises: ValueError
+
+        """
+        super(ReplayCapture, self).__init__(queue, batch_size, flush_interval,
+                                            sample)
+        self._file = PcapFile(path)
+        self._set_linktype(self._file.linktype)
+        self._max_speed = max_speed
+        self._logger.info('Replaying %s', path)
+
+    def _wait_until(self, delay):
+        """Hand off the current batch and sleep until delay seconds after
+        the replay started.
+
+        :param float delay: Seconds since the start of the replay
+
+        """
+        if self._batch:
+            self._flush()
+        remaining = self._started + delay - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def process(self):
+        """Replay the packets in the file, exiting when the file is exhausted
+        or we are no longer running.
+
+        """
+        # We want to process
+        self._running = True
+
+        # Avoid the attribute lookup for every packet
+        process_packet = self._process_packet
+
+        try:
+            if self._max_speed:
+                for timestamp, length, packet in self._file.packets():
+                    process_packet(length, packet, timestamp)
+                    if not self._running:
+                        break
+            else:
+                self._started = time.time()
+                first = None
+                for timestamp, length, packet in self._file.packets():
+                    if first is None:
+                        first = timestamp
+                    if timestamp - first > time.time() - self._started:
+                        self._wait_until(timestamp - first)
+                    process_packet(length, packet, timestamp)
+                    if not self._running:
+                        break
+        finally:
+            self._file.close()
+
+        # Hand off whatever is left
+        if self._batch:
+            self._flush()
+        self._logger.info('Replay complete')
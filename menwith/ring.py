@@ -0,0 +1,241 @@
+"""
+Shared memory ring buffers for handing batches to decode worker processes
+
+Each Ring is a single producer, single consumer ring of length prefixed
+records in an anonymous shared memory map created before the worker is
+forked. The producer only ever moves the head and the consumer only ever
+moves the tail, so neither needs a lock. The head and tail are read and
+written as aligned 64 bit integers through ctypes, since struct writes
+them a byte at a time and the other side could see half an update.
+Batches are encoded with marshal, which handles the tuples of numbers and
+strings a batch is made of in C without the overhead of pickle.
+
+A Slot holds only the latest value a worker put in it, for publishing
+something that is read now and then, such as its snapshots, without the
+worker ever waiting on the reader. It is guarded by a sequence number the
+writer makes odd while writing, and a reader that sees it odd or changed
+reads again.
+
+"""
+import ctypes
+import marshal
+import mmap
+import Queue
+import struct
+import time
+
+# The default size of the data area of a ring
+RING_SIZE = 16 * 1048576
+
+# The head and tail are running byte totals, followed by the closed flag
+_HEADER_SIZE = 24
+_TAIL_OFFSET = 8
+_CLOSED_OFFSET = 16
+
+# Records are the padded record length and the encoded batch length,
+# followed by the encoded batch
+_RECORD = struct.Struct('=II')
+_ALIGNMENT = 8
+
+# A zero length record tells the consumer to continue at the start
+_WRAP = _RECORD.pack(0, 0)
+
+# The default size of the data area of a slot, and its header of the
+# sequence number and the length of the encoded value
+SLOT_SIZE = 1048576
+_SLOT_HEADER_SIZE = 16
+_SLOT_LENGTH = struct.Struct('=Q')
+_SLOT_LENGTH_OFFSET = 8
+
+# How long to sleep while waiting for data or for space
+_POLL_INTERVAL = 0.001
+
+
+class Ring(object):
+    """A single producer, single consumer ring of segment batches in shared
+    memory, with the put, get and empty methods the Decoder uses on a
+    Queue.Queue.
+
+    """
+    def __init__(self, size=RING_SIZE):
+        """Create a new Ring with a data area of size bytes.
+
+        :param int size: The size of the data area, a multiple of 8
+
+        """
+        self._size = size - size % _ALIGNMENT
+        self._map = mmap.mmap(-1, _HEADER_SIZE + self._size)
+        self._head = ctypes.c_uint64.from_buffer(self._map, 0)
+        self._tail = ctypes.c_uint64.from_buffer(self._map, _TAIL_OFFSET)
+
+        # The most bytes in use at once, as seen by the producer
+        self.peak = 0
+
+    @property
+    def closed(self):
+        """Return if the consumer has stopped reading the ring.
+
+        :returns: bool
+
+        """
+        return self._map[_CLOSED_OFFSET] != '\x00'
+
+    def close(self):
+        """Mark the ring as no longer read, so the producer drops batches
+        instead of waiting for space that will never come.
+
+        """
+        self._map[_CLOSED_OFFSET] = '\x01'
+
+    def empty(self):
+        """Return if there is nothing waiting to be read.
+
+        :returns: bool
+
+        """
+        return self._head.value == self._tail.value
+
+    def get(self, block=True, timeout=None):
+        """Remove and return the next batch, waiting up to timeout seconds
+        for one to arrive when block is set.
+
+        :param bool block: Wait for a batch if none is waiting
+        :param float timeout: The most seconds to wait
+        :returns: list
+        :raises: Queue.Empty
+
+        """
+        data = self._map
+        tail = self._tail.value
+        deadline = None
+        while self._head.value == tail:
+            if not block:
+                raise Queue.Empty
+            if timeout is not None:
+                if deadline is None:
+                    deadline = time.time() + timeout
+                elif time.time() >= deadline:
+                    raise Queue.Empty
+            time.sleep(_POLL_INTERVAL)
+
+        # Follow a wrap marker back to the start of the data area
+        offset = _HEADER_SIZE + tail % self._size
+        length, size = _RECORD.unpack_from(data, offset)
+        if not length:
+            tail += self._size - tail % self._size
+            offset = _HEADER_SIZE
+            length, size = _RECORD.unpack_from(data, offset)
+        offset += _RECORD.size
+        batch = marshal.loads(data[offset:offset + size])
+
+        # Hand the space back to the producer
+        self._tail.value = tail + length
+        return batch
+
+    @property
+    def size(self):
+        """Return the size of the data area in bytes.
+
+        :returns: int
+
+        """
+        return self._size
+
+    def put(self, batch, block=True):
+        """Add a batch of segments, waiting for space if the ring is full
+        and block is set. The batch is dropped if there is no space and
+        block is not set, or if the consumer has closed the ring.
+
+        :param list batch: The segments to add
+        :param bool block: Wait for space if the ring is full
+        :returns: bool
+        :raises: ValueError
+
+        """
+        encoded = marshal.dumps(batch)
+        size = _RECORD.size + len(encoded)
+        length = size + -size % _ALIGNMENT
+        if length > self._size:
+            raise ValueError('A batch of %i bytes will not fit in a ring of '
+                             '%i bytes' % (length, self._size))
+        record = _RECORD.pack(length, len(encoded)) + encoded
+
+        # Records do not wrap, the space left at the end is skipped instead
+        head = self._head.value
+        remaining = self._size - head % self._size
+        needed = length + remaining if remaining < length else length
+        while self._size - (head - self._tail.value) < needed:
+            if self.closed or not block:
+                return False
+            time.sleep(_POLL_INTERVAL)
+        data = self._map
+        if remaining < length:
+            data[_HEADER_SIZE + head % self._size:
+                 _HEADER_SIZE + head % self._size + _RECORD.size] = _WRAP
+            head += remaining
+        offset = _HEADER_SIZE + head % self._size
+        data[offset:offset + len(record)] = record
+
+        # Publish the record only once it is all written
+        self._head.value = head + length
+        self.peak = max(self.peak, head + length - self._tail.value)
+        return True
+
+
+class Slot(object):
+    """A single producer slot in shared memory holding the latest value put
+    in it. Putting never waits, each value replaces the last whether it was
+    read or not.
+
+    """
+    def __init__(self, size=SLOT_SIZE):
+        """Create a new, empty, Slot with a data area of size bytes.
+
+        :param int size: The size of the data area
+
+        """
+        self._size = size
+        self._map = mmap.mmap(-1, _SLOT_HEADER_SIZE + size)
+        self._sequence = ctypes.c_uint64.from_buffer(self._map, 0)
+
+    def get(self):
+        """Return the number of values put so far and the latest of them,
+        or None if none has been put.
+
+        :returns: tuple
+
+        """
+        data = self._map
+        while True:
+            sequence = self._sequence.value
+            if not sequence:
+                return 0, None
+
+            # Wait out a value being written
+            if sequence & 1:
+                time.sleep(_POLL_INTERVAL)
+                continue
+            size = _SLOT_LENGTH.unpack_from(data, _SLOT_LENGTH_OFFSET)[0]
+            encoded = data[_SLOT_HEADER_SIZE:_SLOT_HEADER_SIZE + size]
+
+            # Only a value that was not replaced while copied is whole
+            if self._sequence.value == sequence:
+                return sequence // 2, marshal.loads(encoded)
+
+    def put(self, value):
+        """Replace the value in the slot, unless it does not fit.
+
+        :param object value: The value, of the types marshal handles
+        :returns: bool
+
+        """
+        encoded = marshal.dumps(value)
+        if len(encoded) > self._size:
+            return False
+        data = self._map
+        sequence = self._sequence.value
+        self._sequence.value = sequence + 1
+        _SLOT_LENGTH.pack_into(data, _SLOT_LENGTH_OFFSET, len(encoded))
+        data[_SLOT_HEADER_SIZE:_SLOT_HEADER_SIZE + len(encoded)] = encoded
+        self._sequence.value = sequence + 2
+        return True
@@ -0,0 +1,170 @@
+"""
+Flow consistent sampling and the estimates scaled up from it
+
+When sampling 1 in N, whole TCP connections are kept or dropped by a hash
+of their addresses and ports. The hash is the same in both directions, so a
+connection's requests and responses are kept or dropped together and the
+streams that are kept can still be reassembled and decoded. A live capture
+makes the decision in the kernel with a BPF expression computing the same
+hash, so the dropped connections cost nothing, and the packet decoding
+makes it right after the headers are read otherwise.
+
+The counts of the sampled connections are scaled up by N. Connections carry
+very different numbers of requests, so the error of the estimates is larger
+than if requests were sampled one by one. The kept connections are split by
+their hash into groups that are each a sample of the traffic of their own,
+and the spread of the group totals measures how much larger, the design
+effect, which widens the confidence bounds of the scaled totals.
+
+"""
+import math
+
+# Multiplying by the golden ratio mixes the xor of the addresses and ports,
+# so the connections kept do not follow how they are sharded to workers,
+# and the top half of the 32 bit product decides whether they are kept
+_HASH_MULTIPLIER = 0x9e3779b1
+_HASH_MASK = 0xffffffff
+_HASH_SHIFT = 16
+
+# The largest sampling factor, one value of the kept half of the hash
+MAX_RATE = 1 << 16
+
+# The number of groups the kept connections are split into, by the top
+# bits of a second round of mixing that the sampling decision does not see
+GROUPS = 16
+_GROUP_SHIFT = 15
+_GROUP_BITS = 28
+
+# The number of standard errors in the 95% confidence bounds
+_Z = 1.96
+
+
+def parse_rate(value):
+    """Return the sampling factor of a 1/N or N sampling rate.
+
+    :param str value: The sampling rate
+    :returns: int
+    :raises: ValueError
+
+    """
+    numerator, separator, denominator = value.partition('/')
+    if not separator:
+        numerator, denominator = '1', numerator
+    if numerator.strip() != '1':
+        raise ValueError('Sampling rate must be 1/N: %s' % value)
+    rate = int(denominator)
+    if not 1 <= rate <= MAX_RATE:
+        raise ValueError('Sampling factor must be 1 to %i: %s' %
+                         (MAX_RATE, value))
+    return rate
+
+
+def _mix(source, source_port, destination, destination_port):
+    """Return the 32 bit hash of a connection, the same in both directions.
+    The xor of IPv6 addresses is folded to 32 bits first, which leaves that
+    of IPv4 addresses as it is.
+
+    :param int source: The source address
+    :param int source_port: The source port
+    :param int destination: The destination address
+    :param int destination_port: The destination port
+    :returns: int
+
+    """
+    addresses = source ^ destination
+    if addresses > _HASH_MASK:
+        addresses ^= addresses >> 64
+        addresses ^= addresses >> 32
+    return ((addresses ^ source_port ^ destination_port) *
+            _HASH_MULTIPLIER) & _HASH_MASK
+
+
+def keep(rate, source, source_port, destination, destination_port):
+    """Return whether the packets of a connection are kept when sampling
+    1 in rate.
+
+    :param int rate: The sampling factor
+    :param int source: The source address
+    :param int source_port: The source port
+    :param int destination: The destination address
+    :param int destination_port: The destination port
+    :returns: bool
+
+    """
+    return not (_mix(source, source_port, destination, destination_port) >>
+                _HASH_SHIFT) % rate
+
+
+def group(source, source_port, destination, destination_port):
+    """Return the group a kept connection is counted in.
+
+    :param int source: The source address
+    :param int source_port: The source port
+    :param int destination: The destination address
+    :param int destination_port: The destination port
+    :returns: int
+
+    """
+    value = _mix(source, source_port, destination, destination_port)
+    return (((value ^ (value >> _GROUP_SHIFT)) * _HASH_MULTIPLIER) &
+            _HASH_MASK) >> _GROUP_BITS
+
+
+def bpf_sample(rate):
+    """Return the BPF expression keeping the IPv4 and IPv6 TCP packets of
+    the connections the flow hash keeps when sampling 1 in rate. BPF
+    arithmetic is unsigned 32 bit, so the multiplication wraps as the mask
+    does, and the words of IPv6 addresses are xored together as the folding
+    does. libpcap only offers the tcp[] accessor for IPv4, so the ports of
+    IPv6 packets are read right after the fixed header, where the TCP header
+    is when the next header is TCP, and those with extension headers are
+    not kept.
+
+    :param int rate: The sampling factor
+    :returns: str
+
+    """
+    hashed = '((((%s) * 0x%x) >> %i) %% %i) = 0'
+    ipv4 = hashed % ('ip[12:4] ^ ip[16:4] ^ tcp[0:2] ^ tcp[2:2]',
+                     _HASH_MULTIPLIER, _HASH_SHIFT, rate)
+    ipv6 = hashed % (' ^ '.join(['ip6[%i:4]' % offset
+                                 for offset in xrange(8, 40, 4)] +
+                                ['ip6[40:2]', 'ip6[42:2]']),
+                     _HASH_MULTIPLIER, _HASH_SHIFT, rate)
+    return '((ip and %s) or (ip6 and ip6[6] = 6 and %s))' % (ipv4, ipv6)
+
+
+def design_effect(rate, groups):
+    """Return how many times larger the variance of the scaled counts is
+    than if requests had been sampled one by one, from the requests counted
+    in each group of connections. Each group is a sample of 1 in rate times
+    the number of groups, so the spread of the groups is scaled back to the
+    sampling factor.
+
+    :param int rate: The sampling factor
+    :param list groups: The requests counted in each group
+    :returns: float
+
+    """
+    total = sum(groups)
+    if rate < 2 or total < 1:
+        return 1.0
+    mean = float(total) / len(groups)
+    variance = (len(groups) * rate * rate *
+                sum([(count - mean) ** 2 for count in groups]) /
+                (len(groups) - 1) * (rate - 1) / (rate - 1.0 / len(groups)))
+    return max(variance / (rate * (rate - 1) * total), 1.0)
+
+
+def bounds(estimate, rate, effect=1.0):
+    """Return the 95% confidence bounds of a count scaled up by the
+    sampling factor. The lower bound is never less than what was counted.
+
+    :param float estimate: The scaled count
+    :param int rate: The sampling factor
+    :param float effect: The design effect
+    :returns: tuple
+
+    """
+    error = _Z * math.sqrt(effect * (rate - 1) * estimate)
+    return max(estimate - error, float(estimate) / rate), estimate + error
@@ -0,0 +1,286 @@
+"""
+Fixed memory summaries of the key stream
+
+SpaceSaving keeps the heavy hitters of an unbounded number of distinct keys
+in a fixed number of counters. Counters are grouped by their count so that
+the least counted key can be replaced in constant time when a new key
+arrives and the summary is full.
+
+HyperLogLog estimates the number of distinct keys seen in a few KB of
+registers, and two of them merge into the estimate for both.
+
+"""
+import heapq
+import math
+import zlib
+
+# The default bound on the overestimate of a count, as a share of all uses
+KEY_ERROR = 0.001
+
+# HyperLogLog registers are indexed by the top bits of a 32 bit hash
+PRECISION = 12
+_HASH_BITS = 32
+_HASH_MASK = 0xffffffff
+_GOLDEN_RATIO = 0x9e3779b1
+_REGISTER_SHIFT = _HASH_BITS - PRECISION
+_REGISTER_MASK = (1 << _REGISTER_SHIFT) - 1
+
+
+def key_hash(key):
+    """Return a 32 bit hash of the raw bytes of the key, the CRC32 of the key
+    multiplied by the golden ratio so that the runs of similar keys CRC32
+    maps to nearby values are spread across every bit of the hash.
+
+    :param str key: The key to hash
+    :returns: int
+
+    """
+    return (zlib.crc32(key) * _GOLDEN_RATIO) & _HASH_MASK
+
+
+def key_register(key):
+    """Return the register index and rank of the key in a HyperLogLog of the
+    default precision, so a key added to several counters is hashed once.
+
+    :param str key: The key to hash
+    :returns: tuple
+
+    """
+    value = (zlib.crc32(key) * _GOLDEN_RATIO) & _HASH_MASK
+    return (value >> _REGISTER_SHIFT,
+            _REGISTER_SHIFT + 1 - (value & _REGISTER_MASK).bit_length())
+
+
+class HyperLogLog(object):
+    """Estimates the number of distinct keys added, using one byte register
+    for each of 2 ** precision buckets, within a standard error of
+    1.04 / sqrt(2 ** precision), 1.6% at the default precision of 12.
+
+    """
+    def __init__(self, precision=PRECISION):
+        """Create a new, empty, HyperLogLog.
+
+        :param int precision: The number of hash bits used to pick a register
+
+        """
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+        self._shift = _HASH_BITS - precision
+        self._mask = (1 << self._shift) - 1
+
+    def add(self, key):
+        """Add a key.
+
+        :param str key: The key to add
+
+        """
+        value = key_hash(key)
+        index = value >> self._shift
+        rank = self._shift + 1 - (value & self._mask).bit_length()
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def estimate(self):
+        """Return the estimated number of distinct keys added.
+
+        :returns: int
+
+        """
+        registers = self.registers
+        size = len(registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum([2.0 ** -rank
+                                              for rank in registers])
+
+        # Count empty registers while there are few keys, correcting for
+        # hash collisions as the estimate nears the size of the hash
+        if estimate <= 2.5 * size:
+            empty = registers.count('\x00')
+            if empty:
+                estimate = size * math.log(float(size) / empty)
+        elif estimate > (1 << _HASH_BITS) / 30.0:
+            estimate = -(1 << _HASH_BITS) * \
+                math.log(1 - estimate / (1 << _HASH_BITS))
+        return int(round(estimate))
+
+    def merge(self, other):
+        """Add the keys counted by another HyperLogLog of the same precision
+        to this one.
+
+        :param HyperLogLog other: The HyperLogLog to merge in
+        :raises: ValueError
+
+        """
+        if other.precision != self.precision:
+            raise ValueError('Can not merge a HyperLogLog of precision %i '
+                             'into one of %i' %
+                             (other.precision, self.precision))
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+
+class SpaceSaving(object):
+    """Tracks the most used keys in a fixed number of counters using the
+    Space-Saving algorithm. A key that is not tracked replaces the least
+    counted one, inheriting its count as the error of the new count, so a
+    count is never under the true count and never over it by more than the
+    total number of uses divided by the number of counters.
+
+    """
+    def __init__(self, top, error=KEY_ERROR, evicted=None):
+        """Create a new SpaceSaving summary reporting the top keys, with
+        enough counters to keep the overestimate of a count within error
+        times the total number of uses.
+
+        :param int top: The number of keys to report
+        :param float error: The bound on the overestimate of a count
+        :param callable evicted: Called with each key that is replaced
+
+        """
+        self.capacity = max(top, int(math.ceil(1.0 / error)))
+        self.top = top
+        self.total = 0
+        self._counts = dict()
+        self._errors = dict()
+        self._buckets = dict()
+        self._minimum = 0
+        self._evicted = evicted
+
+    def __contains__(self, key):
+        """Return if the key is being tracked.
+
+        :param str key: The key to check
+        :returns: bool
+
+        """
+        return key in self._counts
+
+    def __len__(self):
+        """Return the number of keys being tracked.
+
+        :returns: int
+
+        """
+        return len(self._counts)
+
+    def __getstate__(self):
+        """Return the state to pickle, leaving out the eviction callback so
+        a summary can be sent to another process.
+
+        :returns: dict
+
+        """
+        state = self.__dict__.copy()
+        state['_evicted'] = None
+        return state
+
+    def _floor(self):
+        """Return the most a key that is not tracked may have been used.
+
+        :returns: int
+
+        """
+        if len(self._counts) < self.capacity:
+            return 0
+        return self._minimum
+
+    def increment(self, key):
+        """Count a use of the key.
+
+        :param str key: The key that was used
+
+        """
+        self.total += 1
+        counts = self._counts
+        buckets = self._buckets
+        count = counts.get(key)
+
+        # A tracked key moves up to the bucket for its next count
+        if count is not None:
+            bucket = buckets[count]
+            bucket.remove(key)
+            if not bucket:
+                del buckets[count]
+                if count == self._minimum:
+                    self._minimum = count + 1
+
+        # Start counting a new key while there is room
+        elif len(counts) < self.capacity:
+            count = self._errors[key] = 0
+            self._minimum = 1
+
+        # Replace one of the least counted keys
+        else:
+            count = self._minimum
+            bucket = buckets[count]
+            replaced = bucket.pop()
+            del counts[replaced]
+            del self._errors[replaced]
+            if not bucket:
+                del buckets[count]
+                self._minimum = count + 1
+            self._errors[key] = count
+            if self._evicted:
+                self._evicted(replaced)
+
+        count += 1
+        counts[key] = count
+        if count in buckets:
+            buckets[count].add(key)
+        else:
+            buckets[count] = set([key])
+
+    def merge(self, other):
+        """Add the counts of another summary to this one, keeping the
+        capacity of this summary.
+
+        :param SpaceSaving other: The summary to merge in
+
+        """
+        counts = dict(self._counts)
+        errors = dict(self._errors)
+
+        # A key missing from a full summary may have up to its minimum count
+        floor, other_floor = self._floor(), other._floor()
+        for key, count in other._counts.iteritems():
+            if key in counts:
+                counts[key] += count
+                errors[key] += other._errors[key]
+            else:
+                counts[key] = count + floor
+                errors[key] = other._errors[key] + floor
+        for key in self._counts:
+            if key not in other._counts:
+                counts[key] += other_floor
+                errors[key] += other_floor
+
+        # Keep the most counted keys
+        kept = sorted(counts, key=counts.get, reverse=True)[:self.capacity]
+        if self._evicted:
+            replaced = set(self._counts).difference(kept)
+            for key in replaced:
+                self._evicted(key)
+        self.total += other.total
+        self._counts = dict()
+        self._errors = dict()
+        self._buckets = dict()
+        for key in kept:
+            count = self._counts[key] = counts[key]
+            self._errors[key] = errors[key]
+            if count in self._buckets:
+                self._buckets[count].add(key)
+            else:
+                self._buckets[count] = set([key])
+        self._minimum = min(self._buckets) if self._buckets else 0
+
+    def most_common(self, top=None):
+        """Return the most counted keys with their counts and the most each
+        count may be over the true count, most counted first.
+
+        :param int top: The number of keys to return, defaulting to the
+            number to report
+        :returns: list
+
+        """
+        keys = heapq.nlargest(top or self.top, self._counts,
+                              key=self._counts.get)
+        return [(key, self._counts[key], self._errors[key]) for key in keys]
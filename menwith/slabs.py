@@ -0,0 +1,221 @@
+"""
+Slab class allocation simulated from the sizes of stored items
+
+memcached stores each item in a chunk of the smallest slab class it fits
+in. The chunk size of the first class is the item header plus the minimum
+chunk size, -n, and each class after is the growth factor, -f, times larger,
+aligned to 8 bytes, up to the page size, -I, which is the chunk size of the
+last class. The space between the end of an item and the end of its chunk
+is wasted.
+
+The sizes of the items stored by set, add, replace, cas and ms requests are
+counted in buckets of the chunk alignment, with the bytes of the items in
+each, so the items and the waste of any slab classes can be worked out
+exactly from the histogram alone. A sweep of growth factors sums the
+histogram once and finds the items in each class by bisection, so it costs
+the number of classes per factor, however much traffic was counted.
+
+"""
+import bisect
+
+# Item sizes are those of a 64 bit memcached 1.6 with CAS enabled: the item
+# header, the CAS value, the key and its terminator, the client flags when
+# they are not zero and the value and its CRLF. Before 1.5 the flags and
+# value length were kept as a text suffix of at least 6 bytes instead.
+ITEM_HEADER = 48
+_CAS_BYTES = 8
+_FLAGS_BYTES = 4
+_ITEM_OVERHEAD = ITEM_HEADER + _CAS_BYTES + 1 + 2
+
+# Chunk sizes are aligned to 8 bytes, as are the histogram buckets
+_ALIGN_BITS = 3
+_ALIGN = 1 << _ALIGN_BITS
+
+# The memcached defaults of the growth factor, minimum chunk size and page
+# size, and the most slab classes it creates
+FACTOR = 1.25
+CHUNK_SIZE = 48
+PAGE_SIZE = 1 << 20
+MAX_CLASSES = 63
+
+# The growth factors swept, from 1.05 to 2.0
+FACTORS = [factor / 100.0 for factor in xrange(105, 201)]
+
+
+def item_size(key_length, value_length, flags=0):
+    """Return the bytes memcached 1.6 needs to store an item.
+
+    :param int key_length: The length of the key
+    :param int value_length: The length of the value
+    :param int flags: The client flags of the item
+    :returns: int
+
+    """
+    if flags:
+        return _ITEM_OVERHEAD + _FLAGS_BYTES + key_length + value_length
+    return _ITEM_OVERHEAD + key_length + value_length
+
+
+def slab_classes(factor=FACTOR, chunk_size=CHUNK_SIZE, page_size=PAGE_SIZE):
+    """Return the chunk size of each slab class memcached creates for the
+    growth factor, minimum chunk size and page size.
+
+    :param float factor: The growth factor
+    :param int chunk_size: The minimum chunk size
+    :param int page_size: The page size
+    :returns: list
+
+    """
+    classes = list()
+    size = ITEM_HEADER + chunk_size
+    while len(classes) < MAX_CLASSES - 1 and size <= page_size / factor:
+        if size % _ALIGN:
+            size += _ALIGN - size % _ALIGN
+        classes.append(size)
+        size = int(size * factor)
+    classes.append(page_size)
+    return classes
+
+
+class SizeHistogram(object):
+    """Counts item sizes in buckets as wide as the chunk alignment, keeping
+    the bytes of the items in each bucket.
+
+    """
+    def __init__(self):
+        """Create a new, empty, SizeHistogram."""
+        self.counts = dict()
+        self.bytes = dict()
+
+    def merge(self, other):
+        """Add the sizes counted by another histogram to this one.
+
+        :param SizeHistogram other: The histogram to merge in
+
+        """
+        for bucket, count in other.counts.iteritems():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+            self.bytes[bucket] = self.bytes.get(bucket, 0) + \
+                other.bytes[bucket]
+
+    def record(self, size):
+        """Count an item of size bytes.
+
+        :param int size: The size of the item
+
+        """
+        bucket = (size + _ALIGN - 1) >> _ALIGN_BITS
+        counts = self.counts
+        if bucket in counts:
+            counts[bucket] += 1
+            self.bytes[bucket] += size
+        else:
+            counts[bucket] = 1
+            self.bytes[bucket] = size
+
+    def cumulative(self):
+        """Return the upper bound of each bucket counted, in order, and the
+        items and bytes in the buckets before each, and in all of them.
+
+        :returns: tuple
+
+        """
+        buckets = sorted(self.counts)
+        counts, totals = [0], [0]
+        for bucket in buckets:
+            counts.append(counts[-1] + self.counts[bucket])
+            totals.append(totals[-1] + self.bytes[bucket])
+        return [bucket << _ALIGN_BITS for bucket in buckets], counts, totals
+
+
+def simulate(sizes, factor=FACTOR, chunk_size=CHUNK_SIZE,
+             page_size=PAGE_SIZE, scale=1):
+    """Return the items, bytes and wasted bytes of each slab class the
+    items would be stored in, of the classes used, and their totals. Items
+    larger than a page are not stored by memcached and are counted apart.
+
+    :param SizeHistogram sizes: The item sizes
+    :param float factor: The growth factor
+    :param int chunk_size: The minimum chunk size
+    :param int page_size: The page size
+    :param int scale: The sampling factor the counts are scaled up by
+    :returns: dict
+
+    """
+    bounds, counts, totals = sizes.cumulative()
+    classes = list()
+    previous = 0
+    for number, chunk in enumerate(slab_classes(factor, chunk_size,
+                                                page_size), 1):
+        index = bisect.bisect_right(bounds, chunk)
+        items = counts[index] - counts[previous]
+        if items:
+            item_bytes = totals[index] - totals[previous]
+            classes.append({'class': number,
+                            'chunk_size': chunk,
+                            'per_page': page_size // chunk,
+                            'items': items * scale,
+                            'item_bytes': item_bytes * scale,
+                            'wasted_bytes': (items * chunk - item_bytes) *
+                            scale})
+        previous = index
+    item_bytes = sum([row['item_bytes'] for row in classes])
+    wasted = sum([row['wasted_bytes'] for row in classes])
+    return {'factor': factor,
+            'classes': classes,
+            'items': sum([row['items'] for row in classes]),
+            'item_bytes': item_bytes,
+            'wasted_bytes': wasted,
+            'wasted_ratio': (float(wasted) / (item_bytes + wasted)
+                             if wasted else 0.0),
+            'too_large': (counts[-1] - counts[previous]) * scale}
+
+
+def sweep(sizes, factors=FACTORS, chunk_size=CHUNK_SIZE, page_size=PAGE_SIZE,
+          scale=1):
+    """Return the bytes wasted storing the items with the slab classes of
+    each growth factor, as pairs of the factor and the wasted bytes.
+
+    :param SizeHistogram sizes: The item sizes
+    :param list factors: The growth factors to try
+    :param int chunk_size: The minimum chunk size
+    :param int page_size: The page size
+    :param int scale: The sampling factor the counts are scaled up by
+    :returns: list
+
+    """
+    bounds, counts, totals = sizes.cumulative()
+    wasted = list()
+    for factor in factors:
+        previous = 0
+        total = 0
+        for chunk in slab_classes(factor, chunk_size, page_size):
+            index = bisect.bisect_right(bounds, chunk)
+            total += ((counts[index] - counts[previous]) * chunk -
+                      (totals[index] - totals[previous]))
+            previous = index
+        wasted.append((factor, total * scale))
+    return wasted
+
+
+def report(sizes, factor=FACTOR, chunk_size=CHUNK_SIZE, page_size=PAGE_SIZE,
+           scale=1):
+    """Return the simulation of the slab classes of the growth factor and
+    the growth factor of the sweep that wastes the least, the largest of
+    those that waste as little, as it needs the fewest classes.
+
+    :param SizeHistogram sizes: The item sizes
+    :param float factor: The growth factor
+    :param int chunk_size: The minimum chunk size
+    :param int page_size: The page size
+    :param int scale: The sampling factor the counts are scaled up by
+    :returns: dict
+
+    """
+    simulated = simulate(sizes, factor, chunk_size, page_size, scale)
+    best, wasted = min(sweep(sizes, FACTORS, chunk_size, page_size, scale),
+                       key=lambda candidate: (candidate[1], -candidate[0]))
+    return {'simulated': simulated,
+            'best': {'factor': best,
+                     'wasted_bytes': wasted,
+                     'saved_bytes': simulated['wasted_bytes'] - wasted}}
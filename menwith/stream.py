@@ -0,0 +1,289 @@
+"""
+TCP stream reassembly for the memcached protocol decoders
+
+Segments are tracked per TCP 4-tuple, put back in sequence order and the
+contiguous bytes handed to a protocol parser which cuts complete messages
+out of them. The flow table is bounded both in the number of flows and in
+the number of bytes buffered across all of them.
+
+"""
+import logging
+
+# TCP flags
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+
+# Sequence number arithmetic
+_SEQUENCE_MASK = 0xffffffff
+_SEQUENCE_WINDOW = 0x80000000
+
+# Default limits for the flow table
+MAX_FLOWS = 65536
+MAX_BYTES = 64 * 1048576
+MAX_FLOW_BYTES = 262144
+IDLE_TIMEOUT = 300
+
+# How often, in seconds of packet time, to look for idle flows
+_SWEEP_INTERVAL = 10
+
+# The share of the flows evicted at once when the table is over a limit
+_EVICT_FRACTION = 0.1
+
+
+class Flow(object):
+    """The reassembly state of one direction of a TCP connection"""
+    __slots__ = ['key', 'next_sequence', 'buffer', 'segments', 'held',
+                 'skip', 'synchronized', 'last_seen', 'protocol', 'pending',
+                 'response', 'server', 'group']
+
+    def __init__(self, key, sequence, timestamp):
+        """Create a new Flow expecting sequence as the next byte.
+
+        :param tuple key: The source, source port, destination and
+            destination port of the flow
+        :param int sequence: The sequence number of the next byte
+        :param float timestamp: The time the flow was first seen
+
+        """
+        self.key = key
+        self.next_sequence = sequence
+        self.buffer = ''
+        self.segments = dict()
+        self.held = 0
+        self.skip = 0
+        self.synchronized = True
+        self.last_seen = timestamp
+        self.protocol = None
+        self.pending = None
+        self.response = None
+        self.server = None
+        self.group = 0
+
+
+class FlowTable(object):
+    """Reassembles TCP segments per flow, handing the contiguous bytes of a
+    flow to the parser. The parser is called with the flow and the data,
+    returns how many bytes it consumed, and may set Flow.skip to have the
+    table discard that many bytes that follow the data, such as the rest of
+    a value it does not need.
+
+    """
+    def __init__(self, parser, max_flows=MAX_FLOWS, max_bytes=MAX_BYTES,
+                 max_flow_bytes=MAX_FLOW_BYTES, idle_timeout=IDLE_TIMEOUT):
+        """Create a new FlowTable.
+
+        :param callable parser: Called with a Flow and its contiguous data
+        :param int max_flows: The maximum number of flows tracked
+        :param int max_bytes: The maximum bytes buffered across all flows
+        :param int max_flow_bytes: The maximum bytes buffered for one flow
+        :param int idle_timeout: Seconds without traffic before eviction
+
+        """
+        self._logger = logging.getLogger('menwith.stream.FlowTable')
+        self._parser = parser
+        self._flows = dict()
+        self._max_flows = max_flows
+        self._max_bytes = max_bytes
+        self._max_flow_bytes = max_flow_bytes
+        self._idle_timeout = idle_timeout
+        self._next_sweep = 0
+        self._buffered = 0
+        self.evicted = 0
+
+    @property
+    def active(self):
+        """Return the number of flows being tracked.
+
+        :returns: int
+
+        """
+        return len(self._flows)
+
+    @property
+    def buffered(self):
+        """Return the number of bytes buffered across all flows.
+
+        :returns: int
+
+        """
+        return self._buffered
+
+    def get(self, key):
+        """Return the flow for the key, or None if it is not being tracked.
+
+        :param tuple key: The source, source port, destination and
+            destination port of the flow
+        :returns: Flow
+
+        """
+        return self._flows.get(key)
+
+    def _append(self, flow, payload):
+        """Append an in-order payload to the flow, pull in any held segments
+        that are now contiguous and hand the result to the parser.
+
+        :param Flow flow: The flow the payload belongs to
+        :param str payload: The in-order payload
+
+        """
+        data = flow.buffer + payload if flow.buffer else payload
+        flow.next_sequence = (flow.next_sequence + len(payload)) & \
+            _SEQUENCE_MASK
+
+        # Pull in out of order segments that now follow on
+        while flow.segments and flow.next_sequence in flow.segments:
+            segment = flow.segments.pop(flow.next_sequence)
+            flow.held -= len(segment)
+            self._buffered -= len(segment)
+            data += segment
+            flow.next_sequence = (flow.next_sequence + len(segment)) & \
+                _SEQUENCE_MASK
+
+        # Discard the bytes the parser asked to skip
+        if flow.skip:
+            if flow.skip >= len(data):
+                flow.skip -= len(data)
+                data = ''
+            else:
+                data = data[flow.skip:]
+                flow.skip = 0
+
+        # Let the parser cut the complete messages out of the data
+        if data:
+            consumed = (flow.protocol or self._parser)(flow, data)
+            if consumed:
+                data = data[consumed:]
+
+        # Keep the remainder, giving up on a message that will not fit
+        if len(data) > self._max_flow_bytes:
+            self._logger.debug('Discarding %i unparsed bytes for %r',
+                               len(data), flow.key)
+            flow.synchronized = False
+            data = ''
+        self._buffered += len(data) - len(flow.buffer)
+        flow.buffer = data
+
+    def _evict(self, flow):
+        """Remove the flow from the table.
+
+        :param Flow flow: The flow to remove
+
+        """
+        del self._flows[flow.key]
+        self._buffered -= len(flow.buffer) + flow.held
+        self.evicted += 1
+
+    def _evict_oldest(self):
+        """Evict the least recently seen flows to get back under the flow
+        and byte limits.
+
+        """
+        flows = sorted(self._flows.itervalues(),
+                       key=lambda flow: flow.last_seen)
+        count = max(1, int(len(flows) * _EVICT_FRACTION))
+        for flow in flows[:count]:
+            self._evict(flow)
+        self._logger.debug('Evicted %i flows over the limits', count)
+
+    def _hold(self, flow, sequence, payload):
+        """Hold an out of order segment until the bytes before it arrive.
+        If too much is held for the flow, give up on the missing bytes and
+        continue from the earliest held segment.
+
+        :param Flow flow: The flow the segment belongs to
+        :param int sequence: The sequence number of the segment
+        :param str payload: The segment payload
+
+        """
+        if sequence in flow.segments:
+            return
+        flow.segments[sequence] = payload
+        flow.held += len(payload)
+        self._buffered += len(payload)
+        if flow.held > self._max_flow_bytes:
+            expected = flow.next_sequence
+            sequence = min(flow.segments,
+                           key=lambda value: (value - expected) &
+                           _SEQUENCE_MASK)
+            self._logger.debug('Skipping a gap of %i bytes for %r',
+                               (sequence - expected) & _SEQUENCE_MASK,
+                               flow.key)
+            self._buffered -= len(flow.buffer)
+            flow.buffer = ''
+            flow.skip = 0
+            flow.synchronized = False
+            flow.next_sequence = sequence
+            payload = flow.segments.pop(sequence)
+            flow.held -= len(payload)
+            self._buffered -= len(payload)
+            self._append(flow, payload)
+
+    def _sweep(self, timestamp):
+        """Evict the flows that have been idle for longer than the idle
+        timeout.
+
+        :param float timestamp: The current packet time
+
+        """
+        cutoff = timestamp - self._idle_timeout
+        idle = [flow for flow in self._flows.itervalues()
+                if flow.last_seen < cutoff]
+        for flow in idle:
+            self._evict(flow)
+        if idle:
+            self._logger.debug('Evicted %i idle flows', len(idle))
+        self._next_sweep = timestamp + _SWEEP_INTERVAL
+
+    def segment(self, timestamp, source, source_port, destination,
+                destination_port, sequence, flags, payload):
+        """Add a TCP segment to its flow, parsing any data that is now
+        contiguous.
+
+        :param float timestamp: The time the segment was captured
+        :param int source: The source address
+        :param int source_port: The source port
+        :param int destination: The destination address
+        :param int destination_port: The destination port
+        :param int sequence: The TCP sequence number
+        :param int flags: The TCP flags
+        :param str payload: The TCP payload
+
+        """
+        key = source, source_port, destination, destination_port
+        flow = self._flows.get(key)
+
+        # Start tracking the flow, the data after a SYN is one byte on
+        if flow is None:
+            if flags & (TCP_FIN | TCP_RST):
+                return
+            if flags & TCP_SYN:
+                sequence = (sequence + 1) & _SEQUENCE_MASK
+            flow = self._flows[key] = Flow(key, sequence, timestamp)
+        flow.last_seen = timestamp
+
+        if payload:
+            offset = (sequence - flow.next_sequence) & _SEQUENCE_MASK
+
+            # The segment is the next one expected
+            if not offset:
+                self._append(flow, payload)
+
+            # The segment is ahead of a missing one
+            elif offset < _SEQUENCE_WINDOW:
+                self._hold(flow, sequence, payload)
+
+            # The segment is a retransmission, keep any part that is new
+            elif _SEQUENCE_MASK + 1 - offset < len(payload):
+                self._append(flow, payload[_SEQUENCE_MASK + 1 - offset:])
+
+        # A closed flow will not see any more data
+        if flags & (TCP_FIN | TCP_RST):
+            self._evict(flow)
+
+        # Keep the table within its limits
+        if len(self._flows) > self._max_flows or \
+                self._buffered > self._max_bytes:
+            self._evict_oldest()
+        if timestamp >= self._next_sweep:
+            self._sweep(timestamp)
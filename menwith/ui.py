@@ -1,20 +1,212 @@
+"""
+Interactive user interfaces
+
+The curses interface redraws a top style view of the latest decoder
+snapshot at the refresh interval. Snapshots are read by reference, so the
+decoder never waits on the interface, and only the parts of the screen that
+changed since the last frame are written to the terminal.
+
+"""
 import curses
+import logging
 import threading
+import time
+
+from . import sampling
+
+# The default seconds between screen refreshes
+REFRESH = 1.0
+
+# The columns of the command table
+_COMMAND_HEADER = '%-12s %10s %10s %10s %12s %9s %9s %9s' % (
+    'COMMAND', '1s/s', '10s/s', '60s/s', 'TOTAL', 'p50 us', 'p99 us',
+    'p999 us')
+_COMMAND_ROW = '%-12s %10.1f %10.1f %10.1f %12i %9s %9s %9s'
+_KEY_HEADER = '%-56s %12s' % ('KEY', 'COUNT')
+_KEY_ROW = '%-56s %12i'
+
+# The keys that quit the interface
+_QUIT = frozenset([ord('q'), ord('Q')])
+
+
+def _pipeline(telemetry):
+    """Return the line reporting what the pipeline enqueued and dropped.
+
+    :param dict telemetry: The queue and capture stats
+    :returns: str
+
+    """
+    queue, capture = telemetry['queue'], telemetry['capture']
+    line = 'queue %i enqueued, %i dropped, peak %.0f%% full' % (
+        queue['enqueued'], queue['dropped'], queue['peak_fill'] * 100)
+    if capture:
+        line += '  pcap %i received, %i dropped, %i dropped by interface' % (
+            capture['received'], capture['dropped'], capture['ifdropped'])
+    return line
+
+
+def _sampling(snapshot):
+    """Return the line reporting the sampling factor and the 95%
+    confidence bounds of the request rate over the last ten seconds.
+
+    :param dict snapshot: The decoder snapshot
+    :returns: str
+
+    """
+    sample = snapshot['sample']
+    requests = sum(snapshot['requests']['10s'].values()) * 10
+    low, high = sampling.bounds(requests, sample['rate'],
+                                sample['design_effect'])
+    return ('sampled 1/%i connections  10s rate %.1f-%.1f/s (95%%)  '
+            'design effect %.1f' % (sample['rate'], low / 10, high / 10,
+                                    sample['design_effect']))
+
+
+def render(snapshot, telemetry=None):
+    """Return the lines of the view of a decoder snapshot.
+
+    :param dict snapshot: The decoder snapshot
+    :param dict telemetry: The queue and capture stats, if known
+    :returns: list
+
+    """
+    if not snapshot or snapshot['timestamp'] is None:
+        return ['menwith', '', 'Waiting for traffic...']
+    requests = snapshot['requests']
+    latencies = snapshot['latencies']
+    lines = ['menwith - %s - %.1f requests/s' %
+             (time.strftime('%Y-%m-%d %H:%M:%S',
+                            time.localtime(snapshot['timestamp'])),
+              sum(requests['1s'].values()))]
+    if telemetry:
+        lines.append(_pipeline(telemetry))
+    if snapshot['sample']['rate'] > 1:
+        lines.append(_sampling(snapshot))
+    lines.extend(['', _COMMAND_HEADER])
+
+    # The busiest commands first
+    commands = [command for command, count in snapshot['counts'].iteritems()
+                if count]
+    commands.sort(key=lambda command: (requests['10s'].get(command, 0),
+                                       snapshot['counts'][command]),
+                  reverse=True)
+    for command in commands:
+        latency = latencies.get(command, dict())
+        lines.append(_COMMAND_ROW %
+                     (command, requests['1s'].get(command, 0),
+                      requests['10s'].get(command, 0),
+                      requests['60s'].get(command, 0),
+                      snapshot['counts'][command],
+                      latency.get('p50', '-'), latency.get('p99', '-'),
+                      latency.get('p999', '-')))
+
+    # Hits, misses and value sizes over the last ten seconds
+    responses = snapshot['responses'].get('10s')
+    if responses and (responses['hits'] or responses['misses']):
+        lines.extend(['', 'hits %.1f/s  misses %.1f/s  hit ratio %.1f%%  '
+                          'average value %.0f bytes' %
+                      (responses['hits'], responses['misses'],
+                       100.0 * responses['hits'] /
+                       (responses['hits'] + responses['misses']),
+                       (responses['value_bytes'] / responses['hits']
+                        if responses['hits'] else 0))])
+
+    lines.extend(['', _KEY_HEADER])
+    for key, count in snapshot['keys']:
+        lines.append(_KEY_ROW % (key[:56], count))
+    return lines
 
 
 class Curses(threading.Thread):
+    """Shows the decoder snapshots in a curses full screen view until q is
+    pressed or the interface is stopped.
+
+    """
+    def __init__(self):
+        """Create a new Curses interface thread. The options, decoder and
+        telemetry attributes are set by the manager before it is started.
+
+        """
+        super(Curses, self).__init__()
+        self._logger = logging.getLogger('menwith.ui.Curses')
+        self._lines = list()
+        self._running = False
+        self._size = None
+        self.decoder = None
+        self.options = None
+        self.telemetry = None
+
+    def _draw(self, screen, lines):
+        """Write the lines that changed since the last frame to the screen,
+        starting each at the first column that differs.
+
+        :param curses.window screen: The screen to draw on
+        :param list lines: The lines of the new frame
+
+        """
+        height, width = screen.getmaxyx()
+        if (height, width) != self._size:
+            self._size = height, width
+            self._lines = list()
+            screen.clear()
+
+        # Stay off the last column and row, curses errors writing there
+        lines = [line[:width - 1] for line in lines[:height - 1]]
+        previous = self._lines
+        changed = False
+        for row in xrange(max(len(lines), len(previous))):
+            line = lines[row] if row < len(lines) else ''
+            old = previous[row] if row < len(previous) else ''
+            if line == old:
+                continue
+            column = 0
+            while column < len(line) and column < len(old) and \
+                    line[column] == old[column]:
+                column += 1
+            screen.addstr(row, column, line[column:].ljust(len(old) - column))
+            changed = True
+        self._lines = lines
+        if changed:
+            screen.refresh()
+
+    def _run(self, screen):
+        """Refresh the view until told to stop or q is pressed.
+
+        :param curses.window screen: The screen curses.wrapper set up
+
+        """
+        try:
+            curses.curs_set(0)
+        except curses.error:
+            pass
+        refresh = getattr(self.options, 'refresh', REFRESH)
+        screen.timeout(int(refresh * 1000))
+        while self._running:
+            telemetry = self.telemetry() if self.telemetry else None
+            self._draw(screen, render(self.decoder.snapshot(), telemetry))
+
+            # Waits for a key press for up to the refresh interval
+            if screen.getch() in _QUIT:
+                break
 
     def run(self):
-        pass
+        """Run the interface until it is stopped or the user quits."""
+        self._running = True
+        curses.wrapper(self._run)
+        self._running = False
+        self._logger.debug('Exiting interface')
 
     def stop(self):
-        pass
-        
-        
+        """Stop the interface, restoring the terminal."""
+        self._running = False
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+
 class wxWidgets(threading.Thread):
-    
+
     def run(self):
         pass
-    
+
     def stop(self):
-        pass
\ No newline at end of file
+        pass
@@ -0,0 +1,154 @@
+"""
+Rolling time window counters
+
+Counters are kept in a ring of fixed width interval buckets that are
+allocated once and cleared for reuse. The sum of each sliding window is
+kept up to date as each interval completes, by adding the interval that
+completed and subtracting the one that fell out of the window, so reading
+a rate never scans the buckets.
+
+"""
+# The width of an interval in seconds, and the number kept
+WIDTH = 1.0
+SIZE = 300
+
+# The sliding windows, by name and number of intervals
+WINDOWS = [('1s', 1), ('10s', 10), ('60s', 60), ('5m', 300)]
+
+
+class RollingWindow(object):
+    """Counts named values in fixed width intervals of packet time, keeping
+    the totals of the last intervals for each sliding window. Counting is
+    done by incrementing the current interval bucket directly.
+
+    """
+    def __init__(self, names, width=WIDTH, size=SIZE, windows=WINDOWS):
+        """Create a new RollingWindow counting the named values.
+
+        :param list names: The names of the values counted
+        :param float width: The width of an interval in seconds
+        :param int size: The number of complete intervals kept
+        :param list windows: The name and number of intervals of each
+            sliding window, none longer than size
+        :raises: ValueError
+
+        """
+        if max([length for name, length in windows]) > size:
+            raise ValueError('A window can not be longer than %i intervals' %
+                             size)
+        self.width = width
+        self.windows = windows
+
+        # The interval being counted has a bucket of its own
+        self._buckets = [dict.fromkeys(names, 0)
+                         for index in xrange(size + 1)]
+        self._sums = dict([(name, dict.fromkeys(names, 0))
+                           for name, length in windows])
+        self._interval = None
+        self._completed = 0
+        self.current = self._buckets[0]
+        self.end = None
+
+    def _clear(self):
+        """Clear every bucket and window sum, as after a gap longer than the
+        intervals kept.
+
+        """
+        for counters in self._buckets + self._sums.values():
+            for name in counters:
+                counters[name] = 0
+
+    def advance(self, timestamp):
+        """Complete the intervals that ended before timestamp, updating the
+        window sums, and make the bucket for the interval timestamp falls in
+        the current one.
+
+        :param float timestamp: The packet time
+
+        """
+        interval = int(timestamp // self.width)
+        buckets = self._buckets
+        slots = len(buckets)
+        if self._interval is None:
+            self._interval = interval
+            self.current = buckets[interval % slots]
+            self.end = (interval + 1) * self.width
+            return
+        if interval <= self._interval:
+            return
+
+        # Nothing counted before a long gap is in any window after it
+        if interval - self._interval >= slots:
+            self._clear()
+            self._completed += interval - self._interval - 1
+            self._interval = interval - 1
+
+        # Add each completed interval to the windows and drop the oldest
+        while self._interval < interval:
+            completed = buckets[self._interval % slots]
+            for name, length in self.windows:
+                sums = self._sums[name]
+                oldest = buckets[(self._interval - length) % slots]
+                for value in sums:
+                    sums[value] += completed[value] - oldest[value]
+            self._interval += 1
+            self._completed += 1
+
+            # The bucket reused is the one that left the longest window
+            current = buckets[self._interval % slots]
+            for value in current:
+                current[value] = 0
+
+        self.current = buckets[self._interval % slots]
+        self.end = (interval + 1) * self.width
+
+    def merge(self, other):
+        """Add the counts of another window to the intervals of this one,
+        moving this window on first if the other one is further along.
+        Intervals of the other window too old for this one are left out.
+
+        :param RollingWindow other: The window to merge in
+
+        """
+        if other._interval is None:
+            return
+        if self._interval is None or other._interval > self._interval:
+            self.advance(other._interval * self.width)
+        buckets = self._buckets
+        slots = len(buckets)
+        for interval in xrange(self._interval - slots + 1,
+                               other._interval + 1):
+            if interval <= other._interval - slots:
+                continue
+            counters = buckets[interval % slots]
+            for value, count in other._buckets[interval % slots].iteritems():
+                counters[value] += count
+        self._completed = max(self._completed, other._completed)
+
+        # Add the window sums up again over the merged buckets
+        for name, length in self.windows:
+            sums = self._sums[name]
+            for value in sums:
+                sums[value] = 0
+            for interval in xrange(self._interval - length, self._interval):
+                counters = buckets[interval % slots]
+                for value in sums:
+                    sums[value] += counters[value]
+
+    def rates(self):
+        """Return the per second rate of each value over each sliding window
+        of the completed intervals.
+
+        :returns: dict
+
+        """
+        rates = dict()
+        for name, length in self.windows:
+            seconds = min(length, self._completed) * self.width
+            if seconds:
+                rates[name] = dict([(value, count / seconds)
+                                    for value, count in
+                                    self._sums[name].iteritems()])
+            else:
+                rates[name] = dict()
+        return rates
@@ -0,0 +1,344 @@
+"""
+Decode in several worker processes, sharded by connection
+
+The capture hashes each segment's addresses and ports to pick a worker, in
+a way that gives both directions of a connection the same worker, and
+hands the segments over through a shared memory ring per worker. Each
+worker runs its own Decoder and sends its statistics back over a pipe when
+the parent asks, where they are merged into one set of results. An agent
+drains the workers instead, each sending what it gathered since it was
+last drained and starting afresh.
+
+The statistics are only asked for to report or drain them, as pickling
+them stops the worker decoding. Told to checkpoint, a worker forks a child
+that writes its own part of the checkpoint instead, and the parent merges
+the parts from a child of its own. The interface, the metrics endpoint and
+the records written in gather mode read snapshots instead, which each
+worker publishes in a shared memory slot as it publishes them, without
+waiting on the parent, and which the parent merges when read.
+
+"""
+import logging
+import multiprocessing
+import os
+import Queue
+import signal
+import threading
+
+from . import checkpoint
+from . import memcache
+from . import pipeline
+from . import ring
+
+# How long a worker waits for a batch before checking its pipe again
+_POLL_TIMEOUT = 0.05
+
+# The messages a worker understands
+_CHECKPOINT = 'checkpoint'
+_DRAIN = 'drain'
+_STATE = 'state'
+_STOP = 'stop'
+
+
+class ShardedQueue(object):
+    """Splits the batches the capture puts on it between the rings of the
+    workers by connection, counting the segments put on the rings and
+    dropped. A full ring is waited on, or with the drop-newest policy the
+    segments for it are dropped. Dropping the oldest is not possible, only
+    the worker reading a ring may move its tail.
+
+    """
+    def __init__(self, rings, policy=pipeline.BLOCK):
+        """Create a new ShardedQueue over the rings.
+
+        :param list rings: The ring for each worker
+        :param str policy: What to do with segments for a full ring
+        :raises: ValueError
+
+        """
+        if policy not in [pipeline.BLOCK, pipeline.DROP_NEWEST]:
+            raise ValueError('Unsupported overload policy for decode '
+                             'workers: %s' % policy)
+        self._rings = rings
+        self._block = policy == pipeline.BLOCK
+        self.policy = policy
+        self.enqueued = 0
+        self.dropped = 0
+
+    def put(self, batch):
+        """Hand each segment of the batch to the ring of its worker, picked
+        by the addresses and ports xored together so both directions of a
+        connection go to the same worker.
+
+        :param list batch: The segments from the capture
+
+        """
+        rings = self._rings
+        count = len(rings)
+        batches = [list() for index in xrange(count)]
+        for segment in batch:
+            batches[(segment[1] ^ segment[2] ^ segment[3] ^ segment[4]) %
+                    count].append(segment)
+        for index, shard_batch in enumerate(batches):
+            if shard_batch:
+                if rings[index].put(shard_batch, self._block):
+                    self.enqueued += len(shard_batch)
+                else:
+                    self.dropped += len(shard_batch)
+
+    def stats(self):
+        """Return the overload policy, the payloads enqueued and dropped and
+        the largest share of a ring that has been in use.
+
+        :returns: dict
+
+        """
+        return {'policy': self.policy,
+                'enqueued': self.enqueued,
+                'dropped': self.dropped,
+                'peak_fill': max([float(shard.peak) / shard.size
+                                  for shard in self._rings])}
+
+
+def _worker(index, batches, summaries, connection, options, resume=None):
+    """Decode the batches from the ring until told to stop, publishing the
+    summary of each new snapshot, answering requests for the statistics,
+    writing its part of each checkpoint and sending the statistics a final
+    time on exit.
+
+    :param int index: The worker index
+    :param ring.Ring batches: The ring the batches arrive on
+    :param ring.Slot summaries: The slot the snapshot summaries go in
+    :param multiprocessing.Connection connection: The pipe to the parent
+    :param optparse.Values options: The command line options
+    :param dict resume: The checkpointed state to carry on from
+
+    """
+    # The parent handles interrupts and tells the workers to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    decoder = memcache.Decoder(batches, options.port, options.responses,
+                               options.top_keys, options.key_error,
+                               options.distinct, options.servers,
+                               options.namespaces, options.sample,
+                               options.slabs, live=not options.replay)
+    if resume:
+        decoder.merge(resume)
+    checkpointer = None
+    if options.checkpoint:
+        checkpointer = checkpoint.Checkpointer(
+            checkpoint.part(options.checkpoint, index),
+            checkpoint.settings(options), 0)
+    published = None
+    try:
+        while True:
+            if connection.poll():
+                message = connection.recv()
+                if message == _STOP:
+                    break
+                if message == _DRAIN:
+                    connection.send(decoder.drain())
+                elif message == _CHECKPOINT:
+                    checkpointer.checkpoint(decoder.state())
+                else:
+                    connection.send(decoder.state())
+            try:
+                batch = batches.get(timeout=_POLL_TIMEOUT)
+            except Queue.Empty:
+                decoder.idle()
+            else:
+                decoder.add_batch(batch)
+
+            # Publish each new snapshot for the parent to merge
+            if decoder.snapshot() is not published:
+                published = decoder.snapshot()
+                summaries.put(decoder.summary())
+
+        # Decode anything still waiting in the ring
+        while not batches.empty():
+            decoder.add_batch(batches.get())
+        decoder.finish()
+        summaries.put(decoder.summary())
+    finally:
+        batches.close()
+        if checkpointer:
+            checkpointer.wait()
+    connection.send(decoder.state())
+
+
+class DecodeWorkers(object):
+    """Runs a Decoder in each of several worker processes, standing in for
+    the Decode thread in the manager.
+
+    """
+    def __init__(self, options):
+        """Create the rings and pipes for options.workers workers.
+
+        :param optparse.Values options: The command line options
+
+        """
+        self._logger = logging.getLogger('menwith.workers.DecodeWorkers')
+        self.options = options
+        self._rings = [ring.Ring() for index in xrange(options.workers)]
+        self._slots = [ring.Slot() for index in xrange(options.workers)]
+        self._sequences = None
+        self._snapshot = None
+        self._snapshot_lock = threading.Lock()
+        self._connections = list()
+        self._processes = list()
+        self._final = list()
+        self._stopped = False
+        self._lock = threading.Lock()
+        self.queue = ShardedQueue(self._rings, options.overload)
+
+    def _decoder(self, states):
+        """Return a Decoder holding the merged statistics of the workers.
+
+        :param list states: The statistics of each worker
+        :returns: memcache.Decoder
+
+        """
+        options = self.options
+        decoder = memcache.Decoder(None, options.port, options.responses,
+                                   options.top_keys, options.key_error,
+                                   options.distinct, options.servers,
+                                   options.namespaces, options.sample,
+                                   options.slabs)
+        for state in states:
+            decoder.merge(state)
+        return decoder
+
+    def is_alive(self):
+        """Return if every worker is still running.
+
+        :returns: bool
+
+        """
+        return all([process.is_alive() for process in self._processes])
+
+    def checkpoint(self, checkpointer):
+        """Tell each worker to write its part of the checkpoint from a
+        forked child, and write the checkpoint from a child forked here,
+        merging the latest part of each worker, once they have all written
+        one. Neither the workers nor this process wait on the pickling.
+
+        :param checkpoint.Checkpointer checkpointer: The checkpoint writer
+
+        """
+        parts = checkpointer.parts
+        if all([os.path.exists(path) for path in parts]):
+            checkpointer.checkpoint(lambda: self._decoder(
+                [checkpoint.read(path)[1] for path in parts]).state())
+        with self._lock:
+            if not self._stopped:
+                for connection in self._connections:
+                    connection.send(_CHECKPOINT)
+
+    def drain(self):
+        """Return the merged statistics the workers gathered since they
+        were last drained, each starting afresh, or what they gathered
+        since then up to when they stopped.
+
+        :returns: dict
+
+        """
+        return self._decoder(self._states(_DRAIN)).state()
+
+    def join(self):
+        """Wait for the workers to exit."""
+        for process in self._processes:
+            process.join()
+
+    def start(self):
+        """Fork the workers, the first carrying on from the checkpointed
+        state if resuming.
+
+        """
+        for index, batches in enumerate(self._rings):
+            parent, child = multiprocessing.Pipe()
+            resume = self.options.resume if not index else None
+            process = multiprocessing.Process(target=_worker,
+                                              args=(index, batches,
+                                                    self._slots[index],
+                                                    child, self.options,
+                                                    resume))
+            process.daemon = True
+            process.start()
+            self._connections.append(parent)
+            self._processes.append(process)
+        self._logger.info('Started %i decode workers', len(self._processes))
+
+    def stop_process(self):
+        """Tell the workers to stop, collecting their final statistics."""
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            for connection in self._connections:
+                try:
+                    connection.send(_STOP)
+                except IOError:
+                    pass
+            for connection, process in zip(self._connections,
+                                           self._processes):
+                try:
+                    self._final.append(connection.recv())
+                except (EOFError, IOError):
+                    self._logger.error('Lost the statistics of worker %i',
+                                       process.pid)
+
+    def snapshot(self):
+        """Return the latest snapshots the workers published, merged, only
+        merging them again once one of them has published another.
+
+        :returns: dict
+
+        """
+        with self._snapshot_lock:
+            published = [slot.get() for slot in self._slots]
+            sequences = [sequence for sequence, summary in published]
+            if sequences != self._sequences:
+                self._sequences = sequences
+                self._snapshot = memcache.merge_summaries(
+                    [summary for sequence, summary in published if summary],
+                    self.options.sample)
+            return self._snapshot
+
+    def state(self):
+        """Return the merged statistics of the workers, as returned by
+        the Decoder state method.
+
+        :returns: dict
+
+        """
+        return self._decoder(self._states()).state()
+
+    def _states(self, message=_STATE):
+        """Return the statistics of each worker, asking them for their
+        current statistics while they are running. Reporting, checkpoints
+        and draining may use the pipes at once, so only one request is on
+        them at a time.
+
+        :param str message: The request, for the state or to drain it
+        :returns: list
+
+        """
+        with self._lock:
+            if self._stopped:
+                return self._final
+            for connection in self._connections:
+                connection.send(message)
+            return [connection.recv() for connection in self._connections]
+
+    def values(self):
+        """Return the merged statistics of the workers, asking any that are
+        still running for their current statistics.
+
+        :returns: tuple
+
+        """
+        decoder = self._decoder(self._states())
+        return (decoder.counts, decoder.distinct, decoder.keys,
+                decoder.flows, decoder.servers, decoder.responses,
+                decoder.key_responses, decoder.latencies,
+                decoder.namespaces, decoder.estimates, decoder.item_sizes,
+                decoder.miss_ratio_curve)
@@ -0,0 +1,560 @@
+__author__ = 'gmr'
+
+import json
+import multiprocessing
+import optparse
+import os
+import random
+import re
+import resource
+import struct
+import sys
+import tempfile
+import threading
+import time
+sys.path.insert(0, '..')
+
+import pcap
+
+import generator
+from menwith import memcache
+from menwith import namespace
+from menwith import network
+from menwith import pipeline
+from menwith import replay
+from menwith import ring
+from menwith import sketch
+from menwith import stream
+
+_ETHERNET = struct.Struct('!6s6sH')
+_IPV4 = struct.Struct('!BBHHHBBH4s4s')
+_TCP = struct.Struct('!HHIIBBHHH')
+
+_PACKETS = 200000
+
+# The ns/packet and peak RSS of each benchmark run, for the baseline
+_RESULTS = {'ns_per_packet': dict(), 'peak_rss_mb': dict()}
+
+# How much slower or bigger than the baseline counts as a regression
+_REGRESSION = 0.1
+
+
+class NullQueue(object):
+    """Stand-in for Queue.Queue so the benchmarks only time decoding"""
+    def put(self, item):
+        pass
+
+
+class ListQueue(list):
+    """Stand-in for Queue.Queue that keeps the batches put on it"""
+    put = list.append
+
+
+class BenchmarkCapture(network.TCPCapture):
+    """TCPCapture that does not open a device"""
+    def _setup_libpcap(self, device, ports, responses=False, servers=None):
+        return None
+
+
+class LegacyCapture(object):
+    """The per-packet decode path TCPCapture used before the struct based
+    fast path, kept here as the comparison baseline.
+
+    """
+    def __init__(self, queue):
+        self._queue = queue
+
+    def _char_conversion(self, value):
+        return ''.join(['%c' % byte for byte in value])
+
+    def _ethernet_decode(self, packet_in):
+        return (self._format_bytes(packet_in[0:6], ':'),
+                self._format_bytes(packet_in[6:12], ':'),
+                packet_in[12:14],
+                packet_in[14:])
+
+    def _format_bytes(self, value, delimiter=''):
+        return delimiter.join(['%0.2x' % ord(byte) for byte in value])
+
+    def _ipv4_decode(self, packet_in):
+        from socket import ntohs
+        out = {'version': struct.unpack('b', packet_in[0])[0] >> 4,
+               'ihl': (struct.unpack('b', packet_in[0])[0] & 0x0F) * 4,
+               'total_length': ntohs(struct.unpack('H', packet_in[2:4])[0]),
+               'identification': ntohs(struct.unpack('H', packet_in[4:6])[0]),
+               'flags': (ord(packet_in[6]) & 0xe0) >> 5,
+               'fragment_offset': (ntohs(struct.unpack('H',
+                                                       packet_in[6:8])[0]) &
+                                   0x1f),
+               'ttl': ord(packet_in[8]),
+               'protocol': ord(packet_in[9]),
+               'checksum': ntohs(struct.unpack('H', packet_in[10:12])[0]),
+               'source': pcap.ntoa(struct.unpack('i', packet_in[12:16])[0]),
+               'destination': pcap.ntoa(struct.unpack('i',
+                                                      packet_in[16:20])[0])}
+        if out['ihl'] > 20:
+            out['options'] = packet_in[20:out['ihl']]
+        else:
+            out['options'] = None
+        return out, packet_in[out['ihl']:]
+
+    def _tcp_decode(self, packet_in):
+        from socket import ntohs
+        out = {'source_port': ntohs(struct.unpack('H', packet_in[0:2])[0]),
+               'dest_port': ntohs(struct.unpack('H', packet_in[2:4])[0]),
+               'data_offset': struct.unpack('B', packet_in[12])[0] >> 4}
+        return out, self._char_conversion(packet_in[(24 +
+                                                     out['data_offset']):])
+
+    def _process_packet(self, packet_length, packet_in, timestamp):
+        dest, source, ethertype, payload = self._ethernet_decode(packet_in)
+        if ethertype == '\x08\x00':
+            ipv4_header, ipv4_payload = self._ipv4_decode(payload)
+            if ipv4_header['protocol'] == 6:
+                tcp_header, tcp_payload = self._tcp_decode(ipv4_payload)
+                if tcp_payload:
+                    self._queue.put(tcp_payload)
+
+
+class RegexDecoder(object):
+    """The regex loop Decoder used before the tokenizer, with a pattern for
+    each command it is compared on, kept here as the comparison baseline.
+
+    """
+    PATTERNS = {'get': re.compile('get ((?:[^ \r\n]+ ?)+)\r\n'),
+                'gets': re.compile('gets ((?:[^ \r\n]+ ?)+)\r\n'),
+                'set': re.compile('set ([^ \r\n]+) \d+ \d+ \d+'
+                                  '(?: noreply)?\r\n'),
+                'delete': re.compile('delete ([^ \r\n]+)'
+                                     '(?: noreply)?\r\n'),
+                'incr': re.compile('incr ([^ \r\n]+) \d+'
+                                   '(?: noreply)?\r\n'),
+                'touch': re.compile('touch ([^ \r\n]+) \d+'
+                                    '(?: noreply)?\r\n'),
+                'stats': re.compile('stats(?: [^\r\n]+)?\r\n')}
+
+    def __init__(self):
+        self._counts = dict([(command, 0) for command in self.PATTERNS])
+        self._keys = dict()
+
+    def _process_buffer(self, data):
+        offset = 0
+        while offset < len(data):
+            end = data.find('\r\n', offset)
+            if end < 0:
+                break
+            message_end = end + 2
+            space = data.find(' ', offset, end)
+            if space > 0 and data[offset:space] == 'set':
+                message_end += int(data[offset:end].split()[4]) + 2
+            self._process_payload(data[offset:message_end])
+            offset = message_end
+        return offset
+
+    def _process_payload(self, data):
+        for command in self.PATTERNS:
+            response = self.PATTERNS[command].match(data)
+            if response:
+                self._counts[command] += 1
+                for group in response.groups():
+                    for key in group.split():
+                        self._keys[key] = self._keys.get(key, 0) + 1
+                break
+
+
+def mixed_commands(count, seed=1):
+    """Return count memcached ASCII commands in a typical read heavy mix.
+
+    :param int count: The number of commands
+    :param int seed: The random seed
+    :rtype: list
+
+    """
+    generator = random.Random(seed)
+    commands = list()
+    for value in xrange(count):
+        key = 'user:%i:profile' % generator.randint(0, 10000)
+        choice = generator.random()
+        if choice < 0.6:
+            commands.append('get %s\r\n' % key)
+        elif choice < 0.75:
+            commands.append('get %s\r\n' % ' '.join(
+                ['user:%i:profile' % generator.randint(0, 10000)
+                 for offset in xrange(5)]))
+        elif choice < 0.9:
+            commands.append('set %s 0 3600 %i\r\n%s\r\n' %
+                            (key, 64, 'v' * 64))
+        elif choice < 0.95:
+            commands.append('delete %s\r\n' % key)
+        elif choice < 0.99:
+            commands.append('incr %s 1\r\n' % key)
+        else:
+            commands.append('stats\r\n')
+    return commands
+
+
+def ethernet_packet(payload, source_port=40000, dest_port=11211,
+                    sequence=1, flags=0x18):
+    """Build an Ethernet/IPv4/TCP frame carrying payload.
+
+    :param str payload: The TCP payload
+    :param int source_port: The TCP source port
+    :param int dest_port: The TCP destination port
+    :param int sequence: The TCP sequence number
+    :param int flags: The TCP flags
+    :rtype: str
+
+    """
+    tcp = _TCP.pack(source_port, dest_port, sequence, 0, 5 << 4, flags,
+                    65535, 0, 0)
+    ipv4 = _IPV4.pack(0x45, 0, 20 + len(tcp) + len(payload), 0, 0, 64, 6, 0,
+                      '\x0a\x00\x00\x01', '\x0a\x00\x00\x02')
+    ethernet = _ETHERNET.pack('\x00\x11\x22\x33\x44\x55',
+                              '\x66\x77\x88\x99\xaa\xbb', 0x0800)
+    return ethernet + ipv4 + tcp + payload
+
+
+def _report(name, packets, duration):
+    print '%-36s %10.0f pps %8.0f ns/packet' % (name, packets / duration,
+                                                 duration / packets * 1e9)
+    _RESULTS['ns_per_packet'][name] = duration / packets * 1e9
+
+
+def _report_rss(name):
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print '%-36s %10.1f MB peak RSS' % (name, rss)
+    _RESULTS['peak_rss_mb'][name] = rss
+
+
+def _time_packets(process, packets):
+    start = time.time()
+    for packet in packets:
+        process(len(packet), packet, 0.0)
+    return time.time() - start
+
+
+def packet_decode_benchmark(count=_PACKETS):
+    """Compare the packets per second of the legacy decode path against
+    TCPCapture._process_packet.
+
+    """
+    packets = [ethernet_packet('get user:%i:profile\r\n' % (value % 1000),
+                               40000 + value % 1000)
+               for value in xrange(count)]
+    legacy = LegacyCapture(NullQueue())
+    _report('legacy decode', count,
+            _time_packets(legacy._process_packet, packets))
+    capture = BenchmarkCapture(NullQueue(), None)
+    _report('TCPCapture._process_packet', count,
+            _time_packets(capture._process_packet, packets))
+
+
+def datalink_benchmark(count=_PACKETS):
+    """Time TCPCapture._process_packet on the same traffic on each link
+    layer and IP version, so the cost of each decoding path can be compared
+    with untagged Ethernet and IPv4.
+
+    """
+    for link in ['ethernet', 'vlan', 'qinq', 'sll', 'sll2']:
+        for ip in generator.IPS:
+            traffic = generator.TrafficGenerator(pipeline=4, mss=512,
+                                                 link=link, ip=ip)
+            packets = list(traffic.packets(count))
+            capture = BenchmarkCapture(NullQueue(), None, responses=True)
+            capture._set_linktype(generator.LINKS[link])
+            process = capture._process_packet
+            start = time.time()
+            for timestamp, packet in packets:
+                process(len(packet), packet, timestamp)
+            _report('%s %s' % (link, ip), len(packets), time.time() - start)
+
+
+def tokenizer_benchmark(count=_PACKETS):
+    """Compare the regex loop against the Decoder tokenizer on a mixed
+    command stream, first with one command per payload and then with
+    pipelined payloads of eight commands that the regex loop has to cut
+    into messages first.
+
+    """
+    commands = mixed_commands(count)
+    pipelined = [''.join(commands[offset:offset + 8])
+                 for offset in xrange(0, count, 8)]
+    flow = stream.Flow((1, 40000, 2, 11211), 0, 0.0)
+    for name, payloads in [('', commands), (' pipelined', pipelined)]:
+        decoder = RegexDecoder()
+        start = time.time()
+        for payload in payloads:
+            decoder._process_buffer(payload)
+        _report('regex loop' + name, count, time.time() - start)
+        decoder = memcache.Decoder(NullQueue())
+        start = time.time()
+        for payload in payloads:
+            decoder._process_payload(flow, payload)
+        _report('Decoder._process_payload' + name, count,
+                time.time() - start)
+
+
+def key_tracking_benchmark(count=_PACKETS):
+    """Compare counting every key in a dict against the SpaceSaving top
+    keys sketch and the HyperLogLog distinct key estimate on a long tailed
+    key stream with many distinct keys.
+
+    """
+    generator = random.Random(1)
+    keys = ['session:%i' % (generator.randint(0, 100)
+                            if generator.random() < 0.2 else
+                            generator.randint(0, 10000000))
+            for value in xrange(count)]
+    counts = dict()
+    start = time.time()
+    for key in keys:
+        counts[key] = counts.get(key, 0) + 1
+    _report('dict', count, time.time() - start)
+    print '%-36s %10i keys' % ('dict', len(counts))
+    summary = sketch.SpaceSaving(100)
+    increment = summary.increment
+    start = time.time()
+    for key in keys:
+        increment(key)
+    _report('SpaceSaving.increment', count, time.time() - start)
+    print '%-36s %10i keys' % ('SpaceSaving', len(summary))
+    counter = sketch.HyperLogLog()
+    add = counter.add
+    start = time.time()
+    for key in keys:
+        add(key)
+    _report('HyperLogLog.add', count, time.time() - start)
+    print '%-36s %10i keys' % ('HyperLogLog.estimate', counter.estimate())
+
+
+def namespace_benchmark(count=_PACKETS):
+    """Compare grouping keys by the prefix before the first separator
+    against normalizing them into namespaces, uncached and through the
+    cache, on a long tailed key stream where most uses are of hot keys.
+
+    """
+    generator = random.Random(1)
+    keys = [('user:%i:profile' % generator.randint(0, 5000)
+             if generator.random() < 0.9 else
+             'session:%032x' % generator.getrandbits(128))
+            for value in xrange(count)]
+    start = time.time()
+    for key in keys:
+        key[:max(key.find(':'), 0)]
+    _report('prefix', count, time.time() - start)
+    normalizer = namespace.Normalizer(patterns=['session:**'])
+    normalize = normalizer.normalize
+    start = time.time()
+    for key in keys:
+        normalize(key)
+    _report('Normalizer.normalize', count, time.time() - start)
+    lookup = normalizer.namespace
+    start = time.time()
+    for key in keys:
+        lookup(key)
+    _report('Normalizer.namespace', count, time.time() - start)
+
+    # Every key is in the cache the second time around
+    hot = keys[:namespace.CACHE_SIZE // 2]
+    for key in hot:
+        lookup(key)
+    start = time.time()
+    for key in hot:
+        lookup(key)
+    _report('Normalizer.namespace cached', len(hot), time.time() - start)
+
+
+def stage_benchmark(count=_PACKETS):
+    """Time each stage of the pipeline on generated traffic with pipelined
+    requests, segmentation and responses: decoding the packets, handing the
+    batches through the bounded queue to another thread, and reassembling
+    and decoding the payloads.
+
+    """
+    for protocol, binary in [('ascii', False), ('binary', True)]:
+        traffic = generator.TrafficGenerator(pipeline=4, mss=512,
+                                             binary=binary)
+        packets = list(traffic.packets(count))
+        batches = ListQueue()
+        capture = BenchmarkCapture(batches, None, responses=True)
+        process = capture._process_packet
+        start = time.time()
+        for timestamp, packet in packets:
+            process(len(packet), packet, timestamp)
+        _report('%s TCPCapture._process_packet' % protocol, len(packets),
+                time.time() - start)
+        capture._flush()
+        segments = sum([len(batch) for batch in batches])
+
+        queue = pipeline.BoundedQueue()
+        consumer = threading.Thread(target=_drain,
+                                    args=(queue, len(batches)))
+        consumer.start()
+        start = time.time()
+        for batch in batches:
+            queue.put(batch)
+        consumer.join()
+        _report('%s BoundedQueue handoff' % protocol, segments,
+                time.time() - start)
+
+        decoder = memcache.Decoder(NullQueue(), responses=True)
+        start = time.time()
+        for batch in batches:
+            decoder.add_batch(batch)
+        _report('%s Decoder.add_batch' % protocol, segments,
+                time.time() - start)
+        _report_rss('%s stages' % protocol)
+
+
+def sampling_benchmark(count=_PACKETS):
+    """Time decoding the packets and payloads of generated traffic on many
+    connections when sampling 1 in 1, 4 and 16 of them, reporting the time
+    per packet captured.
+
+    """
+    traffic = generator.TrafficGenerator(connections=2000, pipeline=4,
+                                         mss=512)
+    packets = list(traffic.packets(count))
+    for sample in [1, 4, 16]:
+        batches = ListQueue()
+        capture = BenchmarkCapture(batches, None, responses=True,
+                                   sample=sample)
+        decoder = memcache.Decoder(NullQueue(), responses=True,
+                                   sample=sample)
+        process = capture._process_packet
+        start = time.time()
+        for timestamp, packet in packets:
+            process(len(packet), packet, timestamp)
+        capture._flush()
+        for batch in batches:
+            decoder.add_batch(batch)
+        _report('sample 1/%i capture and decode' % sample, len(packets),
+                time.time() - start)
+
+
+def ring_benchmark(count=_PACKETS):
+    """Compare handing batches of segments to another process through a
+    pickling multiprocessing.Queue against the shared memory Ring.
+
+    """
+    segments = [(float(value), 167772161, 40000 + value % 1000, 167772162,
+                 11211, value, 0x18, 'get user:%i:profile\r\n' % value)
+                for value in xrange(count)]
+    batches = [segments[offset:offset + network.BATCH_SIZE]
+               for offset in xrange(0, count, network.BATCH_SIZE)]
+    for name, queue in [('multiprocessing.Queue', multiprocessing.Queue()),
+                        ('Ring', ring.Ring())]:
+        process = multiprocessing.Process(target=_drain,
+                                          args=(queue, len(batches)))
+        process.start()
+        start = time.time()
+        for batch in batches:
+            queue.put(batch)
+        process.join()
+        _report(name, count, time.time() - start)
+
+
+def _drain(queue, count):
+    for value in xrange(count):
+        queue.get()
+
+
+def write_pcap(path, packets):
+    """Write packets to a classic pcap file at path.
+
+    :param str path: The file to write
+    :param list packets: The ethernet frames to write
+
+    """
+    with open(path, 'wb') as handle:
+        handle.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        for offset, packet in enumerate(packets):
+            handle.write(struct.pack('<IIII', offset // 1000000,
+                                     offset % 1000000, len(packet),
+                                     len(packet)))
+            handle.write(packet)
+
+
+def replay_benchmark(count=_PACKETS):
+    """Compare replaying a capture file at max speed against just reading
+    it from disk.
+
+    """
+    packets = [ethernet_packet('get user:%i:profile\r\n' % (value % 1000),
+                               40000 + value % 1000)
+               for value in xrange(count)]
+    handle, path = tempfile.mkstemp(suffix='.pcap')
+    os.close(handle)
+    try:
+        write_pcap(path, packets)
+        megabytes = os.path.getsize(path) / 1048576.0
+        start = time.time()
+        with open(path, 'rb') as handle:
+            while handle.read(1048576):
+                pass
+        duration = time.time() - start
+        print '%-36s %10.1f MB/s' % ('read', megabytes / duration)
+        capture = replay.ReplayCapture(NullQueue(), path, True)
+        start = time.time()
+        capture.process()
+        duration = time.time() - start
+        print '%-36s %10.1f MB/s' % ('ReplayCapture.process',
+                                     megabytes / duration)
+        _report('ReplayCapture.process', count, duration)
+    finally:
+        os.unlink(path)
+
+
+BENCHMARKS = {'datalink': datalink_benchmark,
+              'decode': packet_decode_benchmark,
+              'keys': key_tracking_benchmark,
+              'namespace': namespace_benchmark,
+              'replay': replay_benchmark,
+              'ring': ring_benchmark,
+              'sampling': sampling_benchmark,
+              'stages': stage_benchmark,
+              'tokenizer': tokenizer_benchmark}
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='usage: %prog [benchmark ...]')
+    parser.add_option('--packets', '-n', type='int', default=_PACKETS,
+                      help='Number of packets per benchmark')
+    parser.add_option('--baseline',
+                      help='Compare the results with a stored baseline')
+    parser.add_option('--save-baseline',
+                      help='Store the results as a baseline')
+    options, args = parser.parse_args()
+    for name in args or sorted(BENCHMARKS):
+        print '%s:' % name
+        BENCHMARKS[name](options.packets)
+    _RESULTS['packets'] = options.packets
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as handle:
+            json.dump(_RESULTS, handle, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as handle:
+            baseline = json.load(handle)
+        regressions = 0
+        missing = 0
+        print 'compared with %s:' % options.baseline
+        if baseline.get('packets') != options.packets:
+            print 'the baseline was run with %s packets' % baseline['packets']
+        for metric in ['ns_per_packet', 'peak_rss_mb']:
+            for name, value in sorted(_RESULTS[metric].iteritems()):
+
+                # A benchmark the baseline has no result for is not checked,
+                # so it is reported rather than passed over
+                if name not in baseline.get(metric, dict()):
+                    missing += 1
+                    print '%-36s %10s %s MISSING' % (name, '', metric)
+                    continue
+                change = value / baseline[metric][name] - 1
+                regressed = change > _REGRESSION
+                regressions += regressed
+                print '%-36s %+9.1f%% %s%s' % (name, change * 100, metric,
+                                               ' REGRESSION' * regressed)
+        if missing:
+            print '%i results are missing from the baseline, store it again ' \
+                'with --save-baseline' % missing
+        sys.exit(1 if regressions or missing else 0)
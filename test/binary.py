@@ -0,0 +1,114 @@
+__author__ = 'gmr'
+
+import struct
+import sys
+sys.path.insert(0, '..')
+
+from menwith import memcache
+
+_CLIENT = (0x0a000001, 40000, 0x0a000002, 11211)
+_HEADER = struct.Struct('!BBHBBHIIQ')
+
+
+def _request(opcode, key='', extras='', value='', opaque=0):
+    """Return a binary protocol request.
+
+    :param int opcode: The opcode
+    :param str key: The key
+    :param str extras: The extras
+    :param str value: The value
+    :param int opaque: The opaque
+    :returns: str
+
+    """
+    return _HEADER.pack(0x80, opcode, len(key), len(extras), 0, 0,
+                        len(extras) + len(key) + len(value), opaque,
+                        0) + extras + key + value
+
+
+def _decode(payloads, sequence=0):
+    """Return a decoder that decoded the payloads, sent in order on one
+    connection.
+
+    :param list payloads: The TCP payloads
+    :param int sequence: The sequence number of the first payload
+    :returns: memcache.Decoder
+
+    """
+    decoder = memcache.Decoder(None)
+    batch = list()
+    for payload in payloads:
+        batch.append((0.0,) + _CLIENT + (sequence, 0, payload))
+        sequence += len(payload)
+    decoder.add_batch(batch)
+    return decoder
+
+
+def _used(decoder):
+    """Return the commands counted and the keys used by a decoder.
+
+    :param memcache.Decoder decoder: The decoder
+    :returns: tuple
+
+    """
+    return (dict([(command, count) for command, count in
+                  decoder.counts.iteritems() if count]), decoder.keys)
+
+
+def opcodes_test():
+    """Check each opcode, quiet ones included, is counted under its ASCII
+    command with the key it uses, and values are jumped over whatever is
+    in them.
+
+    """
+    value = _request(0x00, 'inside') * 3
+    decoder = _decode([_request(0x00, 'a') +
+                       _request(0x0d, 'b') +
+                       _request(0x01, 'c', '\x00' * 8, value) +
+                       _request(0x11, 'd', '\x00' * 8, 'v') +
+                       _request(0x04, 'a') +
+                       _request(0x05, 'e', '\x00' * 20) +
+                       _request(0x1d, 'f', '\x00' * 4) +
+                       _request(0x0a) +
+                       _request(0x10, 'slabs') +
+                       _request(0x21, 'PLAIN', value='secret')])
+    counts, keys = _used(decoder)
+    assert counts == {'get': 2, 'set': 2, 'delete': 1, 'incr': 1,
+                      'gat': 1, 'noop': 1, 'stats': 1, 'sasl': 1}, counts
+    assert keys == {'a': 2, 'b': 1, 'c': 1, 'd': 1, 'e': 1, 'f': 1,
+                    'slabs': 1, 'PLAIN': 1}, keys
+
+
+def split_test():
+    """Check a header, key and value split across segments are decoded
+    once all of them have arrived.
+
+    """
+    data = _request(0x01, 'key', '\x00' * 8, 'x' * 1000) + \
+        _request(0x00, 'other')
+    decoder = _decode([data[:10], data[10:34], data[34:40], data[40:500],
+                       data[500:]])
+    counts, keys = _used(decoder)
+    assert counts == {'set': 1, 'get': 1}, counts
+    assert keys == {'key': 1, 'other': 1}, keys
+
+
+def resynchronize_test():
+    """Check decoding starts again at the next request header after a gap
+    in the stream too long to wait out.
+
+    """
+    requests = _request(0x00, 'b') * 12000
+    decoder = _decode([_request(0x00, 'a')])
+    decoder.add_batch([(0.0,) + _CLIENT + (30, 0, 'tail of a value' +
+                                           requests)])
+    counts, keys = _used(decoder)
+    assert counts == {'get': 12001}, counts
+    assert keys == {'a': 1, 'b': 12000}, keys
+
+
+if __name__ == '__main__':
+    opcodes_test()
+    split_test()
+    resynchronize_test()
+    print 'ok'
@@ -0,0 +1,133 @@
+__author__ = 'gmr'
+
+import optparse
+import os
+import sys
+import tempfile
+import time
+sys.path.insert(0, '..')
+
+import traffic
+from menwith import checkpoint
+from menwith import manager
+from menwith import memcache
+from menwith import namespace
+from menwith import pipeline
+from menwith import sketch
+
+_SETTINGS = {'sample': 1, 'top_keys': None, 'key_error': sketch.KEY_ERROR,
+             'responses': True, 'distinct': True, 'namespaces': None,
+             'mrc': False, 'mrc_rate': 0.01, 'mrc_keys': 100000}
+
+
+def checkpoint_test(requests=20000):
+    """Write the state of decoded traffic to a checkpoint, resume a new
+    decoder from it, and check the counts are carried on, and that one
+    gathered with other options or damaged is refused.
+
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'menwith.ckpt')
+    decoder = traffic.decode(requests, responses=True, distinct=True)
+
+    start = time.time()
+    checkpoint.write(path, _SETTINGS, decoder.state())
+    print 'wrote %i bytes in %.3fs' % (os.path.getsize(path),
+                                       time.time() - start)
+    start = time.time()
+    settings, state = checkpoint.read(path)
+    assert settings == _SETTINGS
+    print 'read in %.3fs' % (time.time() - start)
+
+    resumed = traffic.decode(requests, state, responses=True, distinct=True)
+    assert sum(resumed.counts.values()) == 2 * requests
+    for key, count in decoder.keys.iteritems():
+        assert resumed.keys[key] == 2 * count, key
+    snapshot = resumed.snapshot()
+    assert snapshot['histograms']['latency']['get']['count'] == \
+        2 * decoder.snapshot()['histograms']['latency']['get']['count']
+
+    # Periodic checkpoints are written by a child
+    checkpointer = checkpoint.Checkpointer(path, _SETTINGS, 0)
+    assert checkpointer.due()
+    checkpointer.checkpoint(resumed.state())
+    checkpointer.finish(resumed.state())
+    assert checkpointer.written == 2, checkpointer.written
+    assert sum(checkpoint.read(path)[1]['counts'].values()) == 2 * requests
+
+    # Resuming with other options the state depends on is refused
+    options = optparse.Values(dict(_SETTINGS))
+    assert checkpoint.mismatched(settings, options) == list()
+    options.sample = 10
+    options.top_keys = 100
+    options.responses = False
+    options.namespaces = namespace.Normalizer()
+    assert checkpoint.mismatched(settings, options) == [
+        '--sample', '--top-keys', '--responses', '--namespaces']
+
+    # The namespaces are compared by their rules
+    options = optparse.Values(dict(_SETTINGS,
+                                   namespaces=namespace.Normalizer()))
+    settings = checkpoint.settings(options)
+    options.namespaces = namespace.Normalizer()
+    assert checkpoint.mismatched(settings, options) == list()
+    options.namespaces = namespace.Normalizer(patterns=['user:*'])
+    assert checkpoint.mismatched(settings, options) == ['--namespaces']
+
+    # A damaged checkpoint is refused
+    with open(path, 'r+b') as handle:
+        handle.seek(-1, os.SEEK_END)
+        last = handle.read(1)
+        handle.seek(-1, os.SEEK_END)
+        handle.write(chr(ord(last) ^ 1))
+    try:
+        checkpoint.read(path)
+    except ValueError as error:
+        print 'refused: %s' % error
+    else:
+        raise AssertionError('a damaged checkpoint should be refused')
+    os.unlink(path)
+    os.rmdir(os.path.dirname(path))
+
+
+def decode_test(requests=20000, top_keys=50):
+    """Checkpoint a decode thread over and over while it decodes, and
+    check each checkpoint has the statistics as they were between batches
+    and can be resumed from.
+
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'menwith.ckpt')
+    settings = dict(_SETTINGS, top_keys=top_keys)
+    queue = pipeline.BoundedQueue()
+    decode = manager.Decode()
+    decode.options = optparse.Values(dict(
+        settings, port=[11211], servers=None, slabs=False,
+        replay='replay.pcap', resume=None))
+    decode.queue = queue
+    decode.start()
+    checkpointer = checkpoint.Checkpointer(path, settings, 0)
+    for index, batch in enumerate(traffic.batches(requests)):
+        queue.put(batch)
+        if index % 10:
+            continue
+        written = checkpointer.written
+        decode.checkpoint(checkpointer)
+        checkpointer.wait()
+        if checkpointer.written == written:
+            continue
+        resumed = memcache.Decoder(None, top_keys=top_keys)
+        resumed.merge(checkpoint.read(path)[1])
+        assert sum(resumed.counts.values()) <= requests
+        assert len(resumed.keys) <= top_keys
+    decode.stop_process()
+    decode.join()
+    assert sum(decode.state()['counts'].values()) == requests
+    print 'resumed from %i checkpoints taken while decoding' % \
+        checkpointer.written
+    os.unlink(path)
+    os.rmdir(os.path.dirname(path))
+
+
+if __name__ == '__main__':
+    checkpoint_test()
+    decode_test()
+    print 'ok'
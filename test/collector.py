@@ -0,0 +1,222 @@
+__author__ = 'gmr'
+
+import optparse
+import socket
+import sys
+import time
+sys.path.insert(0, '..')
+
+import traffic
+from menwith import collector
+from menwith import memcache
+from menwith import sketch
+
+# The number of agents and the deltas each sends
+AGENTS = 4
+DELTAS = 5
+
+
+def _options():
+    """Return the options of a collector on a free localhost port.
+
+    :returns: optparse.Values
+
+    """
+    return optparse.Values({'port': [11211], 'responses': True,
+                            'top_keys': 100, 'key_error': sketch.KEY_ERROR,
+                            'distinct': True, 'servers': None,
+                            'namespaces': None, 'sample': 1, 'slabs': True,
+                            'resume': None, 'collect': 0,
+                            'collect_address': '127.0.0.1'})
+
+
+def _add_servers(servers, added):
+    """Add the stats of each server to those in servers.
+
+    :param dict servers: The stats of each server, added to
+    :param dict added: The stats of each server to add
+
+    """
+    for name, stats in added.iteritems():
+        server = servers.setdefault(name, {'counts': dict(), 'keys': 0,
+                                           'hits': 0, 'misses': 0,
+                                           'value_bytes': 0})
+        for command, count in stats['counts'].iteritems():
+            server['counts'][command] = server['counts'].get(command, 0) + \
+                count
+        for name in ['keys', 'hits', 'misses', 'value_bytes']:
+            server[name] += stats[name]
+
+
+def collector_test(requests=20000):
+    """Have several agents on loopback each decode traffic of their own,
+    sending a delta of their statistics a few times along the way, and
+    check the collector merged every request once, including a frame sent
+    again, with the same server stats as decoding without draining, and
+    refuses an agent sampling differently.
+
+    """
+    fleet = collector.Collector(_options())
+    fleet.start()
+    totals = dict()
+    servers = dict()
+    try:
+        for index in xrange(AGENTS):
+            agent = collector.Agent(fleet.address, 'agent-%i' % index, 1)
+            agent.start()
+            decoder = memcache.Decoder(None, responses=True, top_keys=100,
+                                       distinct=True)
+            batches = traffic.batches(requests, seed=index + 1)
+            whole = memcache.Decoder(None, responses=True, top_keys=100)
+            for batch in batches:
+                whole.add_batch(batch)
+            whole.finish()
+            _add_servers(servers, whole.servers)
+            step = len(batches) // DELTAS + 1
+            for first in xrange(0, len(batches), step):
+                for batch in batches[first:first + step]:
+                    decoder.add_batch(batch)
+                decoder.finish()
+                delta = decoder.drain()
+                for command, count in delta['counts'].iteritems():
+                    totals[command] = totals.get(command, 0) + count
+                agent.send(delta)
+            agent.finish(decoder.drain())
+            assert not agent._pending
+
+            # A frame the collector already merged is not merged again
+            agent._sequence -= 1
+            agent._add(delta)
+            assert agent._flush()
+            agent._close()
+            print '%s sent %i deltas in %i bytes' % (agent.name, agent.sent,
+                                                     agent.bytes)
+
+        counts = fleet.values()[0]
+        for command, count in totals.iteritems():
+            assert counts[command] == count, (command, counts[command],
+                                              count)
+        assert sum(counts.values()) == AGENTS * requests
+        assert fleet.values()[4] == servers, (fleet.values()[4], servers)
+        snapshot = fleet.snapshot()
+        assert sum(snapshot['counts'].values()) == AGENTS * requests
+        assert snapshot['requests'], snapshot['requests']
+        agents = fleet.agents()
+        assert len(agents) == AGENTS
+        for name, stats in sorted(agents.iteritems()):
+            assert not stats['lost'], stats
+            print name, stats
+
+        # An agent sampling differently is dropped
+        agent = collector.Agent(fleet.address, 'sampled', 4)
+        agent._add(memcache.Decoder(None, top_keys=100).drain())
+        assert not agent._flush()
+        assert 'sampled' not in fleet.agents()
+    finally:
+        fleet.stop_process()
+        fleet.join()
+
+
+def invalid_test(requests=2000):
+    """Check an agent sending deltas the collector can not merge is dropped
+    with none of the frame merged.
+
+    """
+    delta = traffic.decode(requests, responses=True, top_keys=100).drain()
+    fleet = collector.Collector(_options())
+    fleet.start()
+    try:
+        agent = collector.Agent(fleet.address, 'valid', 1)
+        agent._add(delta)
+        assert agent._flush()
+        agent._close()
+        counts = dict(fleet.values()[0])
+        servers = fleet.values()[4]
+        for name, change in [
+                ('missing', lambda delta: delta.pop('flows')),
+                ('counts', lambda delta: delta.update(counts=['get'])),
+                ('latency', lambda delta: delta['command_latency'].update(
+                    get=sketch.HyperLogLog())),
+                ('keys', lambda delta: delta['keys']._errors.clear()),
+                ('servers', lambda delta: [
+                    stats['counts'].update(unknown=1)
+                    for stats in delta['endpoints'].itervalues()]),
+                ('window', lambda delta: delta['windows'].update(
+                    requests=delta['windows']['responses']))]:
+            invalid = traffic.decode(requests, responses=True,
+                                     top_keys=100).drain()
+            change(invalid)
+            agent = collector.Agent(fleet.address, name, 1)
+            agent._add(delta)
+            agent._add(invalid)
+            assert not agent._flush(), name
+            agent._close()
+            assert name not in fleet.agents(), name
+        assert fleet.values()[0] == counts
+        assert fleet.values()[4] == servers
+    finally:
+        fleet.stop_process()
+        fleet.join()
+
+
+def frames_test(requests=2000, deltas=5):
+    """Check an agent splits the deltas waiting between frames the
+    collector accepts, and drops a delta too large for any frame.
+
+    """
+    delta = traffic.decode(requests, responses=True, top_keys=100).drain()
+    compressed, length = collector.compress(delta)
+    maximum = collector.MAX_FRAME
+    collector.MAX_FRAME = 2 * len(compressed) + collector._FRAME_OVERHEAD
+    fleet = collector.Collector(_options())
+    fleet.start()
+    try:
+        agent = collector.Agent(fleet.address, 'split', 1)
+        for index in xrange(deltas):
+            agent._add(delta)
+        assert agent._flush()
+        assert agent.sent == deltas and agent.frames == 3, agent.frames
+        assert sum(fleet.values()[0].values()) == deltas * requests
+
+        collector.MAX_FRAME = len(compressed)
+        agent._add(delta)
+        assert agent.dropped == 1 and not agent._pending
+        agent._close()
+    finally:
+        collector.MAX_FRAME = maximum
+        fleet.stop_process()
+        fleet.join()
+    print '%i deltas of %i bytes sent in %i frames' % (deltas,
+                                                       len(compressed),
+                                                       agent.frames)
+
+
+def background_test():
+    """Check sending a delta does not wait on a collector that does not
+    answer, the agent thread does.
+
+    """
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    timeout = collector._TIMEOUT
+    collector._TIMEOUT = 0.5
+    try:
+        agent = collector.Agent(listener.getsockname(), 'stalled', 1)
+        agent.start()
+        start = time.time()
+        agent.send(memcache.Decoder(None, top_keys=100).drain())
+        assert time.time() - start < 0.1
+        agent.finish(memcache.Decoder(None, top_keys=100).drain())
+        assert len(agent._pending) == 2 and not agent.sent
+    finally:
+        collector._TIMEOUT = timeout
+        listener.close()
+
+
+if __name__ == '__main__':
+    collector_test()
+    invalid_test()
+    frames_test()
+    background_test()
+    print 'ok'
@@ -0,0 +1,139 @@
+__author__ = 'gmr'
+
+import os
+import struct
+import sys
+import tempfile
+sys.path.insert(0, '..')
+
+import pcap
+
+import generator
+import traffic
+from menwith import memcache
+from menwith import network
+from menwith import replay
+from menwith import sampling
+
+_WORD = struct.Struct('!I')
+
+
+def _segments(link, ip, requests, sample=1):
+    """Return the segments decoded from generated traffic on a link layer
+    and IP version.
+
+    :param str link: The link layer
+    :param str ip: The IP version
+    :param int requests: The number of requests to generate
+    :param int sample: Keep 1 in this many connections
+    :returns: list
+
+    """
+    return [segment for batch in traffic.batches(requests, sample, link=link,
+                                                 ip=ip)
+            for segment in batch]
+
+
+def _without_addresses(segment):
+    """Return a segment without its source and destination addresses.
+
+    :param tuple segment: The segment
+    :returns: tuple
+
+    """
+    return segment[:1] + segment[2:3] + segment[4:]
+
+
+def datalink_test(requests=5000):
+    """Decode the same traffic on every link layer and IP version and check
+    the same TCP segments come out, apart from the addresses, and that the
+    decoder reports IPv6 servers by their address.
+
+    """
+    expected = [_without_addresses(segment) for segment in
+                _segments('ethernet', 'ipv4', requests)]
+    for link in sorted(generator.LINKS):
+        for ip in generator.IPS:
+            segments = _segments(link, ip, requests)
+            assert [_without_addresses(segment)
+                    for segment in segments] == expected, (link, ip)
+            print '%-8s %-12s %i segments' % (link, ip, len(segments))
+
+    decoder = memcache.Decoder(None, responses=True)
+    decoder.add_batch(_segments('sll2', 'ipv6', requests))
+    assert sum(decoder.counts.values()) == requests
+    assert decoder.servers.keys() == ['[fd00::2]:11211'], decoder.servers
+
+
+def replay_test(requests=5000):
+    """Replay capture files of each link layer and check every request is
+    decoded.
+
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'datalink.pcap')
+    try:
+        for link in sorted(generator.LINKS):
+            generator.write_pcap(path, generator.TrafficGenerator(
+                link=link, ip='ipv6-options').packets(requests), link)
+            batches = traffic.ListQueue()
+            replay.ReplayCapture(batches, path, True).process()
+            decoder = memcache.Decoder(None, responses=True)
+            for batch in batches:
+                decoder.add_batch(batch)
+            assert sum(decoder.counts.values()) == requests, link
+    finally:
+        os.unlink(path)
+
+
+def sampling_test(requests=5000, rate=4):
+    """Check IPv6 connections are sampled as the BPF expression computes
+    the hash, from the words of the addresses and the ports.
+
+    """
+    for segment in _segments('ethernet', 'ipv6', requests, rate):
+        source, source_port, destination, destination_port = segment[1:5]
+        value = source_port ^ destination_port
+        for address in [source, destination]:
+            for shift in xrange(0, 128, 32):
+                value ^= (address >> shift) & 0xffffffff
+        value = (value * 0x9e3779b1) & 0xffffffff
+        assert not (value >> 16) % rate
+        assert sampling.keep(rate, source, source_port, destination,
+                             destination_port)
+
+
+def filter_test(requests=5000, rate=4):
+    """Compile the sampling filter with libpcap and run it over generated
+    IPv4 and IPv6 capture files, checking it keeps the segments of the
+    connections the flow hash keeps, and nothing else.
+
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'filter.pcap')
+    try:
+        for ip in ['ipv4', 'ipv6']:
+            generator.write_pcap(path, generator.TrafficGenerator(
+                ip=ip).packets(requests))
+            capture = pcap.pcapObject()
+            capture.open_offline(path)
+            capture.setfilter(sampling.bpf_sample(rate), 1, 0)
+            batches = traffic.ListQueue()
+            decoding = network.PacketCapture(batches)
+            while capture.dispatch(-1, decoding._process_packet) > 0:
+                pass
+            decoding._flush()
+            kept = [segment for batch in batches for segment in batch]
+            expected = _segments('ethernet', ip, requests, rate)
+            assert kept and kept == expected, (ip, len(kept), len(expected))
+            print '%-4s kept %i of %i segments' % (
+                ip, len(kept), len(_segments('ethernet', ip, requests)))
+    finally:
+        os.unlink(path)
+        os.rmdir(os.path.dirname(path))
+
+
+if __name__ == '__main__':
+    datalink_test()
+    replay_test()
+    sampling_test()
+    filter_test()
+    print 'ok'
@@ -0,0 +1,85 @@
+__author__ = 'gmr'
+
+import re
+import sys
+import time
+import urllib2
+sys.path.insert(0, '..')
+
+import traffic
+from menwith import exporter
+
+# A sample line of the exposition format, with optional labels
+_SAMPLE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*'
+                     r'(\{([a-zA-Z_][a-zA-Z0-9_]*="([^"\\]|\\.)*",?)*\})?'
+                     r' [-+]?([0-9.e+-]+|Inf|NaN)$')
+
+
+def _scrape(address, path='/metrics'):
+    return urllib2.urlopen('http://%s:%i%s' % (address[0], address[1], path))
+
+
+def exporter_test(requests=20000):
+    """Serve the metrics of generated traffic on a free localhost port and
+    check the exposition, that scrapes are answered from the text rendered
+    each interval and that other paths are not found.
+
+    """
+    decoder = traffic.decode(requests, responses=True, top_keys=100)
+    telemetry = lambda: {'queue': {'policy': 'block', 'enqueued': requests,
+                                   'dropped': 0, 'peak_fill': 0.5},
+                         'capture': {'received': requests, 'dropped': 0,
+                                     'ifdropped': 0}}
+    metrics = exporter.Exporter(decoder.snapshot, telemetry, port=0,
+                                interval=0.5)
+    metrics.start()
+    try:
+        response = _scrape(metrics.address)
+        assert response.info()['Content-Type'].startswith('text/plain')
+        text = response.read()
+        for line in text.splitlines():
+            if not line.startswith('#'):
+                assert _SAMPLE.match(line), line
+        for name in ['menwith_requests_total', 'menwith_request_rate',
+                     'menwith_top_key_requests',
+                     'menwith_latency_microseconds_bucket',
+                     'menwith_value_size_bytes_bucket',
+                     'menwith_queue_dropped_total',
+                     'menwith_pcap_received_total']:
+            assert '\n%s' % name in text, name
+        total = sum([int(line.rsplit(' ', 1)[1])
+                     for line in text.splitlines()
+                     if line.startswith('menwith_requests_total')])
+        assert total == requests, total
+        print 'rendered %i bytes, %i lines' % (len(text),
+                                              len(text.splitlines()))
+
+        # Scrapes are answered from the text rendered each interval
+        renders = metrics.renders
+        start = time.time()
+        for index in xrange(100):
+            _scrape(metrics.address).read()
+        duration = time.time() - start
+        print '100 scrapes in %.3fs, %i renders' % (
+            duration, metrics.renders - renders)
+        assert metrics.renders - renders <= duration / 0.5 + 1
+
+        # Renders carry on without scrapes
+        renders = metrics.renders
+        time.sleep(1.2)
+        assert metrics.renders - renders >= 2, metrics.renders
+        print 'without scrapes, %i renders' % (metrics.renders - renders)
+
+        try:
+            _scrape(metrics.address, '/')
+        except urllib2.HTTPError as error:
+            assert error.code == 404
+        else:
+            raise AssertionError('/ should not be found')
+    finally:
+        metrics.stop()
+    print 'ok'
+
+
+if __name__ == '__main__':
+    exporter_test()
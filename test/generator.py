@@ -0,0 +1,439 @@
+"""
+Write synthetic memcached traffic to a pcap file
+
+Clients on a number of connections send requests in a configurable command
+mix, for keys picked with a Zipf skew, with log-normally distributed value
+sizes. Requests are written in pipelined groups, cut into segments no
+longer than the MSS, and each group is answered by the server after a short
+latency, in the ASCII or binary protocol, over IPv4 or IPv6 in Ethernet
+frames, with or without VLAN tags, or in Linux cooked capture headers.
+
+"""
+__author__ = 'gmr'
+
+import bisect
+import heapq
+import math
+import optparse
+import random
+import struct
+
+_ETHERNET = struct.Struct('!6s6sH')
+_VLAN_TAG = struct.Struct('!HH')
+_SLL = struct.Struct('!HHH8sH')
+_SLL2 = struct.Struct('!HHIHBB8s')
+_IPV4 = struct.Struct('!BBHHHBBH4s4s')
+_IPV6 = struct.Struct('!IHBB16s16s')
+_IPV6_OPTIONS = struct.Struct('!BB6s')
+_TCP = struct.Struct('!HHIIBBHHH')
+_PCAP_HEADER = struct.Struct('<IHHiIII')
+_PCAP_RECORD = struct.Struct('<IIII')
+_MAC_CLIENT = '\x00\x11\x22\x33\x44\x55'
+_MAC_SERVER = '\x66\x77\x88\x99\xaa\xbb'
+
+_CLIENT = '\x0a\x00\x00\x01'
+_SERVER = '\x0a\x00\x00\x02'
+_CLIENT6 = '\xfd\x00' + '\x00' * 13 + '\x01'
+_SERVER6 = '\xfd\x00' + '\x00' * 13 + '\x02'
+
+# The link layers and their link types, and the IP versions, ipv6-options
+# carrying hop-by-hop and destination options headers before the TCP header
+LINKS = {'ethernet': 1, 'vlan': 1, 'qinq': 1, 'sll': 113, 'sll2': 276}
+IPS = ['ipv4', 'ipv6', 'ipv6-options']
+_ETHERTYPE_IPV4 = 0x0800
+_ETHERTYPE_IPV6 = 0x86dd
+_ETHERTYPE_VLAN = 0x8100
+_ETHERTYPE_QINQ = 0x88a8
+_HOP_BY_HOP = 0
+_DESTINATION_OPTIONS = 60
+_TCP_PROTOCOL = 6
+_PUSH_ACK = 0x18
+
+# The binary protocol header and the opcodes used
+_BINARY = struct.Struct('!BBHBBHIIQ')
+_REQUEST = 0x80
+_RESPONSE = 0x81
+_GET = 0x00
+_SET = 0x01
+_DELETE = 0x04
+_INCREMENT = 0x05
+_NOOP = 0x0a
+_GETKQ = 0x0d
+_STAT = 0x10
+_NOT_FOUND = 0x0001
+
+# The default traffic shape
+MIX = 'get=60,multiget=15,set=15,delete=5,incr=4,stats=1'
+COMMANDS = ['get', 'multiget', 'set', 'delete', 'incr', 'stats']
+KEYS = 100000
+ZIPF = 0.99
+VALUE_SIZE = 256
+VALUE_SIGMA = 1.0
+MAX_VALUE_SIZE = 1048576
+MULTIGET_KEYS = 5
+HIT_RATIO = 0.8
+PIPELINE = 1
+MSS = 1460
+CONNECTIONS = 100
+RATE = 10000
+LATENCY = 0.0002
+
+_VALUE = 'v' * MAX_VALUE_SIZE
+
+
+def parse_mix(value):
+    """Return the command mix in a string such as get=60,set=40 as a list of
+    commands and their cumulative weights.
+
+    :param str value: The command mix
+    :rtype: list
+    :raises: ValueError
+
+    """
+    mix = list()
+    total = 0
+    for part in value.split(','):
+        command, weight = part.split('=')
+        if command not in COMMANDS:
+            raise ValueError('Unknown command in mix: %s' % command)
+        total += float(weight)
+        mix.append((total, command))
+    if not total:
+        raise ValueError('The command mix has no weight')
+    return [(weight / total, command) for weight, command in mix]
+
+
+class ZipfKeys(object):
+    """Picks keys from a fixed key space with a Zipf skew, the key of rank r
+    being picked in proportion to 1 / r ** exponent.
+
+    """
+    def __init__(self, generator, count=KEYS, exponent=ZIPF):
+        self._generator = generator
+        total = 0.0
+        self._cumulative = list()
+        for rank in xrange(1, count + 1):
+            total += 1.0 / rank ** exponent
+            self._cumulative.append(total)
+        self._total = total
+
+    def key(self):
+        rank = bisect.bisect_left(self._cumulative,
+                                  self._generator.random() * self._total)
+        return 'user:%i:profile' % rank
+
+
+class TrafficGenerator(object):
+    """Generates the packets of synthetic memcached traffic in time order."""
+
+    def __init__(self, mix=MIX, keys=KEYS, zipf=ZIPF, value_size=VALUE_SIZE,
+                 value_sigma=VALUE_SIGMA, hit_ratio=HIT_RATIO,
+                 pipeline=PIPELINE, mss=MSS, connections=CONNECTIONS,
+                 rate=RATE, binary=False, responses=True, port=11211,
+                 seed=1, link='ethernet', ip='ipv4'):
+        if link not in LINKS:
+            raise ValueError('Unknown link layer: %s' % link)
+        if ip not in IPS:
+            raise ValueError('Unknown IP version: %s' % ip)
+        self._generator = random.Random(seed)
+        self._mix = parse_mix(mix)
+        self._keys = ZipfKeys(self._generator, keys, zipf)
+        self._value_size = value_size
+        self._value_sigma = value_sigma
+        self._hit_ratio = hit_ratio
+        self._pipeline = pipeline
+        self._mss = mss
+        self._connections = connections
+        self._rate = rate
+        self._binary = binary
+        self._responses = responses
+        self._port = port
+        self._opaque = 0
+        self._link = link
+        self._ip = ip
+
+    def _command(self):
+        choice = self._generator.random()
+        for weight, command in self._mix:
+            if choice <= weight:
+                return command
+        return self._mix[-1][1]
+
+    def _hit(self):
+        return self._generator.random() < self._hit_ratio
+
+    def _size(self):
+        size = int(self._generator.lognormvariate(math.log(self._value_size),
+                                                  self._value_sigma))
+        return min(max(size, 1), MAX_VALUE_SIZE)
+
+    def _ascii(self, command):
+        """Return an ASCII request and its response."""
+        key = self._keys.key()
+        if command == 'get' or command == 'multiget':
+            keys = [key]
+            if command == 'multiget':
+                keys.extend([self._keys.key()
+                             for value in xrange(MULTIGET_KEYS - 1)])
+            response = list()
+            for key in keys:
+                if self._hit():
+                    size = self._size()
+                    response.append('VALUE %s 0 %i\r\n%s\r\n' %
+                                    (key, size, _VALUE[:size]))
+            response.append('END\r\n')
+            return 'get %s\r\n' % ' '.join(keys), ''.join(response)
+        if command == 'set':
+            size = self._size()
+            return ('set %s 0 0 %i\r\n%s\r\n' % (key, size, _VALUE[:size]),
+                    'STORED\r\n')
+        if command == 'delete':
+            return ('delete %s\r\n' % key,
+                    'DELETED\r\n' if self._hit() else 'NOT_FOUND\r\n')
+        if command == 'incr':
+            return ('incr %s 1\r\n' % key,
+                    '%i\r\n' % self._generator.randint(1, 100000)
+                    if self._hit() else 'NOT_FOUND\r\n')
+        return 'stats\r\n', 'STAT pid 1\r\nSTAT uptime 3600\r\nEND\r\n'
+
+    def _binary_message(self, magic, opcode, key='', extras='', value='',
+                        status=0, opaque=0):
+        return (_BINARY.pack(magic, opcode, len(key), len(extras), 0, status,
+                             len(extras) + len(key) + len(value), opaque, 0) +
+                extras + key + value)
+
+    def _binary_get(self, opcode, key):
+        """Return a binary get request and its response, empty for a quiet
+        get that missed.
+
+        """
+        self._opaque += 1
+        request = self._binary_message(_REQUEST, opcode, key,
+                                       opaque=self._opaque)
+        if self._hit():
+            return request, self._binary_message(
+                _RESPONSE, opcode, key if opcode == _GETKQ else '',
+                '\x00' * 4, _VALUE[:self._size()], opaque=self._opaque)
+        if opcode == _GETKQ:
+            return request, ''
+        return request, self._binary_message(_RESPONSE, opcode,
+                                             value='Not found',
+                                             status=_NOT_FOUND,
+                                             opaque=self._opaque)
+
+    def _binary_request(self, command):
+        """Return a binary request and its response."""
+        key = self._keys.key()
+        if command == 'get':
+            return self._binary_get(_GET, key)
+        if command == 'multiget':
+            messages = [self._binary_get(_GETKQ, key)]
+            messages.extend([self._binary_get(_GETKQ, self._keys.key())
+                             for value in xrange(MULTIGET_KEYS - 1)])
+            self._opaque += 1
+            messages.append((self._binary_message(_REQUEST, _NOOP,
+                                                  opaque=self._opaque),
+                             self._binary_message(_RESPONSE, _NOOP,
+                                                  opaque=self._opaque)))
+            return (''.join([request for request, response in messages]),
+                    ''.join([response for request, response in messages]))
+        self._opaque += 1
+        opaque = self._opaque
+        if command == 'set':
+            return (self._binary_message(_REQUEST, _SET, key, '\x00' * 8,
+                                         _VALUE[:self._size()],
+                                         opaque=opaque),
+                    self._binary_message(_RESPONSE, _SET, opaque=opaque))
+        if command == 'delete' or command == 'incr':
+            opcode = _DELETE if command == 'delete' else _INCREMENT
+            extras = '\x00' * 20 if command == 'incr' else ''
+            if self._hit():
+                response = self._binary_message(
+                    _RESPONSE, opcode,
+                    value='\x00' * 8 if command == 'incr' else '',
+                    opaque=opaque)
+            else:
+                response = self._binary_message(_RESPONSE, opcode,
+                                                value='Not found',
+                                                status=_NOT_FOUND,
+                                                opaque=opaque)
+            return (self._binary_message(_REQUEST, opcode, key, extras,
+                                         opaque=opaque), response)
+        return (self._binary_message(_REQUEST, _STAT, opaque=opaque),
+                self._binary_message(_RESPONSE, _STAT, 'pid', value='1',
+                                     opaque=opaque) +
+                self._binary_message(_RESPONSE, _STAT, opaque=opaque))
+
+    def _ip_packet(self, to_server, segment):
+        """Return the IP packet carrying a TCP segment and its ethertype."""
+        if self._ip == 'ipv4':
+            source, destination = ((_CLIENT, _SERVER) if to_server else
+                                   (_SERVER, _CLIENT))
+            return _ETHERTYPE_IPV4, _IPV4.pack(0x45, 0, 20 + len(segment), 0,
+                                               0, 64, _TCP_PROTOCOL, 0,
+                                               source, destination) + segment
+        source, destination = ((_CLIENT6, _SERVER6) if to_server else
+                               (_SERVER6, _CLIENT6))
+        extensions = ''
+        next_header = _TCP_PROTOCOL
+        if self._ip == 'ipv6-options':
+            extensions = (_IPV6_OPTIONS.pack(_DESTINATION_OPTIONS, 0,
+                                             '\x01\x04' + '\x00' * 4) +
+                          _IPV6_OPTIONS.pack(_TCP_PROTOCOL, 0,
+                                             '\x01\x04' + '\x00' * 4))
+            next_header = _HOP_BY_HOP
+        return _ETHERTYPE_IPV6, _IPV6.pack(
+            6 << 28, len(extensions) + len(segment), next_header, 64, source,
+            destination) + extensions + segment
+
+    def _frame(self, to_server, segment):
+        """Return the link layer frame carrying a TCP segment."""
+        ethertype, packet = self._ip_packet(to_server, segment)
+        source, destination = ((_MAC_CLIENT, _MAC_SERVER) if to_server else
+                               (_MAC_SERVER, _MAC_CLIENT))
+        if self._link == 'ethernet':
+            header = _ETHERNET.pack(destination, source, ethertype)
+        elif self._link == 'vlan':
+            header = (_ETHERNET.pack(destination, source, _ETHERTYPE_VLAN) +
+                      _VLAN_TAG.pack(100, ethertype))
+        elif self._link == 'qinq':
+            header = (_ETHERNET.pack(destination, source, _ETHERTYPE_QINQ) +
+                      _VLAN_TAG.pack(200, _ETHERTYPE_VLAN) +
+                      _VLAN_TAG.pack(100, ethertype))
+        elif self._link == 'sll':
+            header = _SLL.pack(0 if to_server else 4, 1, 6,
+                               source + '\x00\x00', ethertype)
+        else:
+            header = _SLL2.pack(ethertype, 0, 2, 1, 0 if to_server else 4, 6,
+                                source + '\x00\x00')
+        return header + packet
+
+    def _segments(self, timestamp, to_server, source_port,
+                  destination_port, sequence, data):
+        """Return the packets carrying data, cut at the MSS."""
+        packets = list()
+        for offset in xrange(0, len(data), self._mss):
+            payload = data[offset:offset + self._mss]
+            tcp = _TCP.pack(source_port, destination_port,
+                            (sequence + offset) & 0xffffffff, 0, 5 << 4,
+                            _PUSH_ACK, 65535, 0, 0)
+            packets.append((timestamp, self._frame(to_server,
+                                                   tcp + payload)))
+        return packets
+
+    def packets(self, requests):
+        """Iterate over the timestamps and link layer frames of the traffic
+        for the number of requests, in time order.
+
+        """
+        sequences = [[1, 1] for value in xrange(self._connections)]
+        waiting = list()
+        timestamp = 1700000000.0
+        interval = self._pipeline / float(self._rate)
+        order = 0
+        for first in xrange(0, requests, self._pipeline):
+            connection = self._generator.randrange(self._connections)
+            client_port = 40000 + connection
+            messages = [self._binary_request(command) if self._binary else
+                        self._ascii(command) for command in
+                        [self._command() for value in
+                         xrange(min(self._pipeline, requests - first))]]
+            request = ''.join([message[0] for message in messages])
+            response = ''.join([message[1] for message in messages])
+            sequence = sequences[connection]
+            for packet in self._segments(timestamp, True,
+                                         client_port, self._port,
+                                         sequence[0], request):
+                order += 1
+                heapq.heappush(waiting, (packet[0], order, packet[1]))
+            sequence[0] += len(request)
+            if self._responses and response:
+                latency = LATENCY * self._generator.uniform(0.5, 2.0)
+                for packet in self._segments(timestamp + latency, False,
+                                             self._port,
+                                             client_port, sequence[1],
+                                             response):
+                    order += 1
+                    heapq.heappush(waiting, (packet[0], order, packet[1]))
+                sequence[1] += len(response)
+
+            # Everything before the next request can be written out
+            timestamp += interval
+            while waiting and waiting[0][0] < timestamp:
+                packet = heapq.heappop(waiting)
+                yield packet[0], packet[2]
+        while waiting:
+            packet = heapq.heappop(waiting)
+            yield packet[0], packet[2]
+
+
+def write_pcap(path, packets, link='ethernet'):
+    """Write the timestamps and frames to a classic pcap file, returning the
+    number of packets written.
+
+    """
+    count = 0
+    with open(path, 'wb') as handle:
+        handle.write(_PCAP_HEADER.pack(0xa1b2c3d4, 2, 4, 0, 0, 65535,
+                                       LINKS[link]))
+        for timestamp, frame in packets:
+            microseconds = int(round(timestamp * 1000000))
+            handle.write(_PCAP_RECORD.pack(microseconds // 1000000,
+                                           microseconds % 1000000,
+                                           len(frame), len(frame)))
+            handle.write(frame)
+            count += 1
+    return count
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='usage: %prog [options] output.pcap')
+    parser.add_option('--requests', '-n', type='int', default=100000,
+                      help='Number of requests')
+    parser.add_option('--mix', default=MIX,
+                      help='Command mix as command=weight pairs from %s' %
+                           ', '.join(COMMANDS))
+    parser.add_option('--keys', type='int', default=KEYS,
+                      help='Number of distinct keys')
+    parser.add_option('--zipf', type='float', default=ZIPF,
+                      help='Zipf exponent of the key popularity')
+    parser.add_option('--value-size', type='int', default=VALUE_SIZE,
+                      help='Median value size in bytes')
+    parser.add_option('--value-sigma', type='float', default=VALUE_SIGMA,
+                      help='Log-normal sigma of the value sizes')
+    parser.add_option('--hit-ratio', type='float', default=HIT_RATIO,
+                      help='Share of keys found')
+    parser.add_option('--pipeline', type='int', default=PIPELINE,
+                      help='Requests written together on a connection')
+    parser.add_option('--mss', type='int', default=MSS,
+                      help='Largest TCP payload per packet')
+    parser.add_option('--connections', type='int', default=CONNECTIONS,
+                      help='Number of client connections')
+    parser.add_option('--rate', type='float', default=RATE,
+                      help='Requests per second of packet time')
+    parser.add_option('--binary', action='store_true', default=False,
+                      help='Use the binary protocol instead of ASCII')
+    parser.add_option('--no-responses', action='store_true', default=False,
+                      help='Leave out the server responses')
+    parser.add_option('--port', type='int', default=11211,
+                      help='Server port')
+    parser.add_option('--seed', type='int', default=1,
+                      help='Random seed')
+    parser.add_option('--link', type='choice', choices=sorted(LINKS),
+                      default='ethernet',
+                      help='Link layer: %s' % ', '.join(sorted(LINKS)))
+    parser.add_option('--ip', type='choice', choices=IPS, default='ipv4',
+                      help='IP version: %s' % ', '.join(IPS))
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('An output file is required')
+    traffic = TrafficGenerator(options.mix, options.keys, options.zipf,
+                               options.value_size, options.value_sigma,
+                               options.hit_ratio, options.pipeline,
+                               options.mss, options.connections, options.rate,
+                               options.binary, not options.no_responses,
+                               options.port, options.seed, options.link,
+                               options.ip)
+    print 'Wrote %i packets to %s' % (
+        write_pcap(args[0], traffic.packets(options.requests), options.link),
+        args[0])
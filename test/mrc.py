@@ -0,0 +1,130 @@
+__author__ = 'gmr'
+
+import collections
+import random
+import sys
+import time
+sys.path.insert(0, '..')
+
+import generator
+import traffic
+from menwith import mrc
+
+# The cache sizes compared, in bytes
+SIZES = [1 << bits for bits in xrange(16, 27)]
+
+
+def _requests(count, keys=20000):
+    """Return requests for Zipf distributed keys, each with the fixed size
+    of its item.
+
+    :param int count: The number of requests
+    :param int keys: The number of distinct keys
+    :returns: list
+
+    """
+    random_generator = random.Random(1)
+    zipf = generator.ZipfKeys(random_generator, keys)
+    sizes = dict()
+    requests = list()
+    for request in xrange(count):
+        key = zipf.key()
+        if key not in sizes:
+            sizes[key] = 60 + int(random_generator.lognormvariate(6, 1))
+        requests.append((key, sizes[key]))
+    return requests
+
+
+def _lru_miss_ratio(requests, size):
+    """Return the miss ratio of an LRU cache of size bytes, item by item.
+
+    :param list requests: The keys requested and the sizes of their items
+    :param int size: The size of the cache
+    :returns: float
+
+    """
+    cache = collections.OrderedDict()
+    used = 0
+    misses = 0
+    for key, item_size in requests:
+        if key in cache:
+            used -= cache.pop(key)
+        else:
+            misses += 1
+        cache[key] = item_size
+        used += item_size
+        while used > size:
+            used -= cache.popitem(last=False)[1]
+    return float(misses) / len(requests)
+
+
+def accuracy_test(count=200000):
+    """Compare the curve, following every key and a sample of them in fixed
+    memory, with the miss ratios of LRU caches simulated item by item.
+
+    """
+    requests = _requests(count)
+    curves = [(1.0, mrc.MissRatioCurve(1.0, 1 << 20)),
+              (0.1, mrc.MissRatioCurve(0.1)),
+              (1.0, mrc.MissRatioCurve(1.0, 1000))]
+    for rate, curve in curves:
+        start = time.time()
+        for key, size in requests:
+            curve.reference(key, size)
+        print 'rate %.2f, %i keys followed: %i requests in %.3fs' % (
+            rate, len(curve), count, time.time() - start)
+    exact = [_lru_miss_ratio(requests, size) for size in SIZES]
+    print '%10s %8s %8s %8s %8s' % ('size', 'lru', 'all', 'sampled',
+                                    'fixed')
+    estimates = [curve.miss_ratios(SIZES) for rate, curve in curves]
+    for index, size in enumerate(SIZES):
+        print '%10i %8.4f %8.4f %8.4f %8.4f' % (
+            size, exact[index], estimates[0][index], estimates[1][index],
+            estimates[2][index])
+        assert abs(estimates[0][index] - exact[index]) < 0.01
+        assert abs(estimates[1][index] - exact[index]) < 0.05
+        assert abs(estimates[2][index] - exact[index]) < 0.05
+    assert len(curves[2][1]) == 1000
+
+
+def traffic_test(requests=100000):
+    """Decode generated traffic estimating the curve from the keys read and
+    stored, and print the miss ratios at multiples of a cache size.
+
+    """
+    decoder = traffic.decode(requests, responses=True, mrc_rate=0.1)
+    report = decoder.miss_ratio_curve.report(8 << 20)
+    assert report['references'] > requests * 0.9, report['references']
+    for multiple, size, ratio in report['memory']:
+        print '%4.1fx %10i bytes misses %.4f' % (multiple, size, ratio)
+
+
+def merge_test(count=20000):
+    """Check a curve carries on from one with the same limits, its rate
+    lowered or not, and refuses one following more keys or a higher share
+    of them.
+
+    """
+    requests = _requests(count)
+    curve = mrc.MissRatioCurve(0.5, 100)
+    for key, size in requests:
+        curve.reference(key, size)
+    assert curve.rate < 0.5
+    resumed = mrc.MissRatioCurve(0.5, 100)
+    resumed.merge(curve)
+    assert resumed.rate == curve.rate
+    assert resumed.references == curve.references
+    for rate, max_keys in [(0.5, 1000), (0.01, 100)]:
+        try:
+            mrc.MissRatioCurve(rate, max_keys).merge(curve)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('merged a curve of other limits')
+
+
+if __name__ == '__main__':
+    accuracy_test()
+    merge_test()
+    traffic_test()
+    print 'ok'
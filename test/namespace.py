@@ -0,0 +1,160 @@
+__author__ = 'gmr'
+
+import cPickle
+import sys
+sys.path.insert(0, '..')
+
+from menwith import memcache
+from menwith import namespace
+
+_UUID = '123e4567-e89b-12d3-a456-426614174000'
+
+
+def _segments(requests, started=1000.0):
+    """Return the segments of get requests and their responses on one
+    connection, each a hit with a five byte value or a miss.
+
+    :param list requests: The key and if it is a hit of each request
+    :param float started: The time of the first request
+    :returns: list
+
+    """
+    segments = list()
+    client, server = 0, 0
+    for index, (key, hit) in enumerate(requests):
+        timestamp = started + index * 0.01
+        request = 'get %s\r\n' % key
+        response = ('VALUE %s 0 5\r\nhello\r\nEND\r\n' % key if hit
+                    else 'END\r\n')
+        segments.append((timestamp, 1, 40000, 2, 11211, client, 0, request))
+        segments.append((timestamp + 0.001, 2, 11211, 1, 40000, server, 0,
+                         response))
+        client += len(request)
+        server += len(response)
+    return segments
+
+
+def patterns_test():
+    """Check keys take the explicit pattern they match, literal segments
+    before wildcards and a trailing remainder matching every segment left,
+    and that patterns with a remainder before the end are refused.
+
+    """
+    normalizer = namespace.Normalizer(
+        patterns=['user:*:profile', 'user:admin:profile', 'user:**',
+                  'cache:*:items:**'])
+    for key, expected in [('user:12:profile', 'user:*:profile'),
+                          ('user:admin:profile', 'user:admin:profile'),
+                          ('user:12:settings:theme', 'user:**'),
+                          ('user:12', 'user:**'),
+                          ('cache:eu:items:1:2:3', 'cache:*:items:**'),
+                          ('cache:eu:other:1', 'cache:eu:other:*'),
+                          ('user', 'user')]:
+        assert normalizer.normalize(key) == expected, (key, expected)
+        assert normalizer.namespace(key) == expected, (key, expected)
+    for patterns in [['user:**:profile'], ['**:user']]:
+        try:
+            namespace.Normalizer(patterns=patterns)
+        except ValueError as error:
+            print 'refused: %s' % error
+        else:
+            raise AssertionError('%r should be refused' % patterns)
+
+
+def collapse_test():
+    """Check runs of digits, long hexadecimal strings and UUIDs collapse
+    into the wildcard as asked, on every delimiter, and nothing else does.
+
+    """
+    normalizer = namespace.Normalizer(':/.')
+    for key, expected in [('user:123:profile', 'user:*:profile'),
+                          ('object:deadbeef01:meta', 'object:*:meta'),
+                          ('object:cafe:meta', 'object:cafe:meta'),
+                          ('session:%s' % _UUID, 'session:*'),
+                          ('image/42.png', 'image/*.png'),
+                          ('item:42abc', 'item:42abc'),
+                          ('plain', 'plain')]:
+        assert normalizer.normalize(key) == expected, (key, expected)
+    digits = namespace.Normalizer(collapse=['digits'])
+    assert digits.normalize('object:deadbeef01:1') == 'object:deadbeef01:*'
+    assert namespace.Normalizer(collapse=[]).normalize('user:1') == 'user:1'
+    for arguments in [{'delimiters': ''}, {'collapse': ['words']}]:
+        try:
+            namespace.Normalizer(**arguments)
+        except ValueError as error:
+            print 'refused: %s' % error
+        else:
+            raise AssertionError('%r should be refused' % arguments)
+
+
+def cache_test():
+    """Check the cache returns the same namespace for a key before and
+    after its generations rotate, keeping a key used again from the old
+    generation and dropping one that is not, and that a normalizer is
+    pickled with its rules and not its cache.
+
+    """
+    normalizer = namespace.Normalizer(cache_size=4)
+    keys = ['user:%i:profile' % index for index in xrange(5)]
+    first = [normalizer.namespace(key) for key in keys[:3]]
+    assert normalizer._old == dict.fromkeys(keys[:2], 'user:*:profile')
+    assert normalizer.namespace(keys[0]) == first[0]
+    assert keys[0] in normalizer._young
+    normalizer.namespace(keys[3])
+    assert keys[0] in normalizer._old and keys[1] not in normalizer._old
+    assert [normalizer.namespace(key) for key in keys[:3]] == first
+    for index in xrange(1000):
+        key = 'user:%i:profile' % (index % 7)
+        assert normalizer.namespace(key) == normalizer.normalize(key)
+        assert len(normalizer._young) <= 2 and len(normalizer._old) <= 2
+
+    copied = cPickle.loads(cPickle.dumps(namespace.Normalizer(
+        patterns=['user:**']), cPickle.HIGHEST_PROTOCOL))
+    assert not copied._young and not copied._old
+    assert copied.namespace('user:1:profile') == 'user:**'
+
+
+def decoder_test():
+    """Check a decoder adds up the requests, hits, misses, value bytes and
+    latencies of each namespace, and that they are carried through its
+    state into another decoder.
+
+    """
+    normalizer = namespace.Normalizer(patterns=['session:**'])
+    requests = [('user:1:profile', True), ('user:22:profile', True),
+                ('user:22:profile', False), ('session:%s' % _UUID, False),
+                ('config', True)]
+    decoder = memcache.Decoder(None, responses=True, namespaces=normalizer)
+    decoder.add_batch(_segments(requests))
+    namespaces = decoder.namespaces
+    assert sorted(namespaces) == ['config', 'session:**', 'user:*:profile']
+    user = namespaces['user:*:profile']
+    assert (user['requests'], user['hits'], user['misses'],
+            user['value_bytes']) == (3, 2, 1, 10), user
+    assert user['latency']['count'] == 3, user['latency']
+    session = namespaces['session:**']
+    assert (session['requests'], session['hits'],
+            session['misses']) == (1, 0, 1), session
+
+    # Merging the state of a decoder adds up each namespace
+    merged = memcache.Decoder(None, responses=True, namespaces=normalizer)
+    merged.add_batch(_segments(requests[:2], 2000.0))
+    merged.merge(cPickle.loads(cPickle.dumps(decoder.state(),
+                                             cPickle.HIGHEST_PROTOCOL)))
+    user = merged.namespaces['user:*:profile']
+    assert (user['requests'], user['hits'], user['misses'],
+            user['value_bytes']) == (5, 4, 1, 20), user
+    assert user['latency']['count'] == 5, user['latency']
+    assert merged.namespaces['session:**'] == namespaces['session:**']
+    drained = merged.drain()
+    assert not merged.namespaces
+    merged.merge(drained)
+    assert merged.namespaces['user:*:profile'] == user
+
+
+if __name__ == '__main__':
+    patterns_test()
+    collapse_test()
+    cache_test()
+    decoder_test()
+    print 'ok'
@@ -0,0 +1,85 @@
+__author__ = 'gmr'
+
+import csv
+import json
+import os
+import sys
+import tempfile
+sys.path.insert(0, '..')
+
+from menwith import output
+
+# The records written, each the totals of the snapshot at a second
+_SECONDS = 5
+
+
+def _snapshots(count=_SECONDS):
+    """Return snapshots of a decoder counting get requests, the totals
+    growing each second.
+
+    :param int count: The number of snapshots
+    :returns: list
+
+    """
+    return [{'started': 100.0,
+             'timestamp': 101.0 + index,
+             'counts': {'get': 10 * (index + 1), 'set': 2 * index},
+             'hits': {'get': 8 * (index + 1)},
+             'misses': {'get': 2 * (index + 1)},
+             'value_bytes': {'get': 800 * (index + 1)}}
+            for index in xrange(count)]
+
+
+def _records(path, name):
+    """Return the records in a file written in an output format.
+
+    :param str path: The file written
+    :param str name: The output format
+    :returns: list
+
+    """
+    with open(path, 'rb') as handle:
+        if name == 'binary':
+            return list(output.read_binary(handle))
+        if name == 'jsonl':
+            return [json.loads(line) for line in handle]
+        rows = list(csv.DictReader(handle))
+    return [row for row in rows if row['command'] == 'get']
+
+
+def writers_test():
+    """Check each writer holds the records in its buffer between flushes,
+    and that every record is in the file once it is closed, the snapshots
+    that are not newer left out.
+
+    """
+    directory = tempfile.mkdtemp()
+    for name, writer in sorted(output.WRITERS.iteritems()):
+        path = os.path.join(directory, 'gather.%s' % name)
+        streaming = writer(path)
+        for snapshot in _snapshots():
+            streaming.add(snapshot)
+            streaming.add(snapshot)
+        assert os.path.getsize(path) == 0, name
+        streaming.close()
+        records = _records(path, name)
+        assert len(records) == _SECONDS, (name, records)
+        print '%s wrote %i bytes' % (name, os.path.getsize(path))
+        if name != 'csv':
+            assert records[0]['seconds'] == 1.0
+            assert records[-1]['commands']['get'] == {
+                'requests': 10, 'hits': 8, 'misses': 2, 'value_bytes': 800}
+        os.unlink(path)
+
+        # Every record is flushed when asked to flush each time
+        streaming = writer(path, 0)
+        streaming.add(_snapshots()[0])
+        assert len(_records(path, name)) == 1, name
+        streaming.close()
+        os.unlink(path)
+    os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    writers_test()
+    print 'ok'
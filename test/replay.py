@@ -0,0 +1,71 @@
+__author__ = 'gmr'
+
+import os
+import struct
+import sys
+import tempfile
+sys.path.insert(0, '..')
+
+from menwith import replay
+
+_BLOCK = struct.Struct('<II')
+_SECTION_HEADER = struct.Struct('<IHHq')
+_INTERFACE = struct.Struct('<HHI')
+_ENHANCED = struct.Struct('<IIIII')
+_FRAME = '\x00' * 14 + 'frame'
+
+
+def _block(block_type, body):
+    """Return a pcapng block of the type with the body padded to 32 bits.
+
+    :param int block_type: The block type
+    :param str body: The block body
+    :returns: str
+
+    """
+    body += '\x00' * (-len(body) % 4)
+    length = len(body) + 12
+    return _BLOCK.pack(block_type, length) + body + struct.pack('<I', length)
+
+
+def _packet(interface, timestamp):
+    """Return an enhanced packet block of the interface and time.
+
+    :param int interface: The interface id
+    :param int timestamp: The timestamp in microseconds
+    :returns: str
+
+    """
+    return _block(6, _ENHANCED.pack(interface, timestamp >> 32,
+                                    timestamp & 0xffffffff, len(_FRAME),
+                                    len(_FRAME)) + _FRAME)
+
+
+def undescribed_interface_test():
+    """Check packet blocks before any interface description, or of an
+    interface that is not described, are skipped rather than ending the
+    replay.
+
+    """
+    data = ''.join([_block(0x0a0d0d0a,
+                           _SECTION_HEADER.pack(0x1a2b3c4d, 1, 0, -1)),
+                    _packet(0, 1000000),
+                    _block(1, _INTERFACE.pack(1, 0, 65535)),
+                    _packet(5, 2000000),
+                    _packet(0, 3000000)])
+    path = os.path.join(tempfile.mkdtemp(), 'undescribed.pcapng')
+    try:
+        with open(path, 'wb') as handle:
+            handle.write(data)
+        capture = replay.PcapFile(path)
+        packets = [(timestamp, length, str(packet))
+                   for timestamp, length, packet in capture.packets()]
+        capture.close()
+    finally:
+        os.unlink(path)
+    assert packets == [(3.0, len(_FRAME), _FRAME)], packets
+
+
+if __name__ == '__main__':
+    undescribed_interface_test()
+    print 'ok'
@@ -0,0 +1,128 @@
+__author__ = 'gmr'
+
+import random
+import sys
+sys.path.insert(0, '..')
+
+import traffic
+from menwith import sampling
+
+_IPV6 = 0x20010db8000000000000000000000001
+_RATES = [1, 4, 16]
+
+
+def _connections(count, seed=1):
+    """Return random IPv4 connections to a memcached server.
+
+    :param int count: The number of connections
+    :param int seed: The random seed
+    :returns: list
+
+    """
+    generator = random.Random(seed)
+    return [(generator.getrandbits(32), generator.getrandbits(16),
+             generator.getrandbits(32), 11211) for index in xrange(count)]
+
+
+def keep_test(count=40000):
+    """Check both directions of a connection are kept or dropped together,
+    IPv6 ones included, and that 1 in rate connections is kept.
+
+    """
+    connections = _connections(count)
+    connections.append((_IPV6, 40000, _IPV6 + 1, 11211))
+    for rate in _RATES:
+        kept = 0
+        for source, source_port, destination, port in connections:
+            keep = sampling.keep(rate, source, source_port, destination, port)
+            assert keep == sampling.keep(rate, destination, port, source,
+                                         source_port)
+            kept += keep
+        share = float(kept) / len(connections)
+        print '1/%i kept %.4f of the connections' % (rate, share)
+        assert abs(share * rate - 1) < 0.1, share
+
+
+def group_test(count=40000, rate=16):
+    """Check both directions of a connection are in the same group, and
+    the connections kept are spread evenly over every group.
+
+    """
+    groups = [0] * sampling.GROUPS
+    for source, source_port, destination, port in _connections(count):
+        group = sampling.group(source, source_port, destination, port)
+        assert group == sampling.group(destination, port, source,
+                                       source_port)
+        if sampling.keep(rate, source, source_port, destination, port):
+            groups[group] += 1
+    expected = float(sum(groups)) / sampling.GROUPS
+    assert all([abs(group / expected - 1) < 0.3 for group in groups]), \
+        groups
+
+
+def design_effect_test(count=20000):
+    """Check the design effect is 1 when each connection carries a single
+    request or nothing is sampled, grows with the requests a connection
+    carries, and scales with the group counts.
+
+    """
+    for requests, low, high in [(1, 1.0, 2.0), (20, 8.0, 40.0)]:
+        for rate in _RATES[1:]:
+            groups = [0] * sampling.GROUPS
+            for connection in _connections(count * rate / requests):
+                if sampling.keep(rate, *connection):
+                    groups[sampling.group(*connection)] += requests
+            effect = sampling.design_effect(rate, groups)
+            print '1/%i with %i requests a connection, design effect %.2f' % (
+                rate, requests, effect)
+            assert low <= effect <= high, effect
+
+    groups = [10, 30, 5, 50, 20, 0, 15, 40, 25, 35, 10, 5, 60, 20, 30, 45]
+    effect = sampling.design_effect(8, groups)
+    assert effect > 1
+    scaled = sampling.design_effect(8, [count * 3 for count in groups])
+    assert abs(scaled - 3 * effect) < 1e-9, (scaled, effect)
+    assert sampling.design_effect(1, groups) == 1.0
+    assert sampling.design_effect(8, [0] * sampling.GROUPS) == 1.0
+    assert sampling.design_effect(8, [7] * sampling.GROUPS) == 1.0
+
+
+def bounds_test():
+    """Check the bounds widen with the design effect, never fall below the
+    count sampled, and are the count itself when nothing is sampled.
+
+    """
+    assert sampling.bounds(1000, 1) == (1000, 1000)
+    low, high = sampling.bounds(1000, 10)
+    wide_low, wide_high = sampling.bounds(1000, 10, 4.0)
+    assert wide_low < low < 1000 < high < wide_high
+    assert abs((wide_high - 1000) - 2 * (high - 1000)) < 1e-9
+    assert sampling.bounds(20, 100, 50.0)[0] == 20 / 100.0
+
+
+def estimates_test(requests=20000, rate=4):
+    """Check a sampled decoder scales up its counts, bounding those of
+    the commands and not those of the keys.
+
+    """
+    decoder = traffic.decode(requests, traffic={'sample': rate},
+                             responses=True, sample=rate)
+    estimates = decoder.estimates
+    assert estimates['sample'] == rate
+    for command, estimate in estimates['counts'].iteritems():
+        assert estimate['estimate'] == decoder.counts[command]
+        assert estimate['low'] <= estimate['estimate'] <= estimate['high']
+    total = sum([estimate['estimate']
+                 for estimate in estimates['counts'].itervalues()])
+    print '1/%i estimated %i of %i requests' % (rate, total, requests)
+    for key, count in estimates['keys']:
+        assert isinstance(count, int) and not count % rate
+
+
+if __name__ == '__main__':
+    keep_test()
+    group_test()
+    design_effect_test()
+    bounds_test()
+    estimates_test()
+    print 'ok'
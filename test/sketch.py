@@ -0,0 +1,119 @@
+__author__ = 'gmr'
+
+import collections
+import random
+import sys
+sys.path.insert(0, '..')
+
+import generator
+from menwith import sketch
+
+
+def _zipf_keys(count, seed=1):
+    """Return count keys drawn from a Zipf distribution.
+
+    :param int count: The number of keys
+    :param int seed: The random seed
+    :returns: list
+
+    """
+    keys = generator.ZipfKeys(random.Random(seed), 100000)
+    return [keys.key() for index in xrange(count)]
+
+
+def space_saving_test(count=200000, top=20, error=0.001):
+    """Check every count is at or over the true count and within the error
+    bound of it, and the most used keys are reported in order.
+
+    """
+    keys = _zipf_keys(count)
+    exact = collections.Counter(keys)
+    summary = sketch.SpaceSaving(top, error)
+    for key in keys:
+        summary.increment(key)
+    assert len(summary) == summary.capacity == 1000
+    assert summary.total == count
+    for key, estimate, overcount in summary.most_common(summary.capacity):
+        assert exact[key] <= estimate <= exact[key] + overcount
+        assert overcount <= error * count
+    assert [key for key, estimate, overcount in summary.most_common()] == \
+        [key for key, value in exact.most_common(top)]
+
+
+def space_saving_eviction_test():
+    """Check a new key replaces a least counted one, inheriting its count
+    as the overcount, and the replaced key is reported.
+
+    """
+    replaced = list()
+    summary = sketch.SpaceSaving(2, 0.5, replaced.append)
+    for key in ['a', 'a', 'b', 'c']:
+        summary.increment(key)
+    assert replaced == ['b']
+    assert summary.most_common() == [('a', 2, 0), ('c', 2, 1)]
+    assert 'b' not in summary
+
+
+def space_saving_merge_test(count=100000):
+    """Check merging the summaries of two halves keeps counts at or over
+    the true counts of the whole, within both error bounds.
+
+    """
+    keys = _zipf_keys(count)
+    exact = collections.Counter(keys)
+    halves = [sketch.SpaceSaving(20, 0.001), sketch.SpaceSaving(20, 0.001)]
+    for index, key in enumerate(keys):
+        halves[index % 2].increment(key)
+    halves[0].merge(halves[1])
+    assert halves[0].total == count
+    assert len(halves[0]) <= halves[0].capacity
+    for key, estimate, overcount in halves[0].most_common(100):
+        assert exact[key] <= estimate <= exact[key] + overcount, key
+        assert overcount <= 0.002 * count
+
+
+def hyperloglog_test():
+    """Check the estimate is within four standard errors of the distinct
+    keys added, from a few keys to many, and adding keys again changes
+    nothing.
+
+    """
+    for distinct in [10, 1000, 50000, 500000]:
+        counter = sketch.HyperLogLog()
+        for index in xrange(distinct):
+            counter.add('key:%i' % index)
+        estimate = counter.estimate()
+        registers = str(counter.registers)
+        for index in xrange(min(distinct, 1000)):
+            counter.add('key:%i' % index)
+        assert str(counter.registers) == registers
+        assert abs(estimate - distinct) <= 4 * 0.0163 * distinct + 1, \
+            (distinct, estimate)
+
+
+def hyperloglog_merge_test():
+    """Check merging counters of overlapping keys estimates their union,
+    and counters of different precisions are refused.
+
+    """
+    first, second = sketch.HyperLogLog(), sketch.HyperLogLog()
+    for index in xrange(60000):
+        first.add('key:%i' % index)
+        second.add('key:%i' % (index + 30000))
+    first.merge(second)
+    assert abs(first.estimate() - 90000) <= 4 * 0.0163 * 90000
+    try:
+        first.merge(sketch.HyperLogLog(10))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Merged HyperLogLogs of different precision')
+
+
+if __name__ == '__main__':
+    space_saving_test()
+    space_saving_eviction_test()
+    space_saving_merge_test()
+    hyperloglog_test()
+    hyperloglog_merge_test()
+    print 'ok'
@@ -0,0 +1,129 @@
+__author__ = 'gmr'
+
+import random
+import struct
+import sys
+import time
+sys.path.insert(0, '..')
+
+import traffic
+from menwith import memcache
+from menwith import slabs
+
+
+def _brute_force(sizes, factor):
+    """Return the bytes wasted storing each item in the smallest class it
+    fits in, item by item.
+
+    :param list sizes: The item sizes
+    :param float factor: The growth factor
+    :returns: int
+
+    """
+    classes = slabs.slab_classes(factor)
+    wasted = 0
+    for size in sizes:
+        for chunk in classes:
+            if size <= chunk:
+                wasted += chunk - size
+                break
+    return wasted
+
+
+def simulation_test(count=100000):
+    """Check the simulation and sweep from the histogram against storing
+    log-normally sized items one by one.
+
+    """
+    generator = random.Random(1)
+    sizes = [min(int(generator.lognormvariate(6, 1.5)), 1 << 21) + 60
+             for value in xrange(count)]
+    histogram = slabs.SizeHistogram()
+    for size in sizes:
+        histogram.record(size)
+    for factor in [1.08, 1.25, 2.0]:
+        simulated = slabs.simulate(histogram, factor)
+        expected = _brute_force(sizes, factor)
+        assert simulated['wasted_bytes'] == expected, (factor, expected)
+        assert simulated['items'] + simulated['too_large'] == count
+        assert dict(slabs.sweep(histogram, [factor]))[factor] == expected
+    start = time.time()
+    swept = slabs.sweep(histogram)
+    print 'swept %i factors over %i buckets in %.3fs' % (
+        len(swept), len(histogram.counts), time.time() - start)
+
+
+def traffic_test(requests=100000):
+    """Decode generated traffic counting the sizes of the items stored and
+    print the simulation at the default factor and the best one found.
+
+    """
+    decoder = traffic.decode(requests, traffic={'value_size': 1024,
+                                                'value_sigma': 1.5},
+                             item_sizes=True)
+    report = slabs.report(decoder.item_sizes)
+    simulated = report['simulated']
+    assert simulated['items'] + simulated['too_large'] == \
+        decoder.counts['set']
+    print '%5s %9s %9s %12s %12s' % ('class', 'chunk', 'items', 'bytes',
+                                     'wasted')
+    for row in simulated['classes']:
+        print '%5i %9i %9i %12i %12i' % (row['class'], row['chunk_size'],
+                                         row['items'], row['item_bytes'],
+                                         row['wasted_bytes'])
+    print 'factor %.2f wastes %.1f%%, best factor %.2f saves %i bytes' % (
+        simulated['factor'], simulated['wasted_ratio'] * 100,
+        report['best']['factor'], report['best']['saved_bytes'])
+
+
+def _binary_set(flags):
+    """Return a binary protocol set of 'abc' to key with the client flags.
+
+    :param int flags: The client flags
+    :returns: str
+
+    """
+    return struct.pack('!BBHBBHIIQII', 0x80, 0x01, 3, 8, 0, 0, 14, 0, 0,
+                       flags, 0) + 'keyabc'
+
+
+def flags_test():
+    """Check the client flags of an item count towards its size when they
+    are not zero, as memcached 1.6 stores them, in each kind of store.
+
+    """
+    plain = slabs.item_size(3, 3)
+    assert slabs.item_size(3, 3, 9) == plain + 4
+    for payload, expected in [('set key 0 0 3\r\nabc\r\n', plain),
+                              ('set key 7 0 3 noreply\r\nabc\r\n',
+                               plain + 4),
+                              ('ms key 3 T0\r\nabc\r\n', plain),
+                              ('ms key 3 F9 T0\r\nabc\r\n', plain + 4),
+                              (_binary_set(0), plain),
+                              (_binary_set(9), plain + 4)]:
+        decoder = memcache.Decoder(None, item_sizes=True)
+        decoder.add_batch([(time.time(), 1, 40000, 2, 11211, 0, 0, payload)])
+        assert sum(decoder.item_sizes.bytes.values()) == expected, payload
+
+
+def unrecorded_test(requests=2000):
+    """Check the sizes of stored items are not worked out when nothing
+    records them.
+
+    """
+    item_size = slabs.item_size
+    slabs.item_size = None
+    try:
+        for binary in [False, True]:
+            decoder = traffic.decode(requests, traffic={'binary': binary})
+            assert decoder.counts['set']
+    finally:
+        slabs.item_size = item_size
+
+
+if __name__ == '__main__':
+    simulation_test()
+    flags_test()
+    unrecorded_test()
+    traffic_test()
+    print 'ok'
@@ -0,0 +1,152 @@
+__author__ = 'gmr'
+
+import sys
+sys.path.insert(0, '..')
+
+from menwith import stream
+
+_KEY = (1, 40000, 2, 11211)
+
+
+class Lines(object):
+    """Parser that cuts complete lines out of the data of each flow"""
+    def __init__(self):
+        self.lines = list()
+
+    def __call__(self, flow, data):
+        end = data.rfind('\n') + 1
+        self.lines.extend(data[:end].splitlines())
+        return end
+
+
+def _table(**limits):
+    """Return a flow table and the parser collecting its lines.
+
+    :returns: tuple
+
+    """
+    parser = Lines()
+    return stream.FlowTable(parser, **limits), parser
+
+
+def in_order_test():
+    """Check data split anywhere is handed over contiguous, with the part
+    of a line that has not all arrived kept until it has.
+
+    """
+    table, parser = _table()
+    table.segment(0, *(_KEY + (99, stream.TCP_SYN, '')))
+    table.segment(0, *(_KEY + (100, 0, 'get a\nget')))
+    assert parser.lines == ['get a']
+    assert table.get(_KEY).buffer == 'get'
+    table.segment(0, *(_KEY + (109, 0, ' b\n')))
+    assert parser.lines == ['get a', 'get b']
+    assert table.buffered == 0
+
+
+def out_of_order_test():
+    """Check segments ahead of a missing one are held and pulled in once
+    it arrives.
+
+    """
+    table, parser = _table()
+    table.segment(0, *(_KEY + (100, 0, 'one\n')))
+    table.segment(0, *(_KEY + (112, 0, 'three\n')))
+    table.segment(0, *(_KEY + (108, 0, 'two\n')))
+    assert parser.lines == ['one'], parser.lines
+    assert table.buffered == 10
+    table.segment(0, *(_KEY + (104, 0, 'and\n')))
+    assert parser.lines == ['one', 'and', 'two', 'three'], parser.lines
+    assert table.buffered == 0
+
+
+def retransmission_test():
+    """Check a segment sent again is ignored and the new part of one that
+    overlaps what was received is kept.
+
+    """
+    table, parser = _table()
+    table.segment(0, *(_KEY + (100, 0, 'one\n')))
+    table.segment(0, *(_KEY + (100, 0, 'one\n')))
+    table.segment(0, *(_KEY + (102, 0, 'e\ntwo\n')))
+    assert parser.lines == ['one', 'two'], parser.lines
+
+    # Sequence numbers wrap around
+    table.segment(0, *((3, 1, 4, 11211) +
+                       (0xfffffffe, 0, 'wr')))
+    table.segment(0, *((3, 1, 4, 11211) + (0, 0, 'ap\n')))
+    assert parser.lines[-1] == 'wrap', parser.lines
+
+
+def skip_test():
+    """Check the bytes the parser asks to skip are dropped across
+    segments.
+
+    """
+    def parser(flow, data):
+        if data.startswith('skip '):
+            flow.skip = int(data[5:7])
+            return 8
+        seen.append(data)
+        return len(data)
+
+    seen = list()
+    table = stream.FlowTable(parser)
+    table.segment(0, *(_KEY + (0, 0, 'skip 12\nxxxx')))
+    table.segment(0, *(_KEY + (12, 0, 'xxxxxxxxkept')))
+    assert seen == ['kept'], seen
+
+
+def gap_test():
+    """Check a flow holding more than it may gives up on the missing bytes
+    and carries on from the earliest segment held, unsynchronized.
+
+    """
+    table, parser = _table(max_flow_bytes=16)
+    table.segment(0, *(_KEY + (100, 0, 'one\n')))
+    table.segment(0, *(_KEY + (200, 0, 'lost\nfound\n')))
+    assert parser.lines == ['one']
+    table.segment(0, *(_KEY + (211, 0, 'more lines\n')))
+    assert parser.lines == ['one', 'lost', 'found', 'more lines'], \
+        parser.lines
+    assert not table.get(_KEY).synchronized
+    assert table.buffered == 0
+
+
+def eviction_test():
+    """Check flows are evicted when closed, idle, or over the table
+    limits, and that the bytes they held are released.
+
+    """
+    table, parser = _table(max_flows=10, idle_timeout=60)
+    for port in xrange(10):
+        table.segment(port, *((1, port, 2, 11211) + (0, 0, 'partial')))
+    assert table.active == 10 and table.buffered == 70
+
+    # The least recently seen flow makes room for a new one
+    table.segment(10, *((1, 10, 2, 11211) + (0, 0, 'partial')))
+    assert table.active == 10 and table.evicted == 1
+    assert table.get((1, 0, 2, 11211)) is None
+    assert table.buffered == 70
+
+    # A closed flow is removed, and no flow is started by a reset
+    table.segment(11, *((1, 1, 2, 11211) + (7, stream.TCP_FIN, '')))
+    table.segment(11, *((1, 99, 2, 11211) + (0, stream.TCP_RST, '')))
+    assert table.active == 9 and table.evicted == 2
+    assert table.get((1, 99, 2, 11211)) is None
+
+    # Flows idle past the timeout are swept
+    table.segment(100, *(_KEY + (0, 0, 'line\n')))
+    assert table.active == 1, table.active
+    assert table.buffered == 0
+    assert parser.lines == ['line']
+
+
+if __name__ == '__main__':
+    in_order_test()
+    out_of_order_test()
+    retransmission_test()
+    skip_test()
+    gap_test()
+    eviction_test()
+    print 'ok'
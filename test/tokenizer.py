@@ -0,0 +1,100 @@
+__author__ = 'gmr'
+
+import sys
+sys.path.insert(0, '..')
+
+from menwith import memcache
+
+_CLIENT = (0x0a000001, 40000, 0x0a000002, 11211)
+
+
+def _decode(payloads):
+    """Return a decoder that decoded the payloads, sent in order on one
+    connection.
+
+    :param list payloads: The TCP payloads
+    :returns: memcache.Decoder
+
+    """
+    decoder = memcache.Decoder(None)
+    sequence = 0
+    batch = list()
+    for payload in payloads:
+        batch.append((0.0,) + _CLIENT + (sequence, 0, payload))
+        sequence += len(payload)
+    decoder.add_batch(batch)
+    return decoder
+
+
+def _used(decoder):
+    """Return the commands counted and the keys used by a decoder.
+
+    :param memcache.Decoder decoder: The decoder
+    :returns: tuple
+
+    """
+    return (dict([(command, count) for command, count in
+                  decoder.counts.iteritems() if count]), decoder.keys)
+
+
+def commands_test():
+    """Check every command is counted with the keys it uses, storage data
+    blocks are jumped over whatever is in them, and lines that are not
+    commands are skipped.
+
+    """
+    decoder = _decode(['get a b c\r\n'
+                       'gets d\r\n'
+                       'set e 0 0 7 noreply\r\nget f\r\n\r\n'
+                       'cas g 1 0 2 99\r\nxy\r\n'
+                       'incr h 1\r\n'
+                       'delete a\r\n'
+                       'touch b 10\r\n'
+                       'gat 10 i j\r\n'
+                       'ms k 2 T0\r\nzz\r\n'
+                       'mg l v\r\n'
+                       'mn\r\n'
+                       '\r\n'
+                       'not a command\r\n'
+                       'stats slabs\r\n'
+                       'version\r\n'])
+    counts, keys = _used(decoder)
+    assert counts == {'get': 1, 'gets': 1, 'set': 1, 'cas': 1, 'incr': 1,
+                      'delete': 1, 'touch': 1, 'gat': 1, 'ms': 1, 'mg': 1,
+                      'mn': 1, 'stats': 1, 'version': 1}, counts
+    assert keys == {'a': 2, 'b': 2, 'c': 1, 'd': 1, 'e': 1, 'g': 1,
+                    'h': 1, 'i': 1, 'j': 1, 'k': 1, 'l': 1}, keys
+
+
+def split_test():
+    """Check a command line and a data block split across segments are
+    decoded once all of them have arrived.
+
+    """
+    decoder = _decode(['ge', 't a\r\nset b 0 0 10\r\n0123',
+                       '456789\r\nget', ' c\r\n'])
+    counts, keys = _used(decoder)
+    assert counts == {'get': 2, 'set': 1}, counts
+    assert keys == {'a': 1, 'b': 1, 'c': 1}, keys
+
+
+def resynchronize_test():
+    """Check decoding starts again at the next line after a gap in the
+    stream too long to wait out, rather than part way into one.
+
+    """
+    decoder = memcache.Decoder(None)
+    decoder.add_batch([(0.0,) + _CLIENT + (0, 0, 'get a\r\n'),
+                       (0.0,) + _CLIENT + (11, 0, 'get b\r\n' +
+                                           'get c\r\n' * 40000),
+                       (0.0,) + _CLIENT + (7, 0, 'lost')])
+    counts, keys = _used(decoder)
+    assert counts == {'get': 40001}, counts
+    assert keys == {'a': 1, 'c': 40000}, keys
+
+
+if __name__ == '__main__':
+    commands_test()
+    split_test()
+    resynchronize_test()
+    print 'ok'
@@ -0,0 +1,61 @@
+"""
+Decoded synthetic traffic for the tests
+
+The packets of generator.TrafficGenerator are run through the packet
+decoding of a live capture, keeping the batches of segments it hands over,
+and those batches can be decoded by a Decoder as the decode thread would.
+
+"""
+__author__ = 'gmr'
+
+import sys
+sys.path.insert(0, '..')
+
+import generator
+from menwith import memcache
+from menwith import network
+
+
+class ListQueue(list):
+    """Stand-in for Queue.Queue that keeps the batches put on it"""
+    put = list.append
+
+
+def batches(requests, sample=1, **options):
+    """Return the batches of segments decoded from generated traffic.
+
+    :param int requests: The number of requests to generate
+    :param int sample: Keep 1 in this many connections
+    :param dict options: The TrafficGenerator options
+    :returns: list
+
+    """
+    queue = ListQueue()
+    capture = network.PacketCapture(
+        queue, sample=sample,
+        linktype=generator.LINKS[options.get('link', 'ethernet')])
+    for timestamp, packet in generator.TrafficGenerator(
+            **options).packets(requests):
+        capture._process_packet(len(packet), packet, timestamp)
+    capture._flush()
+    return queue
+
+
+def decode(requests, state=None, traffic=None, **options):
+    """Return a Decoder that has decoded generated traffic, carrying on
+    from a state if given.
+
+    :param int requests: The number of requests to generate
+    :param dict state: The state to merge in before decoding
+    :param dict traffic: The TrafficGenerator options
+    :param dict options: The Decoder options
+    :returns: memcache.Decoder
+
+    """
+    decoder = memcache.Decoder(None, **options)
+    if state:
+        decoder.merge(state)
+    for batch in batches(requests, **(traffic or dict())):
+        decoder.add_batch(batch)
+    decoder.finish()
+    return decoder
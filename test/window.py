@@ -0,0 +1,129 @@
+__author__ = 'gmr'
+
+import heapq
+import sys
+import time
+sys.path.insert(0, '..')
+
+import traffic
+from menwith import memcache
+from menwith import window
+
+_WINDOWS = [('1s', 1), ('3s', 3)]
+
+
+def rates_test():
+    """Check each window sums the intervals completed within it, counting
+    only those completed so far while fewer than its length have.
+
+    """
+    rolling = window.RollingWindow(['get'], 1.0, 4, _WINDOWS)
+    for second, count in enumerate([2, 4, 6, 8]):
+        rolling.advance(100.0 + second)
+        rolling.current['get'] += count
+        if second == 1:
+            assert rolling.rates() == {'1s': {'get': 2.0},
+                                       '3s': {'get': 2.0}}
+    rolling.advance(104.5)
+    assert rolling.end == 105.0
+    assert rolling.rates() == {'1s': {'get': 8.0}, '3s': {'get': 6.0}}
+
+    # An interval with nothing counted brings the rates down
+    rolling.advance(105.0)
+    assert rolling.rates() == {'1s': {'get': 0.0},
+                               '3s': {'get': 14 / 3.0}}
+
+    # Time going backwards is counted in the current interval
+    rolling.advance(101.0)
+    rolling.current['get'] += 1
+    rolling.advance(106.0)
+    assert rolling.rates()['1s'] == {'get': 1.0}
+
+
+def gap_test():
+    """Check nothing counted before a gap longer than the intervals kept is
+    in any window after it.
+
+    """
+    rolling = window.RollingWindow(['get'], 1.0, 4, _WINDOWS)
+    rolling.advance(0.0)
+    rolling.current['get'] += 10
+    rolling.advance(1.0)
+    rolling.advance(50.0)
+    rolling.current['get'] += 3
+    rolling.advance(51.0)
+    assert rolling.rates() == {'1s': {'get': 3.0}, '3s': {'get': 1.0}}
+
+
+def merge_test():
+    """Check merging windows adds up the counts of each interval, moving
+    on to the later of the two.
+
+    """
+    first = window.RollingWindow(['get'], 1.0, 4, _WINDOWS)
+    second = window.RollingWindow(['get'], 1.0, 4, _WINDOWS)
+    for second_of, rolling, count in [(10, first, 1), (11, first, 2),
+                                      (11, second, 4), (12, second, 8)]:
+        rolling.advance(float(second_of))
+        rolling.current['get'] += count
+    first.merge(second)
+    first.advance(13.0)
+    assert first.rates() == {'1s': {'get': 8.0}, '3s': {'get': 5.0}}
+
+
+def idle_test(requests=100):
+    """Check a live decoder moves its windows on with the clock while no
+    traffic arrives, so the rates fall, and one replaying does not.
+
+    """
+    started = time.time() - 3
+    batch = [(started, 1, 40000, 2, 11211, index * 7, 0, 'get a\r\n')
+             for index in xrange(requests)]
+    for live in [True, False]:
+        decoder = memcache.Decoder(None, live=live)
+        decoder.add_batch(batch)
+        published = decoder.snapshot()
+        decoder.idle()
+        snapshot = decoder.snapshot()
+        if live:
+            assert snapshot['requests']['1s'] == dict(), snapshot
+            assert snapshot['requests']['10s'] == {'get': requests / 3.0}
+        else:
+            assert snapshot is published
+
+
+def _top_counts(keys, top=20):
+    """Return the use counts of the most used keys, most used first.
+
+    :param dict keys: The keys and their use counts
+    :param int top: The number of keys
+    :returns: list
+
+    """
+    return heapq.nlargest(top, keys.values())
+
+
+def snapshot_keys_test(requests=20000):
+    """Check the snapshot of a decoder counting every key has the most
+    used keys and their counts, after merging another decoder too.
+
+    """
+    decoder = traffic.decode(requests)
+    keys = decoder.snapshot()['keys']
+    assert [count for key, count in keys] == _top_counts(decoder.keys)
+    for key, count in keys:
+        assert decoder.keys[key] == count, key
+
+    resumed = traffic.decode(requests, decoder.state())
+    keys = resumed.snapshot()['keys']
+    assert [count for key, count in keys] == _top_counts(resumed.keys)
+    assert keys[0][1] == 2 * decoder.snapshot()['keys'][0][1]
+
+
+if __name__ == '__main__':
+    rates_test()
+    gap_test()
+    merge_test()
+    idle_test()
+    snapshot_keys_test()
+    print 'ok'
@@ -0,0 +1,184 @@
+__author__ = 'gmr'
+
+import optparse
+import os
+import sys
+import tempfile
+import time
+sys.path.insert(0, '..')
+
+import traffic
+from menwith import checkpoint
+from menwith import memcache
+from menwith import pipeline
+from menwith import ring
+from menwith import sketch
+from menwith import workers
+
+WORKERS = 4
+
+
+class ListRing(list):
+    """Stand-in for ring.Ring that keeps the batches put on it"""
+    def put(self, batch, block=True):
+        self.append(batch)
+        return True
+
+
+def _options(path=None):
+    """Return the options of decoding in worker processes.
+
+    :param str path: The checkpoint file, if checkpointing
+    :returns: optparse.Values
+
+    """
+    return optparse.Values({'port': [11211], 'responses': True,
+                            'top_keys': None, 'key_error': sketch.KEY_ERROR,
+                            'distinct': False, 'servers': None,
+                            'namespaces': None, 'sample': 1, 'slabs': False,
+                            'replay': 'replay.pcap', 'resume': None,
+                            'checkpoint': path, 'mrc': False,
+                            'mrc_rate': 0.01, 'mrc_keys': 100000,
+                            'workers': WORKERS,
+                            'overload': pipeline.BLOCK})
+
+
+def _shards(batches, count):
+    """Return the batches split between decoders by connection, as the
+    capture splits them between the worker rings.
+
+    :param list batches: The batches of segments
+    :param int count: The number of decoders
+    :returns: list
+
+    """
+    rings = [ListRing() for index in xrange(count)]
+    sharded = workers.ShardedQueue(rings)
+    for batch in batches:
+        sharded.put(batch)
+    return rings
+
+
+def merge_summaries_test(requests=20000):
+    """Check the summaries of decoders given a shard of the connections
+    each, sent through shared memory slots, merge into the snapshot of one
+    decoder given them all.
+
+    """
+    batches = traffic.batches(requests)
+    whole = memcache.Decoder(None, responses=True)
+    for batch in batches:
+        whole.add_batch(batch)
+    whole.finish()
+    summaries = list()
+    for shard in _shards(batches, WORKERS):
+        decoder = memcache.Decoder(None, responses=True)
+        for batch in shard:
+            decoder.add_batch(batch)
+        decoder.finish()
+        slot = ring.Slot()
+        assert slot.put(decoder.summary())
+        sequence, summary = slot.get()
+        assert sequence == 1
+        summaries.append(summary)
+    merged = memcache.merge_summaries(summaries)
+    expected = whole.snapshot()
+    for name in ['started', 'timestamp', 'counts', 'hits', 'misses',
+                 'value_bytes', 'latencies', 'histograms']:
+        assert merged[name] == expected[name], name
+    for name, rates in expected['requests'].iteritems():
+        for command, rate in rates.iteritems():
+            assert abs(merged['requests'][name][command] - rate) < 1e-6
+    assert [key for key, count in merged['keys'][:5]] == \
+        [key for key, count in expected['keys'][:5]]
+
+
+def slot_test():
+    """Check a slot returns the latest value put, and refuses one that
+    does not fit.
+
+    """
+    slot = ring.Slot(64)
+    assert slot.get() == (0, None)
+    assert slot.put({'a': [1, 2]})
+    assert slot.put({'b': (3, 'four')})
+    assert slot.get() == (2, {'b': (3, 'four')})
+    assert not slot.put('x' * 64)
+    assert slot.get() == (2, {'b': (3, 'four')})
+
+
+def workers_test(requests=20000):
+    """Decode in worker processes and check the snapshots they publish
+    are read without asking the workers for their statistics, while they
+    decode and once they have stopped, when they add up to every request.
+
+    """
+    decoders = workers.DecodeWorkers(_options())
+    decoders.start()
+    states = decoders._states
+    decoders._states = None
+    try:
+        for batch in traffic.batches(requests):
+            decoders.queue.put(batch)
+        deadline = time.time() + 30
+        while not decoders.snapshot()['counts']:
+            assert time.time() < deadline
+            time.sleep(0.1)
+        assert decoders.snapshot() is decoders.snapshot()
+    finally:
+        decoders.stop_process()
+        decoders.join()
+    snapshot = decoders.snapshot()
+    assert sum(snapshot['counts'].values()) == requests
+    decoders._states = states
+    counts = decoders.values()[0]
+    assert counts == snapshot['counts'], (counts, snapshot['counts'])
+    print '%i workers published %i requests' % (WORKERS, sum(counts.values()))
+
+def checkpoint_test(requests=20000):
+    """Checkpoint workers while they decode, without asking them for their
+    statistics, and check the parts they write are merged into the
+    checkpoint, and removed once the final checkpoint is written.
+
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'menwith.ckpt')
+    options = _options(path)
+    decoders = workers.DecodeWorkers(options)
+    checkpointer = checkpoint.Checkpointer(path, checkpoint.settings(options),
+                                           0, WORKERS)
+    decoders.start()
+    states = decoders._states
+    decoders._states = None
+    try:
+        for batch in traffic.batches(requests):
+            decoders.queue.put(batch)
+        deadline = time.time() + 30
+        while not all([os.path.exists(part) for part in checkpointer.parts]):
+            assert time.time() < deadline
+            decoders.checkpoint(checkpointer)
+            time.sleep(0.1)
+        assert not os.path.exists(path)
+        decoders.checkpoint(checkpointer)
+        checkpointer.wait()
+        settings, state = checkpoint.read(path)
+        assert settings == checkpoint.settings(options)
+        assert 0 < sum(state['counts'].values()) <= requests
+        print 'checkpointed %i of %i requests from %i parts' % (
+            sum(state['counts'].values()), requests, WORKERS)
+    finally:
+        decoders.stop_process()
+        decoders.join()
+    decoders._states = states
+    checkpointer.finish(decoders.state())
+    assert sum(checkpoint.read(path)[1]['counts'].values()) == requests
+    assert not any([os.path.exists(part) for part in checkpointer.parts])
+    os.unlink(path)
+    os.rmdir(os.path.dirname(path))
+
+
+if __name__ == '__main__':
+    merge_summaries_test()
+    slot_test()
+    workers_test()
+    checkpoint_test()
+    print 'ok'